@@ -0,0 +1,7 @@
+-- migrate:up
+ALTER TABLE selfbot ADD COLUMN crawl_concurrency integer;
+
+COMMENT ON COLUMN selfbot.crawl_concurrency IS 'Channels message_history crawls at once with this selfbot. NULL uses CRAWL_CONCURRENCY.';
+
+-- migrate:down
+ALTER TABLE selfbot DROP COLUMN crawl_concurrency;
@@ -0,0 +1,7 @@
+-- migrate:up
+ALTER TABLE channel ADD COLUMN history_crawled boolean DEFAULT false NOT NULL;
+
+COMMENT ON COLUMN channel.history_crawled IS 'Has backfill_history reached the first message of the channel';
+
+-- migrate:down
+ALTER TABLE channel DROP COLUMN history_crawled;
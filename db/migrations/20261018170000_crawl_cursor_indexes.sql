@@ -0,0 +1,13 @@
+-- migrate:up transaction:false
+CREATE INDEX CONCURRENTLY IF NOT EXISTS message_channel_id_id_idx ON message (channel_id, id);
+
+DROP INDEX CONCURRENTLY IF EXISTS channel_id_idx;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS channel_crawl_log_channel_id_idx ON channel_crawl_log (channel_id);
+
+-- migrate:down transaction:false
+CREATE INDEX CONCURRENTLY IF NOT EXISTS channel_id_idx ON message (channel_id);
+
+DROP INDEX CONCURRENTLY IF EXISTS message_channel_id_id_idx;
+
+DROP INDEX CONCURRENTLY IF EXISTS channel_crawl_log_channel_id_idx;
@@ -0,0 +1,29 @@
+-- migrate:up
+CREATE TABLE channel_cursor (
+    channel_id bigint NOT NULL PRIMARY KEY REFERENCES channel (id) ON DELETE CASCADE,
+    high_message_id bigint DEFAULT 0 NOT NULL,
+    low_message_id bigint,
+    updated_at timestamp without time zone DEFAULT now() NOT NULL
+);
+
+COMMENT ON TABLE channel_cursor IS 'Crawl position of each channel. Updated in the same transaction as the messages it covers.';
+COMMENT ON COLUMN channel_cursor.high_message_id IS 'Newest message id stored. message_history continues after it.';
+COMMENT ON COLUMN channel_cursor.low_message_id IS 'Oldest message id stored. backfill_history continues before it.';
+
+INSERT INTO channel_cursor (channel_id, high_message_id, low_message_id)
+SELECT
+    c.id,
+    greatest(
+        coalesce((SELECT max(cl.high_message_id) FROM channel_crawl_log cl WHERE cl.channel_id = c.id), 0),
+        coalesce((SELECT max(m.id) FROM message m WHERE m.channel_id = c.id), 0)
+    ),
+    (SELECT min(m.id) FROM message m WHERE m.channel_id = c.id)
+FROM channel c;
+
+-- The crawler used to walk every channel forward from snowflake 0, so a
+-- logged crawl starting at 0 covered the whole history.
+UPDATE channel SET history_crawled = true
+WHERE id IN (SELECT channel_id FROM channel_crawl_log WHERE low_message_id = 0);
+
+-- migrate:down
+DROP TABLE channel_cursor;
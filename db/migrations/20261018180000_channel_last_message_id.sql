@@ -0,0 +1,10 @@
+-- migrate:up
+ALTER TABLE channel ADD COLUMN last_message_id bigint;
+
+COMMENT ON COLUMN channel.last_message_id IS 'Newest message id reported by Discord at the last channel refresh';
+
+UPDATE channel SET last_message_id = (raw_data ->> 'last_message_id')::bigint
+WHERE raw_data ->> 'last_message_id' IS NOT NULL;
+
+-- migrate:down
+ALTER TABLE channel DROP COLUMN last_message_id;
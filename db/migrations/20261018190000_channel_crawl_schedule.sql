@@ -0,0 +1,42 @@
+-- migrate:up
+ALTER TABLE channel
+    ADD COLUMN message_rate double precision DEFAULT 0 NOT NULL,
+    ADD COLUMN last_crawl_messages integer,
+    ADD COLUMN next_crawl_at timestamp without time zone DEFAULT now() NOT NULL;
+
+COMMENT ON COLUMN channel.message_rate IS 'Smoothed messages per hour, estimated from crawl results';
+COMMENT ON COLUMN channel.last_crawl_messages IS 'Messages fetched by the last crawl';
+COMMENT ON COLUMN channel.next_crawl_at IS 'message_history will not crawl the channel before this time';
+
+CREATE INDEX channel_next_crawl_at_idx ON channel (next_crawl_at) WHERE crawl_enabled;
+
+CREATE VIEW v_crawl_schedule AS
+SELECT
+    g.name AS guild,
+    c.name AS channel,
+    c.id AS channel_id,
+    g.crawl_priority,
+    round(c.message_rate::numeric, 2) AS messages_per_hour,
+    c.last_crawl_messages,
+    c.last_update AS last_crawl_at,
+    c.next_crawl_at,
+    c.next_crawl_at - c.last_update AS crawl_interval,
+    greatest(now()::timestamp - c.next_crawl_at, interval '0') AS overdue,
+    cc.channel_id IS NULL OR cc.high_message_id < coalesce(c.last_message_id, 0) AS has_new_messages
+FROM channel c
+JOIN guild g ON g.id = c.guild_id
+LEFT JOIN channel_cursor cc ON cc.channel_id = c.id
+WHERE c.crawl_enabled AND g.crawl_enabled
+ORDER BY c.next_crawl_at;
+
+COMMENT ON VIEW v_crawl_schedule IS 'When each channel is crawled next and why: its message rate and guild priority';
+
+-- migrate:down
+DROP VIEW v_crawl_schedule;
+
+DROP INDEX channel_next_crawl_at_idx;
+
+ALTER TABLE channel
+    DROP COLUMN message_rate,
+    DROP COLUMN last_crawl_messages,
+    DROP COLUMN next_crawl_at;
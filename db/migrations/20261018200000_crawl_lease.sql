@@ -0,0 +1,19 @@
+-- migrate:up
+CREATE TABLE crawl_lease (
+    channel_id bigint NOT NULL REFERENCES channel (id) ON DELETE CASCADE,
+    lane text NOT NULL,
+    owner text NOT NULL,
+    acquired_at timestamp without time zone DEFAULT now() NOT NULL,
+    heartbeat_at timestamp without time zone DEFAULT now() NOT NULL,
+    expires_at timestamp without time zone NOT NULL,
+    PRIMARY KEY (channel_id, lane)
+);
+
+COMMENT ON TABLE crawl_lease IS 'Channels being crawled right now and by which worker. Expired leases can be claimed again';
+COMMENT ON COLUMN crawl_lease.lane IS 'forward (message_history) or backfill (backfill_history)';
+COMMENT ON COLUMN crawl_lease.owner IS 'host:pid:thread of the worker holding the lease';
+
+CREATE INDEX crawl_lease_expires_at_idx ON crawl_lease (expires_at);
+
+-- migrate:down
+DROP TABLE crawl_lease;
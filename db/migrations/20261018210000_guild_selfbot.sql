@@ -0,0 +1,20 @@
+-- migrate:up
+CREATE TABLE guild_selfbot (
+    guild_id bigint NOT NULL REFERENCES guild (id) ON DELETE CASCADE,
+    selfbot_id integer NOT NULL REFERENCES selfbot (id) ON DELETE CASCADE,
+    active boolean DEFAULT true NOT NULL,
+    first_seen_at timestamp without time zone DEFAULT now() NOT NULL,
+    last_seen_at timestamp without time zone DEFAULT now() NOT NULL,
+    PRIMARY KEY (guild_id, selfbot_id)
+);
+
+COMMENT ON TABLE guild_selfbot IS 'Every selfbot that is a member of a guild. Their tokens share the guild''s crawl';
+COMMENT ON COLUMN guild_selfbot.active IS 'False once the selfbot left the guild or its token was rejected (401)';
+
+CREATE INDEX guild_selfbot_selfbot_id_idx ON guild_selfbot (selfbot_id) WHERE active;
+
+INSERT INTO guild_selfbot (guild_id, selfbot_id)
+SELECT id, selfbot_id FROM guild WHERE selfbot_id IS NOT NULL;
+
+-- migrate:down
+DROP TABLE guild_selfbot;
@@ -0,0 +1,209 @@
+-- migrate:up
+
+-- Message ids are snowflakes: milliseconds since the Discord epoch shifted
+-- left by 22 bits. A time range maps to an id range, so `message` can be
+-- range partitioned on its primary key by month.
+CREATE FUNCTION snowflake_at(ts timestamp with time zone) RETURNS bigint
+    LANGUAGE sql IMMUTABLE
+    AS $$
+    SELECT greatest((extract(epoch FROM ts) * 1000)::bigint - 1420070400000, 0) << 22
+$$;
+
+COMMENT ON FUNCTION snowflake_at(timestamp with time zone) IS 'Lowest snowflake created at or after a time';
+
+CREATE FUNCTION create_message_partitions(
+    months_ahead integer DEFAULT 3,
+    since timestamp with time zone DEFAULT now()
+) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    month timestamp with time zone := date_trunc('month', since, 'UTC');
+    last_month timestamp with time zone := date_trunc('month', now(), 'UTC') + make_interval(months => months_ahead);
+    covered_to bigint;
+    lo bigint;
+    hi bigint;
+    name text;
+    created integer := 0;
+BEGIN
+    -- One caller at a time, every crawler node runs this.
+    PERFORM pg_advisory_xact_lock(hashtext('create_message_partitions'));
+
+    -- Upper bound of the newest partition. Monthly partitions are contiguous,
+    -- so everything below it is covered.
+    SELECT max((regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''(-?\d+)''\)'))[1]::bigint)
+    INTO covered_to
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'message'::regclass;
+
+    WHILE month <= last_month LOOP
+        lo := snowflake_at(month);
+        hi := snowflake_at(month + interval '1 month');
+
+        IF covered_to IS NULL OR hi > covered_to THEN
+            lo := greatest(lo, coalesce(covered_to, lo));
+            name := 'message_' || to_char(month AT TIME ZONE 'UTC', '"y"YYYY"m"MM');
+
+            -- Rows that already landed in the default partition move into the
+            -- new one, otherwise it could not be attached.
+            EXECUTE format('CREATE TABLE %I (LIKE message INCLUDING DEFAULTS)', name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM message_default WHERE id >= %s AND id < %s RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved', lo, hi, name);
+            EXECUTE format('ALTER TABLE message ATTACH PARTITION %I FOR VALUES FROM (%s) TO (%s)', name, lo, hi);
+
+            covered_to := hi;
+            created := created + 1;
+        END IF;
+
+        month := month + interval '1 month';
+    END LOOP;
+
+    RETURN created;
+END
+$$;
+
+COMMENT ON FUNCTION create_message_partitions(integer, timestamp with time zone) IS 'Create the monthly message partitions from `since` up to `months_ahead` months from now that do not exist yet';
+
+DROP MATERIALIZED VIEW mv_guild_stats;
+DROP MATERIALIZED VIEW mv_channel_stats;
+DROP VIEW v_channel_stats;
+DROP VIEW v_messages;
+
+ALTER TABLE message RENAME TO message_legacy;
+ALTER TABLE message_legacy RENAME CONSTRAINT message_pkey TO message_legacy_pkey;
+ALTER INDEX message_channel_id_id_idx RENAME TO message_legacy_channel_id_id_idx;
+
+CREATE TABLE message (
+    id bigint NOT NULL,
+    raw_data json,
+    channel_id bigint
+) PARTITION BY RANGE (id);
+
+ALTER TABLE message ADD CONSTRAINT message_pkey PRIMARY KEY (id);
+CREATE INDEX message_channel_id_id_idx ON message (channel_id, id);
+
+CREATE TABLE message_default PARTITION OF message DEFAULT;
+
+COMMENT ON TABLE message IS 'Partitioned by id (snowflake) into months, see create_message_partitions()';
+COMMENT ON TABLE message_default IS 'Messages outside every monthly partition. create_message_partitions() moves them into their month';
+
+-- Existing messages are not copied. The old table is attached as one
+-- partition holding everything before next month; the monthly partitions
+-- start there. ATTACH checks the id range with one scan of the table, under
+-- the exclusive lock the rename above already took. A database without
+-- messages attaches the empty table for everything before this month
+-- instead, so monthly partitions start at the current month.
+DO $$
+DECLARE
+    cutover bigint;
+BEGIN
+    IF EXISTS (SELECT 1 FROM message_legacy) THEN
+        cutover := snowflake_at(date_trunc('month', now(), 'UTC') + interval '1 month');
+    ELSE
+        cutover := snowflake_at(date_trunc('month', now(), 'UTC'));
+    END IF;
+    EXECUTE format('ALTER TABLE message ATTACH PARTITION message_legacy FOR VALUES FROM (MINVALUE) TO (%s)', cutover);
+END
+$$;
+
+COMMENT ON TABLE message_legacy IS 'Messages stored before message was partitioned, up to the first monthly partition';
+
+SELECT create_message_partitions(3);
+
+CREATE MATERIALIZED VIEW mv_channel_stats AS
+ SELECT g.name AS guild,
+    c.name AS channel,
+    count(m.id) AS message_count
+   FROM ((channel c
+     LEFT JOIN message m ON ((c.id = m.channel_id)))
+     LEFT JOIN guild g ON ((g.id = c.guild_id)))
+  GROUP BY c.name, g.name
+  WITH NO DATA;
+
+CREATE MATERIALIZED VIEW mv_guild_stats AS
+ SELECT mv_channel_stats.guild,
+    sum(mv_channel_stats.message_count) AS message_count
+   FROM mv_channel_stats
+  GROUP BY mv_channel_stats.guild
+  WITH NO DATA;
+
+CREATE VIEW v_channel_stats AS
+ SELECT g.name AS guild,
+    c.name AS channel,
+    count(m.id) AS message_count
+   FROM ((channel c
+     LEFT JOIN message m ON ((c.id = m.channel_id)))
+     LEFT JOIN guild g ON ((g.id = c.guild_id)))
+  GROUP BY c.name, g.name;
+
+COMMENT ON VIEW v_channel_stats IS 'View rolling up some basic channel stats';
+
+CREATE VIEW v_messages AS
+ SELECT m.id,
+    g.name AS guild,
+    c.name AS channel,
+    (m.raw_data ->> 'content'::text) AS content
+   FROM ((message m
+     LEFT JOIN channel c ON ((m.channel_id = c.id)))
+     LEFT JOIN guild g ON ((c.guild_id = g.id)));
+
+-- migrate:down
+DROP MATERIALIZED VIEW mv_guild_stats;
+DROP MATERIALIZED VIEW mv_channel_stats;
+DROP VIEW v_channel_stats;
+DROP VIEW v_messages;
+
+CREATE TABLE message_unpartitioned (
+    id bigint NOT NULL,
+    raw_data json,
+    channel_id bigint
+);
+
+INSERT INTO message_unpartitioned SELECT id, raw_data, channel_id FROM message;
+
+DROP TABLE message;
+ALTER TABLE message_unpartitioned RENAME TO message;
+ALTER TABLE message ADD CONSTRAINT message_pkey PRIMARY KEY (id);
+CREATE INDEX message_channel_id_id_idx ON message USING btree (channel_id, id);
+
+DROP FUNCTION create_message_partitions(integer, timestamp with time zone);
+DROP FUNCTION snowflake_at(timestamp with time zone);
+
+CREATE MATERIALIZED VIEW mv_channel_stats AS
+ SELECT g.name AS guild,
+    c.name AS channel,
+    count(m.id) AS message_count
+   FROM ((channel c
+     LEFT JOIN message m ON ((c.id = m.channel_id)))
+     LEFT JOIN guild g ON ((g.id = c.guild_id)))
+  GROUP BY c.name, g.name
+  WITH NO DATA;
+
+CREATE MATERIALIZED VIEW mv_guild_stats AS
+ SELECT mv_channel_stats.guild,
+    sum(mv_channel_stats.message_count) AS message_count
+   FROM mv_channel_stats
+  GROUP BY mv_channel_stats.guild
+  WITH NO DATA;
+
+CREATE VIEW v_channel_stats AS
+ SELECT g.name AS guild,
+    c.name AS channel,
+    count(m.id) AS message_count
+   FROM ((channel c
+     LEFT JOIN message m ON ((c.id = m.channel_id)))
+     LEFT JOIN guild g ON ((g.id = c.guild_id)))
+  GROUP BY c.name, g.name;
+
+COMMENT ON VIEW v_channel_stats IS 'View rolling up some basic channel stats';
+
+CREATE VIEW v_messages AS
+ SELECT m.id,
+    g.name AS guild,
+    c.name AS channel,
+    (m.raw_data ->> 'content'::text) AS content
+   FROM ((message m
+     LEFT JOIN channel c ON ((m.channel_id = c.id)))
+     LEFT JOIN guild g ON ((c.guild_id = g.id)));
@@ -0,0 +1,63 @@
+-- migrate:up
+
+-- The fields every query wants, extracted once at ingest instead of
+-- re-parsing the json text on every read. Adding nullable columns without a
+-- default only touches the catalog, so this is instant on a big table.
+ALTER TABLE message
+    ADD COLUMN data jsonb,
+    ADD COLUMN author_id bigint,
+    ADD COLUMN sent_at timestamp with time zone,
+    ADD COLUMN edited_at timestamp with time zone,
+    ADD COLUMN type smallint,
+    ADD COLUMN content text,
+    ADD COLUMN reference_id bigint,
+    ADD COLUMN attachment_count smallint;
+
+COMMENT ON COLUMN message.raw_data IS 'Message as stored before data existed. backfill_message_columns.py moves it into data and the typed columns';
+COMMENT ON COLUMN message.data IS 'Message object as returned by Discord';
+COMMENT ON COLUMN message.sent_at IS 'Discord timestamp field';
+COMMENT ON COLUMN message.edited_at IS 'Discord edited_timestamp field';
+COMMENT ON COLUMN message.reference_id IS 'Id of the message replied to, forwarded or pinned';
+
+CREATE INDEX message_author_id_id_idx ON message (author_id, id);
+CREATE INDEX message_reference_id_idx ON message (reference_id) WHERE reference_id IS NOT NULL;
+
+DROP VIEW v_messages;
+
+CREATE VIEW v_messages AS
+ SELECT m.id,
+    g.name AS guild,
+    c.name AS channel,
+    COALESCE(m.content, (m.raw_data ->> 'content'::text)) AS content
+   FROM ((message m
+     LEFT JOIN channel c ON ((m.channel_id = c.id)))
+     LEFT JOIN guild g ON ((c.guild_id = g.id)));
+
+-- migrate:down
+DROP VIEW v_messages;
+
+UPDATE message SET raw_data = data::json WHERE raw_data IS NULL AND data IS NOT NULL;
+
+DROP INDEX message_author_id_id_idx;
+DROP INDEX message_reference_id_idx;
+
+ALTER TABLE message
+    DROP COLUMN data,
+    DROP COLUMN author_id,
+    DROP COLUMN sent_at,
+    DROP COLUMN edited_at,
+    DROP COLUMN type,
+    DROP COLUMN content,
+    DROP COLUMN reference_id,
+    DROP COLUMN attachment_count;
+
+COMMENT ON COLUMN message.raw_data IS NULL;
+
+CREATE VIEW v_messages AS
+ SELECT m.id,
+    g.name AS guild,
+    c.name AS channel,
+    (m.raw_data ->> 'content'::text) AS content
+   FROM ((message m
+     LEFT JOIN channel c ON ((m.channel_id = c.id)))
+     LEFT JOIN guild g ON ((c.guild_id = g.id)));
@@ -0,0 +1,115 @@
+-- migrate:up
+CREATE FUNCTION snowflake_time(id bigint) RETURNS timestamp with time zone
+    LANGUAGE sql IMMUTABLE
+    AS $$
+    SELECT to_timestamp(((id >> 22) + 1420070400000) / 1000.0)
+$$;
+
+COMMENT ON FUNCTION snowflake_time(bigint) IS 'Creation time of a snowflake';
+
+-- Counters kept by the ingest path (bulk_upsert_messages) in the statement
+-- that inserts the messages, from the rows actually inserted. No foreign
+-- key to channel, like message itself.
+CREATE TABLE channel_stats (
+    channel_id bigint NOT NULL PRIMARY KEY,
+    message_count bigint DEFAULT 0 NOT NULL,
+    first_message_id bigint,
+    last_message_id bigint,
+    updated_at timestamp without time zone DEFAULT now() NOT NULL
+);
+
+COMMENT ON TABLE channel_stats IS 'Messages stored per channel. Maintained on insert, see bulk_upsert_messages()';
+
+CREATE TABLE channel_stats_daily (
+    channel_id bigint NOT NULL,
+    day date NOT NULL,
+    message_count bigint DEFAULT 0 NOT NULL,
+    PRIMARY KEY (channel_id, day)
+);
+
+COMMENT ON TABLE channel_stats_daily IS 'Messages stored per channel and UTC day they were sent. Maintained on insert, see bulk_upsert_messages()';
+
+-- The one full count. Deploy the code that maintains the counters together
+-- with this migration.
+INSERT INTO channel_stats (channel_id, message_count, first_message_id, last_message_id)
+SELECT channel_id, count(*), min(id), max(id)
+FROM message
+WHERE channel_id IS NOT NULL
+GROUP BY channel_id;
+
+INSERT INTO channel_stats_daily (channel_id, day, message_count)
+SELECT channel_id, (snowflake_time(id) AT TIME ZONE 'UTC')::date, count(*)
+FROM message
+WHERE channel_id IS NOT NULL
+GROUP BY 1, 2;
+
+DROP MATERIALIZED VIEW mv_guild_stats;
+DROP MATERIALIZED VIEW mv_channel_stats;
+DROP VIEW v_channel_stats;
+
+CREATE VIEW v_channel_stats AS
+ SELECT g.name AS guild,
+    c.name AS channel,
+    COALESCE(s.message_count, (0)::bigint) AS message_count
+   FROM ((channel c
+     LEFT JOIN channel_stats s ON ((s.channel_id = c.id)))
+     LEFT JOIN guild g ON ((g.id = c.guild_id)));
+
+COMMENT ON VIEW v_channel_stats IS 'View rolling up some basic channel stats';
+
+CREATE VIEW v_guild_stats AS
+ SELECT g.name AS guild,
+    COALESCE(sum(s.message_count), (0)::numeric) AS message_count
+   FROM ((guild g
+     LEFT JOIN channel c ON ((c.guild_id = g.id)))
+     LEFT JOIN channel_stats s ON ((s.channel_id = c.id)))
+  GROUP BY g.id, g.name;
+
+COMMENT ON VIEW v_guild_stats IS 'Messages stored per guild, from channel_stats';
+
+CREATE VIEW v_guild_stats_daily AS
+ SELECT g.name AS guild,
+    d.day,
+    sum(d.message_count) AS message_count
+   FROM ((channel_stats_daily d
+     JOIN channel c ON ((c.id = d.channel_id)))
+     JOIN guild g ON ((g.id = c.guild_id)))
+  GROUP BY g.id, g.name, d.day;
+
+COMMENT ON VIEW v_guild_stats_daily IS 'Messages stored per guild and UTC day, from channel_stats_daily';
+
+-- migrate:down
+DROP VIEW v_guild_stats_daily;
+DROP VIEW v_guild_stats;
+DROP VIEW v_channel_stats;
+DROP TABLE channel_stats_daily;
+DROP TABLE channel_stats;
+DROP FUNCTION snowflake_time(bigint);
+
+CREATE MATERIALIZED VIEW mv_channel_stats AS
+ SELECT g.name AS guild,
+    c.name AS channel,
+    count(m.id) AS message_count
+   FROM ((channel c
+     LEFT JOIN message m ON ((c.id = m.channel_id)))
+     LEFT JOIN guild g ON ((g.id = c.guild_id)))
+  GROUP BY c.name, g.name
+  WITH NO DATA;
+
+CREATE MATERIALIZED VIEW mv_guild_stats AS
+ SELECT mv_channel_stats.guild,
+    sum(mv_channel_stats.message_count) AS message_count
+   FROM mv_channel_stats
+  GROUP BY mv_channel_stats.guild
+  WITH NO DATA;
+
+CREATE VIEW v_channel_stats AS
+ SELECT g.name AS guild,
+    c.name AS channel,
+    count(m.id) AS message_count
+   FROM ((channel c
+     LEFT JOIN message m ON ((c.id = m.channel_id)))
+     LEFT JOIN guild g ON ((g.id = c.guild_id)))
+  GROUP BY c.name, g.name;
+
+COMMENT ON VIEW v_channel_stats IS 'View rolling up some basic channel stats';
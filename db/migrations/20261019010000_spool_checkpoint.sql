@@ -0,0 +1,12 @@
+-- migrate:up
+CREATE TABLE spool_checkpoint (
+    spool_id text NOT NULL PRIMARY KEY,
+    segment bigint NOT NULL,
+    "offset" bigint NOT NULL,
+    updated_at timestamp without time zone DEFAULT now() NOT NULL
+);
+
+COMMENT ON TABLE spool_checkpoint IS 'Position up to which spool_drain.py stored each local spool. Written in the transaction that stores the pages';
+
+-- migrate:down
+DROP TABLE spool_checkpoint;
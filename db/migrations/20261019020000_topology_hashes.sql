@@ -0,0 +1,13 @@
+-- migrate:up
+ALTER TABLE guild ADD COLUMN payload_hash bytea;
+ALTER TABLE channel ADD COLUMN payload_hash bytea;
+ALTER TABLE channel ADD COLUMN deleted_at timestamp without time zone;
+
+COMMENT ON COLUMN guild.payload_hash IS 'Hash of raw_data without the per-selfbot fields. refresh_guilds only rewrites the row when it changes';
+COMMENT ON COLUMN channel.payload_hash IS 'Hash of raw_data without last_message_id. refresh_channels only rewrites the row when it changes';
+COMMENT ON COLUMN channel.deleted_at IS 'When refresh_channels stopped seeing the channel in its guild. Crawling is disabled until it reappears';
+
+-- migrate:down
+ALTER TABLE channel DROP COLUMN deleted_at;
+ALTER TABLE channel DROP COLUMN payload_hash;
+ALTER TABLE guild DROP COLUMN payload_hash;
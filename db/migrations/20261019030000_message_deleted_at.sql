@@ -0,0 +1,7 @@
+-- migrate:up
+ALTER TABLE message ADD COLUMN deleted_at timestamp with time zone;
+
+COMMENT ON COLUMN message.deleted_at IS 'When gateway_ingest received the MESSAGE_DELETE. The row and its data are kept';
+
+-- migrate:down
+ALTER TABLE message DROP COLUMN deleted_at;
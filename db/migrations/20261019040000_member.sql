@@ -0,0 +1,28 @@
+-- migrate:up
+CREATE TABLE member (
+    guild_id bigint NOT NULL REFERENCES guild (id) ON DELETE CASCADE,
+    user_id bigint NOT NULL,
+    username character varying,
+    nick character varying,
+    joined_at timestamp with time zone,
+    data jsonb NOT NULL,
+    payload_hash bytea NOT NULL,
+    first_seen_at timestamp without time zone DEFAULT now() NOT NULL,
+    last_update timestamp without time zone DEFAULT now() NOT NULL,
+    left_at timestamp without time zone,
+    PRIMARY KEY (guild_id, user_id)
+);
+
+CREATE INDEX member_user_id_idx ON member (user_id);
+
+ALTER TABLE guild ADD COLUMN members_refreshed_at timestamp without time zone;
+
+COMMENT ON TABLE member IS 'Guild members as listed by refresh_users. A row is only rewritten when its payload_hash changes';
+COMMENT ON COLUMN member.data IS 'Guild member object, including the user';
+COMMENT ON COLUMN member.last_update IS 'Last time the member object changed';
+COMMENT ON COLUMN member.left_at IS 'When refresh_users stopped seeing the member in the guild. Cleared if they come back';
+COMMENT ON COLUMN guild.members_refreshed_at IS 'Last complete member list stored by refresh_users';
+
+-- migrate:down
+ALTER TABLE guild DROP COLUMN members_refreshed_at;
+DROP TABLE member;
@@ -0,0 +1,30 @@
+-- migrate:up
+CREATE TABLE attachment (
+    id bigint PRIMARY KEY,
+    message_id bigint NOT NULL,
+    channel_id bigint NOT NULL,
+    filename character varying NOT NULL,
+    url character varying NOT NULL,
+    size bigint,
+    content_type character varying,
+    sha256 bytea,
+    queued_at timestamp without time zone DEFAULT now() NOT NULL,
+    next_attempt_at timestamp without time zone DEFAULT now(),
+    attempts smallint DEFAULT 0 NOT NULL,
+    downloaded_at timestamp without time zone,
+    error character varying
+);
+
+CREATE INDEX attachment_message_id_idx ON attachment (message_id);
+CREATE INDEX attachment_sha256_idx ON attachment (sha256) WHERE sha256 IS NOT NULL;
+CREATE INDEX attachment_due_idx ON attachment (next_attempt_at) WHERE next_attempt_at IS NOT NULL;
+
+COMMENT ON TABLE attachment IS 'Attachments of stored messages, queued when the message is inserted and downloaded by download_attachments';
+COMMENT ON COLUMN attachment.id IS 'Attachment id (snowflake)';
+COMMENT ON COLUMN attachment.url IS 'CDN url as the message listed it. Signed urls expire, so download soon';
+COMMENT ON COLUMN attachment.sha256 IS 'Content hash, the file name in ATTACHMENT_DIR. Null until downloaded';
+COMMENT ON COLUMN attachment.next_attempt_at IS 'When to (re)try the download. Null once downloaded or given up';
+COMMENT ON COLUMN attachment.error IS 'Why the last attempt failed';
+
+-- migrate:down
+DROP TABLE attachment;
@@ -0,0 +1,45 @@
+-- migrate:up
+-- Deleting a channel no longer clears crawl_enabled, which only says whether
+-- the channel should be crawled. Deleted channels are skipped by deleted_at.
+CREATE OR REPLACE VIEW v_crawl_schedule AS
+SELECT
+    g.name AS guild,
+    c.name AS channel,
+    c.id AS channel_id,
+    g.crawl_priority,
+    round(c.message_rate::numeric, 2) AS messages_per_hour,
+    c.last_crawl_messages,
+    c.last_update AS last_crawl_at,
+    c.next_crawl_at,
+    c.next_crawl_at - c.last_update AS crawl_interval,
+    greatest(now()::timestamp - c.next_crawl_at, interval '0') AS overdue,
+    cc.channel_id IS NULL OR cc.high_message_id < coalesce(c.last_message_id, 0) AS has_new_messages
+FROM channel c
+JOIN guild g ON g.id = c.guild_id
+LEFT JOIN channel_cursor cc ON cc.channel_id = c.id
+WHERE c.crawl_enabled AND g.crawl_enabled AND c.deleted_at IS NULL
+ORDER BY c.next_crawl_at;
+
+COMMENT ON COLUMN channel.deleted_at IS 'When refresh_channels stopped seeing the channel in its guild. Not crawled until it reappears; crawl_enabled is left alone';
+
+-- migrate:down
+CREATE OR REPLACE VIEW v_crawl_schedule AS
+SELECT
+    g.name AS guild,
+    c.name AS channel,
+    c.id AS channel_id,
+    g.crawl_priority,
+    round(c.message_rate::numeric, 2) AS messages_per_hour,
+    c.last_crawl_messages,
+    c.last_update AS last_crawl_at,
+    c.next_crawl_at,
+    c.next_crawl_at - c.last_update AS crawl_interval,
+    greatest(now()::timestamp - c.next_crawl_at, interval '0') AS overdue,
+    cc.channel_id IS NULL OR cc.high_message_id < coalesce(c.last_message_id, 0) AS has_new_messages
+FROM channel c
+JOIN guild g ON g.id = c.guild_id
+LEFT JOIN channel_cursor cc ON cc.channel_id = c.id
+WHERE c.crawl_enabled AND g.crawl_enabled
+ORDER BY c.next_crawl_at;
+
+COMMENT ON COLUMN channel.deleted_at IS 'When refresh_channels stopped seeing the channel in its guild. Crawling is disabled until it reappears';
@@ -0,0 +1,175 @@
+-- migrate:up
+CREATE OR REPLACE FUNCTION create_message_partitions(
+    months_ahead integer DEFAULT 3,
+    since timestamp with time zone DEFAULT now()
+) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    month timestamp with time zone := date_trunc('month', since, 'UTC');
+    last_month timestamp with time zone := date_trunc('month', now(), 'UTC') + make_interval(months => months_ahead);
+    oldest bigint;
+    lo bigint;
+    hi bigint;
+    name text;
+    created integer := 0;
+BEGIN
+    -- One caller at a time, every crawler node runs this.
+    PERFORM pg_advisory_xact_lock(hashtext('create_message_partitions'));
+
+    -- Once message_legacy is split (split_message_legacy()) nothing covers
+    -- the ids below the oldest month, and older messages stored later land in
+    -- the default partition. Their months are created as well.
+    SELECT min(id) INTO oldest FROM message_default;
+    IF oldest IS NOT NULL THEN
+        month := least(month, date_trunc('month', snowflake_time(oldest), 'UTC'));
+    END IF;
+
+    WHILE month <= last_month LOOP
+        lo := snowflake_at(month);
+        hi := snowflake_at(month + interval '1 month');
+
+        IF hi > lo AND NOT EXISTS (
+            SELECT 1
+            FROM (
+                SELECT
+                    (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'FROM \(''(-?\d+)''\)'))[1]::bigint AS b_lo,
+                    (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''(-?\d+)''\)'))[1]::bigint AS b_hi
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'message'::regclass AND pg_get_expr(c.relpartbound, c.oid) <> 'DEFAULT'
+            ) bound
+            -- A missing FROM is MINVALUE (message_legacy).
+            WHERE (bound.b_lo IS NULL OR bound.b_lo < hi) AND bound.b_hi > lo
+        ) THEN
+            name := 'message_' || to_char(month AT TIME ZONE 'UTC', '"y"YYYY"m"MM');
+
+            -- Rows that already landed in the default partition move into the
+            -- new one, otherwise it could not be attached.
+            EXECUTE format('CREATE TABLE %I (LIKE message INCLUDING DEFAULTS)', name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM message_default WHERE id >= %s AND id < %s RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved', lo, hi, name);
+            EXECUTE format('ALTER TABLE message ATTACH PARTITION %I FOR VALUES FROM (%s) TO (%s)', name, lo, hi);
+
+            created := created + 1;
+        END IF;
+
+        month := month + interval '1 month';
+    END LOOP;
+
+    RETURN created;
+END
+$$;
+
+COMMENT ON FUNCTION create_message_partitions(integer, timestamp with time zone) IS 'Create the monthly message partitions that do not exist yet, from `since` (or the month of the oldest message in message_default) up to `months_ahead` months from now';
+
+CREATE FUNCTION split_message_legacy(batch integer DEFAULT 10000) RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    newest bigint;
+    lo bigint;
+    columns text;
+    moved bigint;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('create_message_partitions'));
+
+    IF to_regclass('message_legacy') IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = 'message_legacy'::regclass) THEN
+        ALTER TABLE message DETACH PARTITION message_legacy;
+        RETURN 0;
+    END IF;
+
+    SELECT max(id) INTO newest FROM message_legacy;
+    IF newest IS NULL THEN
+        DROP TABLE message_legacy;
+        RETURN NULL;
+    END IF;
+
+    -- Newest month first. Its partition, and any missing one above it, is
+    -- created before the rows are moved in.
+    lo := snowflake_at(date_trunc('month', snowflake_time(newest), 'UTC'));
+    PERFORM create_message_partitions(0, snowflake_time(newest));
+
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+    FROM pg_attribute
+    WHERE attrelid = 'message'::regclass AND attnum > 0 AND NOT attisdropped;
+
+    -- A message stored again while the split runs is kept as stored then.
+    EXECUTE format(
+        'WITH moved AS ('
+        '    DELETE FROM message_legacy WHERE id IN ('
+        '        SELECT id FROM message_legacy WHERE id >= %s ORDER BY id DESC LIMIT %s'
+        '    ) RETURNING %s'
+        '), inserted AS ('
+        '    INSERT INTO message (%s) SELECT * FROM moved ON CONFLICT DO NOTHING'
+        ') SELECT count(*) FROM moved',
+        lo, batch, columns, columns) INTO moved;
+
+    RETURN moved;
+END
+$$;
+
+COMMENT ON FUNCTION split_message_legacy(integer) IS 'One step of moving message_legacy into monthly partitions: detach it (0), move up to `batch` of its newest rows (rows moved), or drop it once empty. NULL when done';
+
+-- migrate:down
+DROP FUNCTION split_message_legacy(integer);
+
+CREATE OR REPLACE FUNCTION create_message_partitions(
+    months_ahead integer DEFAULT 3,
+    since timestamp with time zone DEFAULT now()
+) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    month timestamp with time zone := date_trunc('month', since, 'UTC');
+    last_month timestamp with time zone := date_trunc('month', now(), 'UTC') + make_interval(months => months_ahead);
+    covered_to bigint;
+    lo bigint;
+    hi bigint;
+    name text;
+    created integer := 0;
+BEGIN
+    -- One caller at a time, every crawler node runs this.
+    PERFORM pg_advisory_xact_lock(hashtext('create_message_partitions'));
+
+    -- Upper bound of the newest partition. Monthly partitions are contiguous,
+    -- so everything below it is covered.
+    SELECT max((regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''(-?\d+)''\)'))[1]::bigint)
+    INTO covered_to
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'message'::regclass;
+
+    WHILE month <= last_month LOOP
+        lo := snowflake_at(month);
+        hi := snowflake_at(month + interval '1 month');
+
+        IF covered_to IS NULL OR hi > covered_to THEN
+            lo := greatest(lo, coalesce(covered_to, lo));
+            name := 'message_' || to_char(month AT TIME ZONE 'UTC', '"y"YYYY"m"MM');
+
+            -- Rows that already landed in the default partition move into the
+            -- new one, otherwise it could not be attached.
+            EXECUTE format('CREATE TABLE %I (LIKE message INCLUDING DEFAULTS)', name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM message_default WHERE id >= %s AND id < %s RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved', lo, hi, name);
+            EXECUTE format('ALTER TABLE message ATTACH PARTITION %I FOR VALUES FROM (%s) TO (%s)', name, lo, hi);
+
+            covered_to := hi;
+            created := created + 1;
+        END IF;
+
+        month := month + interval '1 month';
+    END LOOP;
+
+    RETURN created;
+END
+$$;
+
+COMMENT ON FUNCTION create_message_partitions(integer, timestamp with time zone) IS 'Create the monthly message partitions from `since` up to `months_ahead` months from now that do not exist yet';
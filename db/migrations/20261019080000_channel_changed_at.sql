@@ -0,0 +1,9 @@
+-- migrate:up
+-- Existing channels keep NULL: when they last changed is not known.
+ALTER TABLE channel ADD COLUMN changed_at timestamp without time zone;
+ALTER TABLE channel ALTER COLUMN changed_at SET DEFAULT now();
+
+COMMENT ON COLUMN channel.changed_at IS 'When refresh_channels last saw the channel object change (payload_hash). last_update is the last crawl';
+
+-- migrate:down
+ALTER TABLE channel DROP COLUMN changed_at;
@@ -16,10 +16,243 @@ SET row_security = off;
 -- *not* creating schema, since initdb creates it
 
 
+--
+-- Name: create_message_partitions(integer, timestamp with time zone); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION public.create_message_partitions(months_ahead integer DEFAULT 3, since timestamp with time zone DEFAULT now()) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    month timestamp with time zone := date_trunc('month', since, 'UTC');
+    last_month timestamp with time zone := date_trunc('month', now(), 'UTC') + make_interval(months => months_ahead);
+    oldest bigint;
+    lo bigint;
+    hi bigint;
+    name text;
+    created integer := 0;
+BEGIN
+    -- One caller at a time, every crawler node runs this.
+    PERFORM pg_advisory_xact_lock(hashtext('create_message_partitions'));
+
+    -- Once message_legacy is split (split_message_legacy()) nothing covers
+    -- the ids below the oldest month, and older messages stored later land in
+    -- the default partition. Their months are created as well.
+    SELECT min(id) INTO oldest FROM message_default;
+    IF oldest IS NOT NULL THEN
+        month := least(month, date_trunc('month', snowflake_time(oldest), 'UTC'));
+    END IF;
+
+    WHILE month <= last_month LOOP
+        lo := snowflake_at(month);
+        hi := snowflake_at(month + interval '1 month');
+
+        IF hi > lo AND NOT EXISTS (
+            SELECT 1
+            FROM (
+                SELECT
+                    (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'FROM \(''(-?\d+)''\)'))[1]::bigint AS b_lo,
+                    (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''(-?\d+)''\)'))[1]::bigint AS b_hi
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'message'::regclass AND pg_get_expr(c.relpartbound, c.oid) <> 'DEFAULT'
+            ) bound
+            -- A missing FROM is MINVALUE (message_legacy).
+            WHERE (bound.b_lo IS NULL OR bound.b_lo < hi) AND bound.b_hi > lo
+        ) THEN
+            name := 'message_' || to_char(month AT TIME ZONE 'UTC', '"y"YYYY"m"MM');
+
+            -- Rows that already landed in the default partition move into the
+            -- new one, otherwise it could not be attached.
+            EXECUTE format('CREATE TABLE %I (LIKE message INCLUDING DEFAULTS)', name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM message_default WHERE id >= %s AND id < %s RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved', lo, hi, name);
+            EXECUTE format('ALTER TABLE message ATTACH PARTITION %I FOR VALUES FROM (%s) TO (%s)', name, lo, hi);
+
+            created := created + 1;
+        END IF;
+
+        month := month + interval '1 month';
+    END LOOP;
+
+    RETURN created;
+END
+$$;
+
+
+--
+-- Name: FUNCTION create_message_partitions(months_ahead integer, since timestamp with time zone); Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON FUNCTION public.create_message_partitions(months_ahead integer, since timestamp with time zone) IS 'Create the monthly message partitions that do not exist yet, from `since` (or the month of the oldest message in message_default) up to `months_ahead` months from now';
+
+
+--
+-- Name: snowflake_at(timestamp with time zone); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION public.snowflake_at(ts timestamp with time zone) RETURNS bigint
+    LANGUAGE sql IMMUTABLE
+    AS $$
+    SELECT greatest((extract(epoch FROM ts) * 1000)::bigint - 1420070400000, 0) << 22
+$$;
+
+
+--
+-- Name: FUNCTION snowflake_at(ts timestamp with time zone); Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON FUNCTION public.snowflake_at(ts timestamp with time zone) IS 'Lowest snowflake created at or after a time';
+
+
+--
+-- Name: snowflake_time(bigint); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION public.snowflake_time(id bigint) RETURNS timestamp with time zone
+    LANGUAGE sql IMMUTABLE
+    AS $$
+    SELECT to_timestamp(((id >> 22) + 1420070400000) / 1000.0)
+$$;
+
+
+--
+-- Name: FUNCTION snowflake_time(id bigint); Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON FUNCTION public.snowflake_time(id bigint) IS 'Creation time of a snowflake';
+
+
+--
+-- Name: split_message_legacy(integer); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION public.split_message_legacy(batch integer DEFAULT 10000) RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    newest bigint;
+    lo bigint;
+    columns text;
+    moved bigint;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('create_message_partitions'));
+
+    IF to_regclass('message_legacy') IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = 'message_legacy'::regclass) THEN
+        ALTER TABLE message DETACH PARTITION message_legacy;
+        RETURN 0;
+    END IF;
+
+    SELECT max(id) INTO newest FROM message_legacy;
+    IF newest IS NULL THEN
+        DROP TABLE message_legacy;
+        RETURN NULL;
+    END IF;
+
+    -- Newest month first. Its partition, and any missing one above it, is
+    -- created before the rows are moved in.
+    lo := snowflake_at(date_trunc('month', snowflake_time(newest), 'UTC'));
+    PERFORM create_message_partitions(0, snowflake_time(newest));
+
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+    FROM pg_attribute
+    WHERE attrelid = 'message'::regclass AND attnum > 0 AND NOT attisdropped;
+
+    -- A message stored again while the split runs is kept as stored then.
+    EXECUTE format(
+        'WITH moved AS ('
+        '    DELETE FROM message_legacy WHERE id IN ('
+        '        SELECT id FROM message_legacy WHERE id >= %s ORDER BY id DESC LIMIT %s'
+        '    ) RETURNING %s'
+        '), inserted AS ('
+        '    INSERT INTO message (%s) SELECT * FROM moved ON CONFLICT DO NOTHING'
+        ') SELECT count(*) FROM moved',
+        lo, batch, columns, columns) INTO moved;
+
+    RETURN moved;
+END
+$$;
+
+
+--
+-- Name: FUNCTION split_message_legacy(batch integer); Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON FUNCTION public.split_message_legacy(batch integer) IS 'One step of moving message_legacy into monthly partitions: detach it (0), move up to `batch` of its newest rows (rows moved), or drop it once empty. NULL when done';
+
+
 SET default_tablespace = '';
 
 SET default_table_access_method = heap;
 
+--
+-- Name: attachment; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.attachment (
+    id bigint NOT NULL,
+    message_id bigint NOT NULL,
+    channel_id bigint NOT NULL,
+    filename character varying NOT NULL,
+    url character varying NOT NULL,
+    size bigint,
+    content_type character varying,
+    sha256 bytea,
+    queued_at timestamp without time zone DEFAULT now() NOT NULL,
+    next_attempt_at timestamp without time zone DEFAULT now(),
+    attempts smallint DEFAULT 0 NOT NULL,
+    downloaded_at timestamp without time zone,
+    error character varying
+);
+
+
+--
+-- Name: TABLE attachment; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.attachment IS 'Attachments of stored messages, queued when the message is inserted and downloaded by download_attachments';
+
+
+--
+-- Name: COLUMN attachment.id; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.attachment.id IS 'Attachment id (snowflake)';
+
+
+--
+-- Name: COLUMN attachment.url; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.attachment.url IS 'CDN url as the message listed it. Signed urls expire, so download soon';
+
+
+--
+-- Name: COLUMN attachment.sha256; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.attachment.sha256 IS 'Content hash, the file name in ATTACHMENT_DIR. Null until downloaded';
+
+
+--
+-- Name: COLUMN attachment.next_attempt_at; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.attachment.next_attempt_at IS 'When to (re)try the download. Null once downloaded or given up';
+
+
+--
+-- Name: COLUMN attachment.error; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.attachment.error IS 'Why the last attempt failed';
+
+
 --
 -- Name: channel; Type: TABLE; Schema: public; Owner: -
 --
@@ -31,7 +264,15 @@ CREATE TABLE public.channel (
     guild_id bigint NOT NULL,
     crawl_enabled boolean DEFAULT true,
     created_at timestamp without time zone DEFAULT now(),
-    last_update timestamp without time zone DEFAULT now()
+    last_update timestamp without time zone DEFAULT now(),
+    history_crawled boolean DEFAULT false NOT NULL,
+    last_message_id bigint,
+    message_rate double precision DEFAULT 0 NOT NULL,
+    last_crawl_messages integer,
+    next_crawl_at timestamp without time zone DEFAULT now() NOT NULL,
+    payload_hash bytea,
+    deleted_at timestamp without time zone,
+    changed_at timestamp without time zone DEFAULT now()
 );
 
 
@@ -42,6 +283,62 @@ CREATE TABLE public.channel (
 COMMENT ON COLUMN public.channel.crawl_enabled IS 'Is crawling enabled for this channel';
 
 
+--
+-- Name: COLUMN channel.history_crawled; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.channel.history_crawled IS 'Has backfill_history reached the first message of the channel';
+
+
+--
+-- Name: COLUMN channel.last_message_id; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.channel.last_message_id IS 'Newest message id reported by Discord at the last channel refresh';
+
+
+--
+-- Name: COLUMN channel.message_rate; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.channel.message_rate IS 'Smoothed messages per hour, estimated from crawl results';
+
+
+--
+-- Name: COLUMN channel.last_crawl_messages; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.channel.last_crawl_messages IS 'Messages fetched by the last crawl';
+
+
+--
+-- Name: COLUMN channel.next_crawl_at; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.channel.next_crawl_at IS 'message_history will not crawl the channel before this time';
+
+
+--
+-- Name: COLUMN channel.payload_hash; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.channel.payload_hash IS 'Hash of raw_data without last_message_id. refresh_channels only rewrites the row when it changes';
+
+
+--
+-- Name: COLUMN channel.deleted_at; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.channel.deleted_at IS 'When refresh_channels stopped seeing the channel in its guild. Not crawled until it reappears; crawl_enabled is left alone';
+
+
+--
+-- Name: COLUMN channel.changed_at; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.channel.changed_at IS 'When refresh_channels last saw the channel object change (payload_hash). last_update is the last crawl';
+
+
 --
 -- Name: channel_crawl_log; Type: TABLE; Schema: public; Owner: -
 --
@@ -85,115 +382,91 @@ ALTER TABLE public.channel_crawl_log ALTER COLUMN id ADD GENERATED ALWAYS AS IDE
 
 
 --
--- Name: config; Type: TABLE; Schema: public; Owner: -
+-- Name: channel_cursor; Type: TABLE; Schema: public; Owner: -
 --
 
-CREATE TABLE public.config (
-    id integer NOT NULL
+CREATE TABLE public.channel_cursor (
+    channel_id bigint NOT NULL,
+    high_message_id bigint DEFAULT 0 NOT NULL,
+    low_message_id bigint,
+    updated_at timestamp without time zone DEFAULT now() NOT NULL
 );
 
 
 --
--- Name: config_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+-- Name: TABLE channel_cursor; Type: COMMENT; Schema: public; Owner: -
 --
 
-ALTER TABLE public.config ALTER COLUMN id ADD GENERATED ALWAYS AS IDENTITY (
-    SEQUENCE NAME public.config_id_seq
-    START WITH 1
-    INCREMENT BY 1
-    NO MINVALUE
-    NO MAXVALUE
-    CACHE 1
-);
+COMMENT ON TABLE public.channel_cursor IS 'Crawl position of each channel. Updated in the same transaction as the messages it covers.';
 
 
 --
--- Name: guild; Type: TABLE; Schema: public; Owner: -
+-- Name: COLUMN channel_cursor.high_message_id; Type: COMMENT; Schema: public; Owner: -
 --
 
-CREATE TABLE public.guild (
-    id bigint NOT NULL,
-    name character varying,
-    raw_data json,
-    selfbot_id integer,
-    invite_link text,
-    crawl_priority integer DEFAULT 0,
-    crawl_enabled boolean DEFAULT true NOT NULL
-);
+COMMENT ON COLUMN public.channel_cursor.high_message_id IS 'Newest message id stored. message_history continues after it.';
 
 
 --
--- Name: COLUMN guild.crawl_priority; Type: COMMENT; Schema: public; Owner: -
+-- Name: COLUMN channel_cursor.low_message_id; Type: COMMENT; Schema: public; Owner: -
 --
 
-COMMENT ON COLUMN public.guild.crawl_priority IS 'Give preference or penalty to specific guilds. Higher numbers go sooner than lower.';
+COMMENT ON COLUMN public.channel_cursor.low_message_id IS 'Oldest message id stored. backfill_history continues before it.';
 
 
 --
--- Name: message; Type: TABLE; Schema: public; Owner: -
+-- Name: channel_stats; Type: TABLE; Schema: public; Owner: -
 --
 
-CREATE TABLE public.message (
-    id bigint NOT NULL,
-    raw_data json,
-    channel_id bigint
+CREATE TABLE public.channel_stats (
+    channel_id bigint NOT NULL,
+    message_count bigint DEFAULT 0 NOT NULL,
+    first_message_id bigint,
+    last_message_id bigint,
+    updated_at timestamp without time zone DEFAULT now() NOT NULL
 );
 
 
 --
--- Name: mv_channel_stats; Type: MATERIALIZED VIEW; Schema: public; Owner: -
+-- Name: TABLE channel_stats; Type: COMMENT; Schema: public; Owner: -
 --
 
-CREATE MATERIALIZED VIEW public.mv_channel_stats AS
- SELECT g.name AS guild,
-    c.name AS channel,
-    count(m.id) AS message_count
-   FROM ((public.channel c
-     LEFT JOIN public.message m ON ((c.id = m.channel_id)))
-     LEFT JOIN public.guild g ON ((g.id = c.guild_id)))
-  GROUP BY c.name, g.name
-  WITH NO DATA;
+COMMENT ON TABLE public.channel_stats IS 'Messages stored per channel. Maintained on insert, see bulk_upsert_messages()';
 
 
 --
--- Name: mv_guild_stats; Type: MATERIALIZED VIEW; Schema: public; Owner: -
+-- Name: channel_stats_daily; Type: TABLE; Schema: public; Owner: -
 --
 
-CREATE MATERIALIZED VIEW public.mv_guild_stats AS
- SELECT mv_channel_stats.guild,
-    sum(mv_channel_stats.message_count) AS message_count
-   FROM public.mv_channel_stats
-  GROUP BY mv_channel_stats.guild
-  WITH NO DATA;
+CREATE TABLE public.channel_stats_daily (
+    channel_id bigint NOT NULL,
+    day date NOT NULL,
+    message_count bigint DEFAULT 0 NOT NULL
+);
 
 
 --
--- Name: schema_migrations; Type: TABLE; Schema: public; Owner: -
+-- Name: TABLE channel_stats_daily; Type: COMMENT; Schema: public; Owner: -
 --
 
-CREATE TABLE public.schema_migrations (
-    version character varying(255) NOT NULL
-);
+COMMENT ON TABLE public.channel_stats_daily IS 'Messages stored per channel and UTC day they were sent. Maintained on insert, see bulk_upsert_messages()';
 
 
 --
--- Name: selfbot; Type: TABLE; Schema: public; Owner: -
+-- Name: config; Type: TABLE; Schema: public; Owner: -
 --
 
-CREATE TABLE public.selfbot (
-    id integer NOT NULL,
-    username character varying NOT NULL,
-    email character varying NOT NULL,
-    token text
+CREATE TABLE public.config (
+    id integer NOT NULL
 );
 
 
 --
--- Name: selfbot_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+-- Name: config_id_seq; Type: SEQUENCE; Schema: public; Owner: -
 --
 
-ALTER TABLE public.selfbot ALTER COLUMN id ADD GENERATED ALWAYS AS IDENTITY (
-    SEQUENCE NAME public.selfbot_id_seq
+ALTER TABLE public.config ALTER COLUMN id ADD GENERATED ALWAYS AS IDENTITY (
+    SEQUENCE NAME public.config_id_seq
     START WITH 1
     INCREMENT BY 1
     NO MINVALUE
@@ -203,125 +476,1165 @@ ALTER TABLE public.selfbot ALTER COLUMN id ADD GENERATED ALWAYS AS IDENTITY (
 
 
 --
--- Name: v_channel_stats; Type: VIEW; Schema: public; Owner: -
+-- Name: crawl_lease; Type: TABLE; Schema: public; Owner: -
 --
 
-CREATE VIEW public.v_channel_stats AS
- SELECT g.name AS guild,
-    c.name AS channel,
-    count(m.id) AS message_count
-   FROM ((public.channel c
-     LEFT JOIN public.message m ON ((c.id = m.channel_id)))
-     LEFT JOIN public.guild g ON ((g.id = c.guild_id)))
-  GROUP BY c.name, g.name;
+CREATE TABLE public.crawl_lease (
+    channel_id bigint NOT NULL,
+    lane text NOT NULL,
+    owner text NOT NULL,
+    acquired_at timestamp without time zone DEFAULT now() NOT NULL,
+    heartbeat_at timestamp without time zone DEFAULT now() NOT NULL,
+    expires_at timestamp without time zone NOT NULL
+);
 
 
 --
--- Name: VIEW v_channel_stats; Type: COMMENT; Schema: public; Owner: -
+-- Name: TABLE crawl_lease; Type: COMMENT; Schema: public; Owner: -
 --
 
-COMMENT ON VIEW public.v_channel_stats IS 'View rolling up some basic channel stats';
+COMMENT ON TABLE public.crawl_lease IS 'Channels being crawled right now and by which worker. Expired leases can be claimed again';
 
 
 --
--- Name: v_messages; Type: VIEW; Schema: public; Owner: -
+-- Name: COLUMN crawl_lease.lane; Type: COMMENT; Schema: public; Owner: -
 --
 
-CREATE VIEW public.v_messages AS
- SELECT m.id,
-    g.name AS guild,
-    c.name AS channel,
-    (m.raw_data ->> 'content'::text) AS content
-   FROM ((public.message m
-     LEFT JOIN public.channel c ON ((m.channel_id = c.id)))
-     LEFT JOIN public.guild g ON ((c.guild_id = g.id)));
+COMMENT ON COLUMN public.crawl_lease.lane IS 'forward (message_history) or backfill (backfill_history)';
 
 
 --
--- Name: channel channel_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+-- Name: COLUMN crawl_lease.owner; Type: COMMENT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.channel
-    ADD CONSTRAINT channel_pkey PRIMARY KEY (id);
+COMMENT ON COLUMN public.crawl_lease.owner IS 'host:pid:thread of the worker holding the lease';
 
 
 --
--- Name: config config_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+-- Name: guild; Type: TABLE; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.config
-    ADD CONSTRAINT config_pkey PRIMARY KEY (id);
+CREATE TABLE public.guild (
+    id bigint NOT NULL,
+    name character varying,
+    raw_data json,
+    selfbot_id integer,
+    invite_link text,
+    crawl_priority integer DEFAULT 0,
+    crawl_enabled boolean DEFAULT true NOT NULL,
+    payload_hash bytea,
+    members_refreshed_at timestamp without time zone
+);
 
 
 --
--- Name: guild guild_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+-- Name: COLUMN guild.crawl_priority; Type: COMMENT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.guild
-    ADD CONSTRAINT guild_pkey PRIMARY KEY (id);
+COMMENT ON COLUMN public.guild.crawl_priority IS 'Give preference or penalty to specific guilds. Higher numbers go sooner than lower.';
 
 
 --
--- Name: message message_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+-- Name: COLUMN guild.payload_hash; Type: COMMENT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.message
-    ADD CONSTRAINT message_pkey PRIMARY KEY (id);
+COMMENT ON COLUMN public.guild.payload_hash IS 'Hash of raw_data without the per-selfbot fields. refresh_guilds only rewrites the row when it changes';
 
 
 --
--- Name: schema_migrations schema_migrations_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+-- Name: COLUMN guild.members_refreshed_at; Type: COMMENT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.schema_migrations
-    ADD CONSTRAINT schema_migrations_pkey PRIMARY KEY (version);
+COMMENT ON COLUMN public.guild.members_refreshed_at IS 'Last complete member list stored by refresh_users';
 
 
 --
--- Name: selfbot selfbot_email_key; Type: CONSTRAINT; Schema: public; Owner: -
+-- Name: guild_selfbot; Type: TABLE; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.selfbot
-    ADD CONSTRAINT selfbot_email_key UNIQUE (email);
+CREATE TABLE public.guild_selfbot (
+    guild_id bigint NOT NULL,
+    selfbot_id integer NOT NULL,
+    active boolean DEFAULT true NOT NULL,
+    first_seen_at timestamp without time zone DEFAULT now() NOT NULL,
+    last_seen_at timestamp without time zone DEFAULT now() NOT NULL
+);
 
 
 --
--- Name: selfbot selfbot_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+-- Name: TABLE guild_selfbot; Type: COMMENT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.selfbot
-    ADD CONSTRAINT selfbot_pkey PRIMARY KEY (id);
+COMMENT ON TABLE public.guild_selfbot IS 'Every selfbot that is a member of a guild. Their tokens share the guild''s crawl';
 
 
 --
--- Name: selfbot selfbot_username_key; Type: CONSTRAINT; Schema: public; Owner: -
+-- Name: COLUMN guild_selfbot.active; Type: COMMENT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.selfbot
-    ADD CONSTRAINT selfbot_username_key UNIQUE (username);
+COMMENT ON COLUMN public.guild_selfbot.active IS 'False once the selfbot left the guild or its token was rejected (401)';
 
 
 --
--- Name: channel_id_idx; Type: INDEX; Schema: public; Owner: -
+-- Name: member; Type: TABLE; Schema: public; Owner: -
 --
 
-CREATE INDEX channel_id_idx ON public.message USING btree (channel_id);
+CREATE TABLE public.member (
+    guild_id bigint NOT NULL,
+    user_id bigint NOT NULL,
+    username character varying,
+    nick character varying,
+    joined_at timestamp with time zone,
+    data jsonb NOT NULL,
+    payload_hash bytea NOT NULL,
+    first_seen_at timestamp without time zone DEFAULT now() NOT NULL,
+    last_update timestamp without time zone DEFAULT now() NOT NULL,
+    left_at timestamp without time zone
+);
 
 
 --
--- Name: channel channel_guild_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+-- Name: TABLE member; Type: COMMENT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.channel
-    ADD CONSTRAINT channel_guild_id_fkey FOREIGN KEY (guild_id) REFERENCES public.guild(id) ON DELETE CASCADE;
+COMMENT ON TABLE public.member IS 'Guild members as listed by refresh_users. A row is only rewritten when its payload_hash changes';
 
 
 --
--- Name: guild guild_selfbot_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+-- Name: COLUMN member.data; Type: COMMENT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.guild
-    ADD CONSTRAINT guild_selfbot_id_fkey FOREIGN KEY (selfbot_id) REFERENCES public.selfbot(id) ON DELETE CASCADE;
+COMMENT ON COLUMN public.member.data IS 'Guild member object, including the user';
+
+
+--
+-- Name: COLUMN member.last_update; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.member.last_update IS 'Last time the member object changed';
+
+
+--
+-- Name: COLUMN member.left_at; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.member.left_at IS 'When refresh_users stopped seeing the member in the guild. Cleared if they come back';
+
+
+--
+-- Name: message; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.message (
+    id bigint NOT NULL,
+    raw_data json,
+    channel_id bigint,
+    data jsonb,
+    author_id bigint,
+    sent_at timestamp with time zone,
+    edited_at timestamp with time zone,
+    type smallint,
+    content text,
+    reference_id bigint,
+    attachment_count smallint,
+    deleted_at timestamp with time zone
+)
+PARTITION BY RANGE (id);
+
+
+--
+-- Name: TABLE message; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.message IS 'Partitioned by id (snowflake) into months, see create_message_partitions()';
+
+
+--
+-- Name: COLUMN message.raw_data; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.message.raw_data IS 'Message as stored before data existed. backfill_message_columns.py moves it into data and the typed columns';
+
+
+--
+-- Name: COLUMN message.data; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.message.data IS 'Message object as returned by Discord';
+
+
+--
+-- Name: COLUMN message.sent_at; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.message.sent_at IS 'Discord timestamp field';
+
+
+--
+-- Name: COLUMN message.edited_at; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.message.edited_at IS 'Discord edited_timestamp field';
+
+
+--
+-- Name: COLUMN message.reference_id; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.message.reference_id IS 'Id of the message replied to, forwarded or pinned';
+
+
+--
+-- Name: COLUMN message.deleted_at; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.message.deleted_at IS 'When gateway_ingest received the MESSAGE_DELETE. The row and its data are kept';
+
+
+--
+-- Name: message_default; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.message_default (
+    id bigint NOT NULL,
+    raw_data json,
+    channel_id bigint,
+    data jsonb,
+    author_id bigint,
+    sent_at timestamp with time zone,
+    edited_at timestamp with time zone,
+    type smallint,
+    content text,
+    reference_id bigint,
+    attachment_count smallint,
+    deleted_at timestamp with time zone
+);
+
+
+--
+-- Name: TABLE message_default; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.message_default IS 'Messages outside every monthly partition. create_message_partitions() moves them into their month';
+
+
+--
+-- Name: message_legacy; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.message_legacy (
+    id bigint NOT NULL,
+    raw_data json,
+    channel_id bigint,
+    data jsonb,
+    author_id bigint,
+    sent_at timestamp with time zone,
+    edited_at timestamp with time zone,
+    type smallint,
+    content text,
+    reference_id bigint,
+    attachment_count smallint,
+    deleted_at timestamp with time zone
+);
+
+
+--
+-- Name: TABLE message_legacy; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.message_legacy IS 'Messages stored before message was partitioned, up to the first monthly partition';
+
+
+--
+-- Name: message_y2026m10; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.message_y2026m10 (
+    id bigint NOT NULL,
+    raw_data json,
+    channel_id bigint,
+    data jsonb,
+    author_id bigint,
+    sent_at timestamp with time zone,
+    edited_at timestamp with time zone,
+    type smallint,
+    content text,
+    reference_id bigint,
+    attachment_count smallint,
+    deleted_at timestamp with time zone
+);
+
+
+--
+-- Name: message_y2026m11; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.message_y2026m11 (
+    id bigint NOT NULL,
+    raw_data json,
+    channel_id bigint,
+    data jsonb,
+    author_id bigint,
+    sent_at timestamp with time zone,
+    edited_at timestamp with time zone,
+    type smallint,
+    content text,
+    reference_id bigint,
+    attachment_count smallint,
+    deleted_at timestamp with time zone
+);
+
+
+--
+-- Name: message_y2026m12; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.message_y2026m12 (
+    id bigint NOT NULL,
+    raw_data json,
+    channel_id bigint,
+    data jsonb,
+    author_id bigint,
+    sent_at timestamp with time zone,
+    edited_at timestamp with time zone,
+    type smallint,
+    content text,
+    reference_id bigint,
+    attachment_count smallint,
+    deleted_at timestamp with time zone
+);
+
+
+--
+-- Name: message_y2027m01; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.message_y2027m01 (
+    id bigint NOT NULL,
+    raw_data json,
+    channel_id bigint,
+    data jsonb,
+    author_id bigint,
+    sent_at timestamp with time zone,
+    edited_at timestamp with time zone,
+    type smallint,
+    content text,
+    reference_id bigint,
+    attachment_count smallint,
+    deleted_at timestamp with time zone
+);
+
+
+--
+-- Name: schema_migrations; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.schema_migrations (
+    version character varying(255) NOT NULL
+);
+
+
+--
+-- Name: selfbot; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.selfbot (
+    id integer NOT NULL,
+    username character varying NOT NULL,
+    email character varying NOT NULL,
+    token text,
+    crawl_concurrency integer
+);
+
+
+--
+-- Name: COLUMN selfbot.crawl_concurrency; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.selfbot.crawl_concurrency IS 'Channels message_history crawls at once with this selfbot. NULL uses CRAWL_CONCURRENCY.';
+
+
+--
+-- Name: selfbot_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+--
+
+ALTER TABLE public.selfbot ALTER COLUMN id ADD GENERATED ALWAYS AS IDENTITY (
+    SEQUENCE NAME public.selfbot_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1
+);
+
+
+--
+-- Name: spool_checkpoint; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.spool_checkpoint (
+    spool_id text NOT NULL,
+    segment bigint NOT NULL,
+    "offset" bigint NOT NULL,
+    updated_at timestamp without time zone DEFAULT now() NOT NULL
+);
+
+
+--
+-- Name: TABLE spool_checkpoint; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.spool_checkpoint IS 'Position up to which spool_drain.py stored each local spool. Written in the transaction that stores the pages';
+
+
+--
+-- Name: v_channel_stats; Type: VIEW; Schema: public; Owner: -
+--
+
+CREATE VIEW public.v_channel_stats AS
+ SELECT g.name AS guild,
+    c.name AS channel,
+    COALESCE(s.message_count, (0)::bigint) AS message_count
+   FROM ((public.channel c
+     LEFT JOIN public.channel_stats s ON ((s.channel_id = c.id)))
+     LEFT JOIN public.guild g ON ((g.id = c.guild_id)));
+
+
+--
+-- Name: VIEW v_channel_stats; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON VIEW public.v_channel_stats IS 'View rolling up some basic channel stats';
+
+
+--
+-- Name: v_crawl_schedule; Type: VIEW; Schema: public; Owner: -
+--
+
+CREATE VIEW public.v_crawl_schedule AS
+ SELECT g.name AS guild,
+    c.name AS channel,
+    c.id AS channel_id,
+    g.crawl_priority,
+    round((c.message_rate)::numeric, 2) AS messages_per_hour,
+    c.last_crawl_messages,
+    c.last_update AS last_crawl_at,
+    c.next_crawl_at,
+    (c.next_crawl_at - c.last_update) AS crawl_interval,
+    GREATEST(((now())::timestamp without time zone - c.next_crawl_at), '00:00:00'::interval) AS overdue,
+    ((cc.channel_id IS NULL) OR (cc.high_message_id < COALESCE(c.last_message_id, (0)::bigint))) AS has_new_messages
+   FROM ((public.channel c
+     JOIN public.guild g ON ((g.id = c.guild_id)))
+     LEFT JOIN public.channel_cursor cc ON ((cc.channel_id = c.id)))
+  WHERE (c.crawl_enabled AND g.crawl_enabled AND (c.deleted_at IS NULL))
+  ORDER BY c.next_crawl_at;
+
+
+--
+-- Name: VIEW v_crawl_schedule; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON VIEW public.v_crawl_schedule IS 'When each channel is crawled next and why: its message rate and guild priority';
+
+
+--
+-- Name: v_guild_stats; Type: VIEW; Schema: public; Owner: -
+--
+
+CREATE VIEW public.v_guild_stats AS
+ SELECT g.name AS guild,
+    COALESCE(sum(s.message_count), (0)::numeric) AS message_count
+   FROM ((public.guild g
+     LEFT JOIN public.channel c ON ((c.guild_id = g.id)))
+     LEFT JOIN public.channel_stats s ON ((s.channel_id = c.id)))
+  GROUP BY g.id, g.name;
+
+
+--
+-- Name: VIEW v_guild_stats; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON VIEW public.v_guild_stats IS 'Messages stored per guild, from channel_stats';
+
+
+--
+-- Name: v_guild_stats_daily; Type: VIEW; Schema: public; Owner: -
+--
+
+CREATE VIEW public.v_guild_stats_daily AS
+ SELECT g.name AS guild,
+    d.day,
+    sum(d.message_count) AS message_count
+   FROM ((public.channel_stats_daily d
+     JOIN public.channel c ON ((c.id = d.channel_id)))
+     JOIN public.guild g ON ((g.id = c.guild_id)))
+  GROUP BY g.id, g.name, d.day;
+
+
+--
+-- Name: VIEW v_guild_stats_daily; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON VIEW public.v_guild_stats_daily IS 'Messages stored per guild and UTC day, from channel_stats_daily';
+
+
+--
+-- Name: v_messages; Type: VIEW; Schema: public; Owner: -
+--
+
+CREATE VIEW public.v_messages AS
+ SELECT m.id,
+    g.name AS guild,
+    c.name AS channel,
+    COALESCE(m.content, (m.raw_data ->> 'content'::text)) AS content
+   FROM ((public.message m
+     LEFT JOIN public.channel c ON ((m.channel_id = c.id)))
+     LEFT JOIN public.guild g ON ((c.guild_id = g.id)));
+
+
+--
+-- Name: message_default; Type: TABLE ATTACH; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message ATTACH PARTITION public.message_default DEFAULT;
+
+
+--
+-- Name: message_legacy; Type: TABLE ATTACH; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message ATTACH PARTITION public.message_legacy FOR VALUES FROM (MINVALUE) TO ('1555006331289600000');
+
+
+--
+-- Name: message_y2026m10; Type: TABLE ATTACH; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message ATTACH PARTITION public.message_y2026m10 FOR VALUES FROM ('1555006331289600000') TO ('1566240355123200000');
+
+
+--
+-- Name: message_y2026m11; Type: TABLE ATTACH; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message ATTACH PARTITION public.message_y2026m11 FOR VALUES FROM ('1566240355123200000') TO ('1577111991091200000');
+
+
+--
+-- Name: message_y2026m12; Type: TABLE ATTACH; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message ATTACH PARTITION public.message_y2026m12 FOR VALUES FROM ('1577111991091200000') TO ('1588346014924800000');
+
+
+--
+-- Name: message_y2027m01; Type: TABLE ATTACH; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message ATTACH PARTITION public.message_y2027m01 FOR VALUES FROM ('1588346014924800000') TO ('1599580038758400000');
+
+
+--
+-- Name: attachment attachment_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.attachment
+    ADD CONSTRAINT attachment_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: channel_cursor channel_cursor_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.channel_cursor
+    ADD CONSTRAINT channel_cursor_pkey PRIMARY KEY (channel_id);
+
+
+--
+-- Name: channel channel_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.channel
+    ADD CONSTRAINT channel_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: channel_stats_daily channel_stats_daily_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.channel_stats_daily
+    ADD CONSTRAINT channel_stats_daily_pkey PRIMARY KEY (channel_id, day);
+
+
+--
+-- Name: channel_stats channel_stats_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.channel_stats
+    ADD CONSTRAINT channel_stats_pkey PRIMARY KEY (channel_id);
+
+
+--
+-- Name: config config_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.config
+    ADD CONSTRAINT config_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: crawl_lease crawl_lease_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.crawl_lease
+    ADD CONSTRAINT crawl_lease_pkey PRIMARY KEY (channel_id, lane);
+
+
+--
+-- Name: guild guild_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.guild
+    ADD CONSTRAINT guild_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: guild_selfbot guild_selfbot_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.guild_selfbot
+    ADD CONSTRAINT guild_selfbot_pkey PRIMARY KEY (guild_id, selfbot_id);
+
+
+--
+-- Name: member member_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.member
+    ADD CONSTRAINT member_pkey PRIMARY KEY (guild_id, user_id);
+
+
+--
+-- Name: message message_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message
+    ADD CONSTRAINT message_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: message_default message_default_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message_default
+    ADD CONSTRAINT message_default_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: message_legacy message_legacy_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message_legacy
+    ADD CONSTRAINT message_legacy_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: message_y2026m10 message_y2026m10_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message_y2026m10
+    ADD CONSTRAINT message_y2026m10_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: message_y2026m11 message_y2026m11_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message_y2026m11
+    ADD CONSTRAINT message_y2026m11_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: message_y2026m12 message_y2026m12_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message_y2026m12
+    ADD CONSTRAINT message_y2026m12_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: message_y2027m01 message_y2027m01_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.message_y2027m01
+    ADD CONSTRAINT message_y2027m01_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: schema_migrations schema_migrations_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.schema_migrations
+    ADD CONSTRAINT schema_migrations_pkey PRIMARY KEY (version);
+
+
+--
+-- Name: selfbot selfbot_email_key; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.selfbot
+    ADD CONSTRAINT selfbot_email_key UNIQUE (email);
+
+
+--
+-- Name: selfbot selfbot_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.selfbot
+    ADD CONSTRAINT selfbot_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: selfbot selfbot_username_key; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.selfbot
+    ADD CONSTRAINT selfbot_username_key UNIQUE (username);
+
+
+--
+-- Name: spool_checkpoint spool_checkpoint_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.spool_checkpoint
+    ADD CONSTRAINT spool_checkpoint_pkey PRIMARY KEY (spool_id);
+
+
+--
+-- Name: attachment_due_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX attachment_due_idx ON public.attachment USING btree (next_attempt_at) WHERE (next_attempt_at IS NOT NULL);
+
+
+--
+-- Name: attachment_message_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX attachment_message_id_idx ON public.attachment USING btree (message_id);
+
+
+--
+-- Name: attachment_sha256_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX attachment_sha256_idx ON public.attachment USING btree (sha256) WHERE (sha256 IS NOT NULL);
+
+
+--
+-- Name: channel_crawl_log_channel_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX channel_crawl_log_channel_id_idx ON public.channel_crawl_log USING btree (channel_id);
+
+
+--
+-- Name: channel_next_crawl_at_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX channel_next_crawl_at_idx ON public.channel USING btree (next_crawl_at) WHERE crawl_enabled;
+
+
+--
+-- Name: crawl_lease_expires_at_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX crawl_lease_expires_at_idx ON public.crawl_lease USING btree (expires_at);
+
+
+--
+-- Name: guild_selfbot_selfbot_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX guild_selfbot_selfbot_id_idx ON public.guild_selfbot USING btree (selfbot_id) WHERE active;
+
+
+--
+-- Name: member_user_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX member_user_id_idx ON public.member USING btree (user_id);
+
+
+--
+-- Name: message_author_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_author_id_id_idx ON ONLY public.message USING btree (author_id, id);
+
+
+--
+-- Name: message_channel_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_channel_id_id_idx ON ONLY public.message USING btree (channel_id, id);
+
+
+--
+-- Name: message_default_author_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_default_author_id_id_idx ON public.message_default USING btree (author_id, id);
+
+
+--
+-- Name: message_default_channel_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_default_channel_id_id_idx ON public.message_default USING btree (channel_id, id);
+
+
+--
+-- Name: message_reference_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_reference_id_idx ON ONLY public.message USING btree (reference_id) WHERE (reference_id IS NOT NULL);
+
+
+--
+-- Name: message_default_reference_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_default_reference_id_idx ON public.message_default USING btree (reference_id) WHERE (reference_id IS NOT NULL);
+
+
+--
+-- Name: message_legacy_author_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_legacy_author_id_id_idx ON public.message_legacy USING btree (author_id, id);
+
+
+--
+-- Name: message_legacy_channel_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_legacy_channel_id_id_idx ON public.message_legacy USING btree (channel_id, id);
+
+
+--
+-- Name: message_legacy_reference_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_legacy_reference_id_idx ON public.message_legacy USING btree (reference_id) WHERE (reference_id IS NOT NULL);
+
+
+--
+-- Name: message_y2026m10_author_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2026m10_author_id_id_idx ON public.message_y2026m10 USING btree (author_id, id);
+
+
+--
+-- Name: message_y2026m10_channel_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2026m10_channel_id_id_idx ON public.message_y2026m10 USING btree (channel_id, id);
+
+
+--
+-- Name: message_y2026m10_reference_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2026m10_reference_id_idx ON public.message_y2026m10 USING btree (reference_id) WHERE (reference_id IS NOT NULL);
+
+
+--
+-- Name: message_y2026m11_author_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2026m11_author_id_id_idx ON public.message_y2026m11 USING btree (author_id, id);
+
+
+--
+-- Name: message_y2026m11_channel_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2026m11_channel_id_id_idx ON public.message_y2026m11 USING btree (channel_id, id);
+
+
+--
+-- Name: message_y2026m11_reference_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2026m11_reference_id_idx ON public.message_y2026m11 USING btree (reference_id) WHERE (reference_id IS NOT NULL);
+
+
+--
+-- Name: message_y2026m12_author_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2026m12_author_id_id_idx ON public.message_y2026m12 USING btree (author_id, id);
+
+
+--
+-- Name: message_y2026m12_channel_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2026m12_channel_id_id_idx ON public.message_y2026m12 USING btree (channel_id, id);
+
+
+--
+-- Name: message_y2026m12_reference_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2026m12_reference_id_idx ON public.message_y2026m12 USING btree (reference_id) WHERE (reference_id IS NOT NULL);
+
+
+--
+-- Name: message_y2027m01_author_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2027m01_author_id_id_idx ON public.message_y2027m01 USING btree (author_id, id);
+
+
+--
+-- Name: message_y2027m01_channel_id_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2027m01_channel_id_id_idx ON public.message_y2027m01 USING btree (channel_id, id);
+
+
+--
+-- Name: message_y2027m01_reference_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX message_y2027m01_reference_id_idx ON public.message_y2027m01 USING btree (reference_id) WHERE (reference_id IS NOT NULL);
+
+
+--
+-- Name: message_default_author_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_author_id_id_idx ATTACH PARTITION public.message_default_author_id_id_idx;
+
+
+--
+-- Name: message_default_channel_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_channel_id_id_idx ATTACH PARTITION public.message_default_channel_id_id_idx;
+
+
+--
+-- Name: message_default_pkey; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_pkey ATTACH PARTITION public.message_default_pkey;
+
+
+--
+-- Name: message_default_reference_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_reference_id_idx ATTACH PARTITION public.message_default_reference_id_idx;
+
+
+--
+-- Name: message_legacy_author_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_author_id_id_idx ATTACH PARTITION public.message_legacy_author_id_id_idx;
+
+
+--
+-- Name: message_legacy_channel_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_channel_id_id_idx ATTACH PARTITION public.message_legacy_channel_id_id_idx;
+
+
+--
+-- Name: message_legacy_pkey; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_pkey ATTACH PARTITION public.message_legacy_pkey;
+
+
+--
+-- Name: message_legacy_reference_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_reference_id_idx ATTACH PARTITION public.message_legacy_reference_id_idx;
+
+
+--
+-- Name: message_y2026m10_author_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_author_id_id_idx ATTACH PARTITION public.message_y2026m10_author_id_id_idx;
+
+
+--
+-- Name: message_y2026m10_channel_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_channel_id_id_idx ATTACH PARTITION public.message_y2026m10_channel_id_id_idx;
+
+
+--
+-- Name: message_y2026m10_pkey; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_pkey ATTACH PARTITION public.message_y2026m10_pkey;
+
+
+--
+-- Name: message_y2026m10_reference_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_reference_id_idx ATTACH PARTITION public.message_y2026m10_reference_id_idx;
+
+
+--
+-- Name: message_y2026m11_author_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_author_id_id_idx ATTACH PARTITION public.message_y2026m11_author_id_id_idx;
+
+
+--
+-- Name: message_y2026m11_channel_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_channel_id_id_idx ATTACH PARTITION public.message_y2026m11_channel_id_id_idx;
+
+
+--
+-- Name: message_y2026m11_pkey; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_pkey ATTACH PARTITION public.message_y2026m11_pkey;
+
+
+--
+-- Name: message_y2026m11_reference_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_reference_id_idx ATTACH PARTITION public.message_y2026m11_reference_id_idx;
+
+
+--
+-- Name: message_y2026m12_author_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_author_id_id_idx ATTACH PARTITION public.message_y2026m12_author_id_id_idx;
+
+
+--
+-- Name: message_y2026m12_channel_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_channel_id_id_idx ATTACH PARTITION public.message_y2026m12_channel_id_id_idx;
+
+
+--
+-- Name: message_y2026m12_pkey; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_pkey ATTACH PARTITION public.message_y2026m12_pkey;
+
+
+--
+-- Name: message_y2026m12_reference_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_reference_id_idx ATTACH PARTITION public.message_y2026m12_reference_id_idx;
+
+
+--
+-- Name: message_y2027m01_author_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_author_id_id_idx ATTACH PARTITION public.message_y2027m01_author_id_id_idx;
+
+
+--
+-- Name: message_y2027m01_channel_id_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_channel_id_id_idx ATTACH PARTITION public.message_y2027m01_channel_id_id_idx;
+
+
+--
+-- Name: message_y2027m01_pkey; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_pkey ATTACH PARTITION public.message_y2027m01_pkey;
+
+
+--
+-- Name: message_y2027m01_reference_id_idx; Type: INDEX ATTACH; Schema: public; Owner: -
+--
+
+ALTER INDEX public.message_reference_id_idx ATTACH PARTITION public.message_y2027m01_reference_id_idx;
+
+
+--
+-- Name: channel_cursor channel_cursor_channel_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.channel_cursor
+    ADD CONSTRAINT channel_cursor_channel_id_fkey FOREIGN KEY (channel_id) REFERENCES public.channel(id) ON DELETE CASCADE;
+
+
+--
+-- Name: channel channel_guild_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.channel
+    ADD CONSTRAINT channel_guild_id_fkey FOREIGN KEY (guild_id) REFERENCES public.guild(id) ON DELETE CASCADE;
+
+
+--
+-- Name: crawl_lease crawl_lease_channel_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.crawl_lease
+    ADD CONSTRAINT crawl_lease_channel_id_fkey FOREIGN KEY (channel_id) REFERENCES public.channel(id) ON DELETE CASCADE;
+
+
+--
+-- Name: guild_selfbot guild_selfbot_guild_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.guild_selfbot
+    ADD CONSTRAINT guild_selfbot_guild_id_fkey FOREIGN KEY (guild_id) REFERENCES public.guild(id) ON DELETE CASCADE;
+
+
+--
+-- Name: guild guild_selfbot_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.guild
+    ADD CONSTRAINT guild_selfbot_id_fkey FOREIGN KEY (selfbot_id) REFERENCES public.selfbot(id) ON DELETE CASCADE;
+
+
+--
+-- Name: guild_selfbot guild_selfbot_selfbot_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.guild_selfbot
+    ADD CONSTRAINT guild_selfbot_selfbot_id_fkey FOREIGN KEY (selfbot_id) REFERENCES public.selfbot(id) ON DELETE CASCADE;
+
+
+--
+-- Name: member member_guild_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.member
+    ADD CONSTRAINT member_guild_id_fkey FOREIGN KEY (guild_id) REFERENCES public.guild(id) ON DELETE CASCADE;
 
 
 --
@@ -335,4 +1648,23 @@ ALTER TABLE ONLY public.guild
 
 INSERT INTO public.schema_migrations (version) VALUES
     ('20221102214739'),
-    ('20221103124223');
+    ('20221103124223'),
+    ('20261018150000'),
+    ('20261018160000'),
+    ('20261018170000'),
+    ('20261018170100'),
+    ('20261018180000'),
+    ('20261018190000'),
+    ('20261018200000'),
+    ('20261018210000'),
+    ('20261018220000'),
+    ('20261018230000'),
+    ('20261019000000'),
+    ('20261019010000'),
+    ('20261019020000'),
+    ('20261019030000'),
+    ('20261019040000'),
+    ('20261019050000'),
+    ('20261019060000'),
+    ('20261019070000'),
+    ('20261019080000');
@@ -0,0 +1,230 @@
+"""Worker to backfill channel history older than the oldest message we hold.
+
+Pages backwards with `before` from the oldest stored message down to the
+first message of the channel. Runs as its own service so deep histories never
+hold up the polling for fresh messages in message_history.py.
+"""
+
+import logging.config
+import signal
+import threading
+import time
+from datetime import datetime
+from typing import Optional, List, Dict
+
+import psycopg
+
+from libs.api import DiscordAPI429
+from libs.ratelimit import log_snapshot
+import settings
+from libs.db_operations import (
+    get_db_conn,
+    get_selfbots,
+    bulk_upsert_messages,
+    channel_crawl_enabled,
+    create_channel_crawl_log,
+    mark_channel_history_complete,
+    advance_channel_cursor,
+    claim_backfill_channel,
+    lease_owner,
+)
+from libs.lease import Lease
+from libs.tokens import TokenPool
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+def get_low_snowflake(message_list: List) -> Optional[int]:
+    """
+    Get the snowflake with the lowest ID in a message list.
+
+    :param message_list:
+    :return: Integer - the lowest snowflake message id or None
+    """
+    message_ids = [int(message['id']) for message in message_list if 'id' in message]
+
+    if message_ids:
+        return min(message_ids)
+
+    return None
+
+
+def backfill_channel(
+    db_conn: psycopg.Connection,
+    pool: TokenPool,
+    channel: Dict,
+    lease: Optional[Lease] = None,
+) -> None:
+    """
+    Page backwards through a channel until the first message is reached.
+
+    Each page is committed with the channel's low cursor, so an interrupted
+    backfill resumes from the oldest message stored. The covered range is
+    written to channel_crawl_log when the backfill stops.
+
+    :param db_conn: Database handle, autocommit on
+    :param pool: Tokens of every selfbot in the channel's guild
+    :param channel: Claimed channel row
+    :param lease: The worker's lease on the channel, renewed between pages.
+        The backfill stops if the lease is lost.
+    :return: None
+    """
+    channel_id: int = channel['channel_id']
+    before: Optional[int] = channel['message_id']
+
+    logger.debug(
+        'Backfilling channel history for | {0} | {1} | {2} | before {3}'.format(
+            channel['guild_name'],
+            channel['channel_name'],
+            channel_id,
+            before,
+        )
+    )
+
+    start_time = datetime.utcnow()
+    high_id: Optional[int] = before
+    low_id: Optional[int] = before
+    complete = False
+
+    while True:
+        if lease is not None and not lease.keep_alive():
+            break
+
+        try:
+            messages = pool.get_messages(channel['guild_id'], channel_id, before=before)
+        except DiscordAPI429 as e:
+            logger.warning('Channel {0} still rate limited, moving on: {1}'.format(channel_id, e))
+            break
+
+        if isinstance(messages, list) and len(messages) > 0:
+            before = low_id = get_low_snowflake(messages)
+            if high_id is None:
+                high_id = max(int(m['id']) for m in messages)
+            with db_conn.transaction():
+                bulk_upsert_messages(db_conn, messages, channel_id)
+                advance_channel_cursor(db_conn, channel_id, high_id=high_id, low_id=low_id)
+
+        # Usually access related. Same handling as the forward crawler.
+        elif isinstance(messages, dict):
+            channel_crawl_enabled(db_conn, channel_id, False)
+            logger.warning('Channel {0} got error: {1}'.format(channel_id, messages))
+            break
+
+        # Empty page. There is nothing older.
+        else:
+            complete = True
+            break
+
+    if low_id is not None and low_id != high_id:
+        create_channel_crawl_log(
+            conn=db_conn,
+            low_id=low_id,
+            high_id=high_id,
+            start_time=start_time,
+            end_time=datetime.utcnow(),
+            channel_id=channel_id,
+        )
+
+    if complete:
+        mark_channel_history_complete(db_conn, channel_id)
+
+
+def backfill_worker(selfbot: Dict, pool: TokenPool, stop: threading.Event) -> None:
+    """
+    Claim and backfill channels of one selfbot until `stop` is set.
+
+    :param selfbot: selfbot row
+    :param pool: Tokens of every selfbot, shared by all workers
+    :param stop: Set to shut the worker down after the current channel
+    :return: None
+    """
+    db_conn = get_db_conn()
+    owner = lease_owner()
+
+    while not stop.is_set():
+        lease = None
+        try:
+            channel = claim_backfill_channel(db_conn, selfbot['id'], owner)
+
+            if channel is None:
+                stop.wait(settings.CRAWL_IDLE_SLEEP)
+                continue
+
+            lease = Lease(db_conn, channel['channel_id'], 'backfill', owner)
+            backfill_channel(db_conn, pool, channel, lease)
+
+        except Exception:
+            logger.exception('Backfill failed for selfbot {0}'.format(selfbot['username']))
+            if db_conn.broken:
+                # The lease expires on its own after LEASE_TTL.
+                db_conn = get_db_conn()
+                lease = None
+            stop.wait(settings.CRAWL_IDLE_SLEEP)
+
+        finally:
+            if lease is not None and not lease.lost:
+                try:
+                    lease.release()
+                except psycopg.Error:
+                    logger.exception('Could not release the lease on channel {0}'.format(
+                        lease.channel_id,
+                    ))
+
+    db_conn.close()
+
+
+if __name__ == '__main__':
+
+    logger.info('Starting up...')
+    db_conn = get_db_conn()
+    selfbots = get_selfbots(db_conn)
+
+    if not selfbots:
+        logger.critical('No selfbot tokens. Add them to the database.')
+        exit(1)
+
+    stop = threading.Event()
+    # SIGTERM is handled like Ctrl-C. Setting the event from inside a signal
+    # handler can deadlock with the stop.wait() it interrupts.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    pool = TokenPool(selfbots)
+    pool.refresh(db_conn)
+
+    workers = []
+    for sb in selfbots:
+
+        for n in range(settings.BACKFILL_CONCURRENCY):
+            worker = threading.Thread(
+                target=backfill_worker,
+                args=(sb, pool, stop),
+                name='{0}-backfill-{1}'.format(sb['username'], n),
+            )
+            worker.start()
+            workers.append(worker)
+
+    reported_at = time.monotonic()
+    try:
+        while not stop.wait(settings.TOKEN_POOL_REFRESH):
+            try:
+                pool.refresh(db_conn)
+            except psycopg.Error:
+                logger.exception('Could not refresh the token pool')
+                if db_conn.broken:
+                    db_conn = get_db_conn()
+
+            if settings.RATE_LIMIT_REPORT_INTERVAL and \
+                    time.monotonic() - reported_at >= settings.RATE_LIMIT_REPORT_INTERVAL:
+                log_snapshot()
+                reported_at = time.monotonic()
+    except KeyboardInterrupt:
+        stop.set()
+
+    logger.info('Waiting for backfills in progress to finish...')
+    for worker in workers:
+        worker.join()
+
+    db_conn.close()
+    print('DONE')
@@ -0,0 +1,169 @@
+"""One-off job moving stored messages from raw_data into data and the typed columns.
+
+Messages written before the typed columns existed only have raw_data (json).
+This splits their id range into slices and has a pool of workers convert
+each slice in small batches, one transaction per batch, so no lock is held
+for long and the crawlers keep running. Interrupted runs can simply be
+started again: converted rows no longer have raw_data and are skipped.
+
+    python backfill_message_columns.py --workers 8 --batch 5000
+
+Vacuum `message` afterwards to reclaim the space of the old rows.
+"""
+
+import argparse
+import logging.config
+import queue
+import signal
+import threading
+import time
+from typing import Tuple
+
+import psycopg
+
+import settings
+from libs.db_operations import (
+    get_db_conn,
+    get_unconverted_message_range,
+    convert_message_batch,
+)
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+# Slices per worker, so a worker that got a dense slice does not hold up the
+# end of the run.
+SLICES_PER_WORKER = 8
+
+# Seconds between progress lines.
+REPORT_INTERVAL = 30
+
+
+class Progress(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.converted = 0
+        self.slices_done = 0
+
+    def add(self, converted: int, slice_done: bool = False) -> None:
+        with self.lock:
+            self.converted += converted
+            self.slices_done += int(slice_done)
+
+
+def log_progress(progress: Progress, total_slices: int, started_at: float) -> None:
+    logger.info('Converted {0} messages, {1}/{2} slices done, {3:.0f} messages/sec'.format(
+        progress.converted,
+        progress.slices_done,
+        total_slices,
+        progress.converted / max(time.monotonic() - started_at, 1e-9),
+    ))
+
+
+def slices(low: int, high: int, count: int) -> list:
+    """
+    Split the ids [low, high] into `count` contiguous ranges.
+
+    :return: List of (low, high) tuples, high exclusive
+    """
+    step = max((high - low) // count + 1, 1)
+    return [(start, min(start + step, high + 1)) for start in range(low, high + 1, step)]
+
+
+def convert_slice(
+    db_conn: psycopg.Connection,
+    id_range: Tuple[int, int],
+    batch: int,
+    progress: Progress,
+    stop: threading.Event,
+) -> None:
+    low, high = id_range
+
+    while not stop.is_set():
+        converted, last_id = convert_message_batch(db_conn, low, high, batch)
+        progress.add(converted)
+
+        if converted < batch:
+            break
+        low = last_id + 1
+
+    progress.add(0, slice_done=not stop.is_set())
+
+
+def convert_worker(
+    work: queue.Queue,
+    batch: int,
+    progress: Progress,
+    stop: threading.Event,
+) -> None:
+    db_conn = get_db_conn()
+
+    while not stop.is_set():
+        try:
+            id_range = work.get_nowait()
+        except queue.Empty:
+            break
+
+        try:
+            convert_slice(db_conn, id_range, batch, progress, stop)
+        except psycopg.Error:
+            logger.exception('Could not convert messages {0} to {1}'.format(*id_range))
+            if db_conn.broken:
+                db_conn = get_db_conn()
+
+    db_conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='Parallel database connections')
+    parser.add_argument('--batch', type=int, default=5000, help='Messages per transaction')
+    args = parser.parse_args()
+
+    db_conn = get_db_conn()
+    id_range = get_unconverted_message_range(db_conn)
+    db_conn.close()
+
+    if id_range is None:
+        logger.info('Every message is converted already')
+        exit(0)
+
+    work: queue.Queue = queue.Queue()
+    parts = slices(id_range[0], id_range[1], args.workers * SLICES_PER_WORKER)
+    for part in parts:
+        work.put(part)
+    logger.info('Converting messages {0} to {1} in {2} slices'.format(id_range[0], id_range[1], len(parts)))
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    progress = Progress()
+    started_at = time.monotonic()
+
+    workers = []
+    for n in range(args.workers):
+        worker = threading.Thread(
+            target=convert_worker,
+            args=(work, args.batch, progress, stop),
+            name='convert-{0}'.format(n),
+        )
+        worker.start()
+        workers.append(worker)
+
+    reported_at = started_at
+    try:
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(1)
+            if time.monotonic() - reported_at >= REPORT_INTERVAL:
+                log_progress(progress, len(parts), started_at)
+                reported_at = time.monotonic()
+    except KeyboardInterrupt:
+        logger.info('Stopping after the batches in progress. Run again to continue')
+        stop.set()
+
+    for worker in workers:
+        worker.join()
+
+    log_progress(progress, len(parts), started_at)
+    print('DONE')
@@ -0,0 +1,79 @@
+"""Pages/sec for the sync and async Discord clients against a local fake server.
+
+Run from the discord_crawler directory:
+
+    python -m benchmarks.bench_api --pages 2000 --latency-ms 20
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('DATABASE_URL', '')
+
+import requests
+
+from benchmarks.fake_discord import FakeDiscord, FakeDiscordServer
+from libs.api import DiscordAPI, AsyncDiscordAPI, close_async_sessions
+
+
+TOKEN = 'bench-token'
+
+
+def report(label: str, pages: int, elapsed: float) -> None:
+    print('{0:<32} {1:>7} pages {2:>8.2f}s {3:>10.1f} pages/sec'.format(
+        label, pages, elapsed, pages / elapsed,
+    ))
+
+
+def bench_bare_requests(base_url: str, channel_ids: list, pages: int) -> None:
+    """The pre-pool behaviour: a new connection for every page."""
+    headers = {'authorization': TOKEN}
+    start = time.perf_counter()
+    for i in range(pages):
+        url = '{0}/channels/{1}/messages'.format(base_url, channel_ids[i % len(channel_ids)])
+        requests.get(url, headers=headers, params={'limit': 100, 'after': 0}).json()
+    report('sync requests.get', pages, time.perf_counter() - start)
+
+
+def bench_sync(base_url: str, channel_ids: list, pages: int) -> None:
+    api = DiscordAPI(TOKEN)
+    api.BASE_URL = base_url + '/{0}'
+    start = time.perf_counter()
+    for i in range(pages):
+        api.get_messages(channel_ids[i % len(channel_ids)], after=0)
+    report('sync DiscordAPI (pooled)', pages, time.perf_counter() - start)
+
+
+async def bench_async(base_url: str, channel_ids: list, pages: int, concurrency: int) -> None:
+    api = AsyncDiscordAPI(TOKEN)
+    api.BASE_URL = base_url + '/{0}'
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(i: int) -> None:
+        async with semaphore:
+            await api.get_messages(channel_ids[i % len(channel_ids)], after=0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(fetch(i) for i in range(pages)))
+    report('async x{0}'.format(concurrency), pages, time.perf_counter() - start)
+    await close_async_sessions()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 100, 300])
+    args = parser.parse_args()
+
+    fake = FakeDiscord(guilds=1, channels_per_guild=20, messages_per_channel=100, latency_ms=args.latency_ms)
+    channels = [int(c['id']) for chans in fake.channels.values() for c in chans]
+
+    with FakeDiscordServer(fake) as server:
+        print('fake server {0} | injected latency {1}ms'.format(server.base_url, args.latency_ms))
+        bench_bare_requests(server.base_url, channels, args.pages)
+        bench_sync(server.base_url, channels, args.pages)
+        for n in args.concurrency:
+            asyncio.run(bench_async(server.base_url, channels, args.pages, n))
@@ -0,0 +1,101 @@
+"""Attachment download throughput against the fake Discord CDN.
+
+Starts benchmarks/fake_discord.py with attachments on --attachments of the
+messages, stores every message (which queues their attachments) and runs
+download_attachments.py until the queue is empty, once per --pool size
+with ATTACHMENT_HOST_CONCURRENCY of --host-limit. Every run starts from an
+empty store and a fresh queue. It reports files/sec, the bytes received
+against the bytes of all attachments (cut off responses that are resumed
+add little), blobs stored, CDN requests and the most requests the CDN saw
+at once.
+
+All guild, channel and message rows are deleted first, so point
+DATABASE_URL at a scratch database loaded with db/schema.sql. Run from the
+discord_crawler directory:
+
+    DATABASE_URL=postgres://... python -m benchmarks.bench_attachments --pool 1,4,16 --cdn-cut 0.05
+"""
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from benchmarks.bench_e2e import reset
+from benchmarks.fake_discord import FakeDiscordServer, add_arguments, from_arguments
+from libs.codec import dumps
+from libs.db_operations import get_db_conn, insert_message_pages
+
+
+def pending(conn) -> int:
+    return conn.execute('SELECT count(*) AS n FROM attachment WHERE sha256 IS NULL').fetchone()['n']
+
+
+def run(fake, env: dict, conn, pool: int, host_limit: int, store: str, timeout: float) -> None:
+    conn.execute('UPDATE attachment SET sha256 = NULL, downloaded_at = NULL, next_attempt_at = now(), attempts = 0, error = NULL')
+    shutil.rmtree(store, ignore_errors=True)
+    total = conn.execute('SELECT count(*) AS n, sum(size) AS bytes FROM attachment').fetchone()
+    requests_before, bytes_before = fake.cdn_requests, fake.cdn_bytes
+    fake.cdn_peak = 0
+
+    env = dict(env, ATTACHMENT_DIR=store, ATTACHMENT_CONCURRENCY=str(pool), ATTACHMENT_HOST_CONCURRENCY=str(host_limit))
+    started_at = time.monotonic()
+    proc = subprocess.Popen([sys.executable, 'download_attachments.py'], env=env, stdout=subprocess.DEVNULL)
+    while pending(conn) and time.monotonic() - started_at < timeout:
+        time.sleep(0.1)
+    elapsed = time.monotonic() - started_at
+    proc.send_signal(signal.SIGTERM)
+    proc.wait()
+
+    left = pending(conn)
+    blobs = sum(len(files) for path, _, files in os.walk(store) if not path.endswith('partial'))
+    print('pool {0:>3} host limit {1:>3} {2:>7.2f}s {3:>8.1f} files/s {4:>7.1f} MB/s received {5:>6.3f}x content '
+          '{6:>6} blobs {7:>6} requests peak {8:>3}{9}'.format(
+              pool, host_limit, elapsed,
+              (total['n'] - left) / elapsed,
+              (fake.cdn_bytes - bytes_before) / elapsed / 1e6,
+              (fake.cdn_bytes - bytes_before) / (total['bytes'] or 1),
+              blobs,
+              fake.cdn_requests - requests_before,
+              fake.cdn_peak,
+              ' | {0} not downloaded'.format(left) if left else '',
+          ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--pool', default='1,4,16', help='ATTACHMENT_CONCURRENCY of each run, comma separated')
+    parser.add_argument('--host-limit', type=int, default=8, help='ATTACHMENT_HOST_CONCURRENCY')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds before a run is stopped')
+    parser.set_defaults(guilds=1, channels=10, messages=500, attachments=0.2, attachment_variants=200)
+    args = parser.parse_args()
+
+    fake = from_arguments(args)
+    conn = get_db_conn()
+    reset(conn)
+    store = tempfile.mkdtemp(prefix='bench-attachments-')
+
+    with FakeDiscordServer(fake) as server:
+        for channel_id, ids in fake.messages.items():
+            for start in range(0, len(ids), 100):
+                page = [fake.message(channel_id, i, n) for n, i in enumerate(ids[start:start + 100])]
+                insert_message_pages(conn, [dumps(page)])
+
+        queued = conn.execute('SELECT count(*) AS n FROM attachment').fetchone()['n']
+        print('fake server {0} | {1} attachments of {2} KiB, {3} different | latency {4}ms | {5:.0%} of responses cut off'.format(
+            server.base_url, queued, args.attachment_kb, args.attachment_variants or queued,
+            args.latency_ms, args.cdn_cut,
+        ))
+
+        env = dict(os.environ, DISCORD_API_URL=server.base_url)
+        for pool in [int(p) for p in args.pool.split(',')]:
+            run(fake, env, conn, pool, args.host_limit, store, args.timeout)
+
+    shutil.rmtree(store, ignore_errors=True)
+    conn.close()
@@ -0,0 +1,95 @@
+"""Channels claimed/sec by claim_channels for one worker and many.
+
+Creates a throwaway selfbot, guild and channels, lets workers claim and
+immediately release them for a few seconds per setting, and deletes
+everything again. Writes are committed, so use a scratch database. Run from
+the discord_crawler directory:
+
+    DATABASE_URL=postgres://... python -m benchmarks.bench_claims
+"""
+import argparse
+import os
+import threading
+import time
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from benchmarks.fake_discord import make_snowflake
+from libs.db_operations import get_db_conn, claim_channels, release_crawl_leases
+
+
+START_MS = 1262304000000
+
+
+def setup(conn, channels: int) -> int:
+    with conn.transaction(), conn.cursor() as cur:
+        selfbot_id = cur.execute(
+            "INSERT INTO selfbot (username, email, token) VALUES ('bench-claims', 'bench@localhost', NULL) RETURNING id"
+        ).fetchone()['id']
+        guild_id = make_snowflake(START_MS)
+        cur.execute(
+            "INSERT INTO guild (id, name, selfbot_id) VALUES (%s, 'bench-claims', %s)",
+            [guild_id, selfbot_id],
+        )
+        cur.executemany(
+            'INSERT INTO channel (id, name, guild_id, last_message_id) VALUES (%s, %s, %s, 1)',
+            [(make_snowflake(START_MS + 1, 0) + i, 'bench-{0}'.format(i), guild_id) for i in range(channels)],
+        )
+    return selfbot_id
+
+
+def teardown(conn, selfbot_id: int) -> None:
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute(
+            'DELETE FROM channel WHERE guild_id IN (SELECT id FROM guild WHERE selfbot_id = %s)',
+            [selfbot_id],
+        )
+        cur.execute('DELETE FROM guild WHERE selfbot_id = %s', [selfbot_id])
+        cur.execute('DELETE FROM selfbot WHERE id = %s', [selfbot_id])
+
+
+def worker(selfbot_id: int, batch: int, deadline: float, counts: list, n: int) -> None:
+    conn = get_db_conn()
+    owner = 'bench-claims:{0}'.format(n)
+    while time.perf_counter() < deadline:
+        claimed = claim_channels(conn, selfbot_id, owner, batch)
+        if claimed:
+            release_crawl_leases(conn, [c['channel_id'] for c in claimed], 'forward', owner)
+        counts[n] += len(claimed)
+    conn.close()
+
+
+def run(selfbot_id: int, workers: int, batch: int, seconds: float) -> float:
+    counts = [0] * workers
+    deadline = time.perf_counter() + seconds
+    threads = [
+        threading.Thread(target=worker, args=(selfbot_id, batch, deadline, counts, n))
+        for n in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=5000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+
+    conn = get_db_conn()
+    selfbot_id = setup(conn, args.channels)
+
+    try:
+        print('{0:>8} {1:>6} {2:>14}'.format('workers', 'batch', 'claims/sec'))
+        for workers in args.workers:
+            for batch in args.batches:
+                rate = run(selfbot_id, workers, batch, args.seconds)
+                print('{0:>8} {1:>6} {2:>14.0f}'.format(workers, batch, rate))
+    finally:
+        teardown(conn, selfbot_id)
+        conn.close()
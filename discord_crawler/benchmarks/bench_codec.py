@@ -0,0 +1,96 @@
+"""Microseconds per 100-message page to decode it and encode it for the database.
+
+Compares the path before libs.codec (requests' json() and json.dumps per
+message), libs.codec decoding and re-encoding every message (the COPY
+path of bulk_upsert_messages) and libs.codec decoding only, with the body
+written as it came (the codec.Page path). With --database it also times
+bulk_upsert_messages for a Page against the same messages as a plain list,
+inside transactions that are rolled back. Run from the discord_crawler
+directory:
+
+    python -m benchmarks.bench_codec
+    DATABASE_URL=postgres://... python -m benchmarks.bench_codec --database
+"""
+import argparse
+import json
+import os
+import time
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from benchmarks.fake_discord import make_message, make_snowflake
+from libs import codec
+
+
+CHANNEL_ID = make_snowflake(1640995200000)
+
+
+def make_page(number: int, size: int = 100) -> bytes:
+    """Response body of one message page, encoded like Discord does."""
+    messages = [
+        make_message(CHANNEL_ID, make_snowflake(1640995200000 + (number * size + i) * 1000), number * size + i)
+        for i in range(size)
+    ]
+    return json.dumps(messages).encode()
+
+
+def stdlib(body: bytes) -> list:
+    return [json.dumps(m) for m in json.loads(body)]
+
+
+def codec_reencode(body: bytes) -> list:
+    return [codec.dumps(m) for m in codec.loads(body)]
+
+
+def codec_raw(body: bytes) -> bytes:
+    return codec.loads_page(body).raw
+
+
+def per_page(func, bodies: list, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for body in bodies:
+            func(body)
+    return (time.perf_counter() - start) / (rounds * len(bodies)) * 1e6
+
+
+def insert_rate(conn, pages: list) -> float:
+    from libs.db_operations import bulk_upsert_messages
+
+    with conn.transaction(force_rollback=True):
+        start = time.perf_counter()
+        for page in pages:
+            bulk_upsert_messages(conn, page, CHANNEL_ID)
+        elapsed = time.perf_counter() - start
+    return sum(len(page) for page in pages) / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--database', action='store_true', help='Also time bulk_upsert_messages per path')
+    args = parser.parse_args()
+
+    bodies = [make_page(n) for n in range(args.pages)]
+    print('codec backend: {0}, {1:.0f} KiB per page\n'.format(
+        codec.BACKEND, sum(map(len, bodies)) / len(bodies) / 1024,
+    ))
+
+    print('{0:<28} {1:>12}'.format('path', 'us/page'))
+    for name, func in (
+        ('json.loads + json.dumps', stdlib),
+        ('codec loads + dumps', codec_reencode),
+        ('codec loads, raw body', codec_raw),
+    ):
+        print('{0:<28} {1:>12.0f}'.format(name, per_page(func, bodies, args.rounds)))
+
+    if args.database:
+        from libs.db_operations import get_db_conn
+
+        conn = get_db_conn()
+        pages = [codec.loads_page(body) for body in bodies]
+        print('\n{0:<28} {1:>12}'.format('bulk_upsert_messages', 'rows/sec'))
+        print('{0:<28} {1:>12.0f}'.format('list (COPY)', insert_rate(conn, [list(page) for page in pages])))
+        print('{0:<28} {1:>12.0f}'.format('Page (raw body)', insert_rate(conn, pages)))
+        conn.close()
@@ -0,0 +1,242 @@
+"""End to end crawl throughput against a local fake Discord server.
+
+Starts benchmarks/fake_discord.py in this process and runs the real
+services against it and a local database, one after the other:
+
+    refresh_guilds -> refresh_channels -> message_history
+
+Channel cursors are set before the first message after refresh_channels,
+so message_history pages through every channel's full history (instead of
+starting at the newest page). It is stopped once every readable message is
+stored. Each stage reports wall time, requests and 429s (counted by the
+fake server), pages/sec, rows/sec, p50 / p99 request latency and seconds
+waited for rate limits (from the process' metrics endpoint, so missing for
+stages that end before the first scrape) and CPU time per message.
+
+All guild, channel and message rows are deleted first, so point
+DATABASE_URL at a scratch database loaded with db/schema.sql. Run from the
+discord_crawler directory:
+
+    DATABASE_URL=postgres://... python -m benchmarks.bench_e2e --latency-ms 20 --rate-limit 5
+"""
+import argparse
+import os
+import re
+import resource
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Callable, Dict, List, Optional, Tuple
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from benchmarks.fake_discord import FakeDiscordServer, add_arguments, from_arguments
+from libs.db_operations import get_db_conn
+
+
+TOKEN = 'bench-token'
+
+SAMPLE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+# Seconds between metrics scrapes while a stage runs. The last scrape before
+# the process ends is the one reported.
+SCRAPE_INTERVAL = 0.2
+
+
+def reset(conn) -> None:
+    with conn.transaction():
+        conn.execute("""
+            TRUNCATE selfbot, guild, message, channel_stats, channel_stats_daily, channel_crawl_log, attachment
+            RESTART IDENTITY CASCADE
+        """)
+        conn.execute(
+            "INSERT INTO selfbot (username, email, token) VALUES ('bench', 'bench@localhost', %s)",
+            [TOKEN],
+        )
+
+
+def scrape(port: int) -> Optional[Dict[str, List[Tuple[Dict, float]]]]:
+    """Samples of a metrics endpoint by name, or None if it does not answer."""
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:{0}/metrics'.format(port), timeout=1) as resp:
+            text = resp.read().decode()
+    except OSError:
+        return None
+
+    samples: Dict[str, List[Tuple[Dict, float]]] = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples.setdefault(name, []).append((dict(LABEL.findall(labels or '')), float(value)))
+    return samples
+
+
+def total(samples: Optional[Dict], name: str, **labels) -> float:
+    if not samples:
+        return 0
+    return sum(
+        value for sample_labels, value in samples.get(name, [])
+        if all(sample_labels.get(k) == v for k, v in labels.items())
+    )
+
+
+def quantile(samples: Optional[Dict], name: str, q: float) -> Optional[float]:
+    """
+    Quantile of a histogram summed over all its label sets, interpolated
+    within the bucket like PromQL's histogram_quantile.
+    """
+    buckets: Dict[float, float] = {}
+    for labels, value in (samples or {}).get(name + '_bucket', []):
+        le = float(labels['le'])
+        buckets[le] = buckets.get(le, 0) + value
+    if not buckets or not buckets[float('inf')]:
+        return None
+
+    bounds = sorted(buckets)
+    rank = q * buckets[float('inf')]
+    lower, below = 0.0, 0.0
+    for bound in bounds:
+        if buckets[bound] >= rank:
+            if bound == float('inf'):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(buckets[bound] - below, 1)
+        lower, below = bound, buckets[bound]
+    return lower
+
+
+def count_messages(conn) -> int:
+    return conn.execute('SELECT count(*) AS n FROM message').fetchone()['n']
+
+
+def run_stage(
+    fake,
+    name: str,
+    script: str,
+    env: Dict,
+    port: int,
+    conn,
+    done: Optional[Callable[[], bool]] = None,
+    timeout: float = 600,
+) -> Dict:
+    """
+    Run one service until it exits, or until `done` returns True.
+
+    :return: Measurements of the stage
+    """
+    env = dict(env, METRICS_PORT=str(port))
+    messages_before = count_messages(conn)
+    requests_before, rate_limited_before = fake.requests, fake.rate_limited
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    samples = None
+
+    started_at = time.monotonic()
+    proc = subprocess.Popen([sys.executable, script], env=env, stdout=subprocess.DEVNULL)
+    while proc.poll() is None and time.monotonic() - started_at < timeout:
+        samples = scrape(port) or samples
+        if done is not None and done():
+            break
+        time.sleep(SCRAPE_INTERVAL)
+    elapsed = time.monotonic() - started_at
+
+    if proc.poll() is None:
+        samples = scrape(port) or samples
+        proc.send_signal(signal.SIGTERM)
+    proc.wait()
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    messages = count_messages(conn) - messages_before
+    cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+    p50 = quantile(samples, 'discord_crawler_request_seconds', 0.5)
+    p99 = quantile(samples, 'discord_crawler_request_seconds', 0.99)
+
+    return {
+        'stage': name,
+        'seconds': elapsed,
+        'requests': fake.requests - requests_before,
+        'pages': total(samples, 'discord_crawler_pages_total'),
+        'rows': messages,
+        'p50': p50,
+        'p99': p99,
+        'rate_limited': fake.rate_limited - rate_limited_before,
+        'waited': total(samples, 'discord_crawler_rate_limit_wait_seconds_total'),
+        'cpu': cpu,
+        'exit': proc.returncode,
+    }
+
+
+def report(result: Dict) -> None:
+    def ms(value: Optional[float]) -> str:
+        return '{0:.1f}'.format(value * 1000) if value is not None else '-'
+
+    print('{0:<18} {1:>7.2f}s {2:>7.0f} req {3:>8.1f} pages/s {4:>9.0f} rows/s '
+          'p50 {5:>6}ms p99 {6:>6}ms {7:>5} 429s {8:>6.1f}s waited {9:>6.2f}s cpu {10:>5} us/msg'.format(
+              result['stage'],
+              result['seconds'],
+              result['requests'],
+              result['pages'] / result['seconds'],
+              result['rows'] / result['seconds'],
+              ms(result['p50']),
+              ms(result['p99']),
+              result['rate_limited'],
+              result['waited'],
+              result['cpu'],
+              '{0:.0f}'.format(result['cpu'] / result['rows'] * 1e6) if result['rows'] else '-',
+          ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--concurrency', type=int, default=4, help='CRAWL_CONCURRENCY of message_history')
+    parser.add_argument('--metrics-port', type=int, default=9190, help='Port the services serve metrics on')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds before a stage is stopped')
+    args = parser.parse_args()
+
+    fake = from_arguments(args)
+    expected = sum(
+        len(fake.messages[int(channel['id'])])
+        for channels in fake.channels.values()
+        for channel in channels
+        if int(channel['id']) not in fake.forbidden
+    )
+    conn = get_db_conn()
+    reset(conn)
+
+    with FakeDiscordServer(fake) as server:
+        env = dict(
+            os.environ,
+            DISCORD_API_URL=server.base_url,
+            CRAWL_CONCURRENCY=str(args.concurrency),
+            CRAWL_IDLE_SLEEP='0.5',
+        )
+        print('fake server {0} | {1} guilds x {2} channels x {3} messages ({4} forbidden per guild) | '
+              'latency {5}ms | rate limit {6}/{7}s'.format(
+                  server.base_url, args.guilds, args.channels, args.messages, args.forbidden,
+                  args.latency_ms, args.rate_limit or '-', args.rate_window,
+              ))
+
+        results = [
+            run_stage(fake, 'refresh_guilds', 'refresh_guilds.py', env, args.metrics_port, conn, timeout=args.timeout),
+            run_stage(fake, 'refresh_channels', 'refresh_channels.py', env, args.metrics_port, conn, timeout=args.timeout),
+        ]
+
+        # Crawl every channel from its first message.
+        conn.execute('INSERT INTO channel_cursor (channel_id, high_message_id) SELECT id, 1 FROM channel')
+
+        results.append(run_stage(
+            fake, 'message_history', 'message_history.py', env, args.metrics_port, conn,
+            done=lambda: count_messages(conn) >= expected,
+            timeout=args.timeout,
+        ))
+
+    for result in results:
+        report(result)
+        if result['exit']:
+            print('{0} exited with {1}'.format(result['stage'], result['exit']))
+    if results[-1]['rows'] < expected:
+        print('message_history stored {0} of {1} messages before the timeout'.format(results[-1]['rows'], expected))
+    conn.close()
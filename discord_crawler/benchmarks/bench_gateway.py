@@ -0,0 +1,111 @@
+"""REST polling with and without gateway_ingest, under live traffic.
+
+Starts benchmarks/fake_discord.py with messages posted live at --live-rate
+and crawls it twice for --seconds each: first with message_history and
+refresh_channels (re-run every --refresh seconds, which is how polling
+learns about new messages) alone, then with gateway_ingest running as
+well. Channels start with their history stored, so only new messages are
+crawled. Both runs use the same aggressive schedule (CRAWL_MIN_INTERVAL,
+CRAWL_TARGET_MESSAGES), and report requests/sec after the first --warmup
+seconds (catching up and, with the gateway, the one crawl per channel that
+anchors its cursor) and how many readable messages posted during the run
+were still not stored at its end.
+
+All guild, channel and message rows are deleted first, so point
+DATABASE_URL at a scratch database loaded with db/schema.sql. Run from the
+discord_crawler directory:
+
+    DATABASE_URL=postgres://... python -m benchmarks.bench_gateway --live-rate 20
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from benchmarks.bench_e2e import reset
+from benchmarks.fake_discord import FakeDiscordServer, add_arguments, from_arguments
+from libs.db_operations import get_db_conn
+
+
+# Seconds for the last events to be written after a run.
+GRACE = 2
+
+
+def unstored(conn, fake, started_at: float, ended_at: float) -> int:
+    """Readable, undeleted messages posted in the window that are not stored."""
+    ids = [
+        message_id for posted_at, channel_id, message_id in fake.posted
+        if started_at <= posted_at < ended_at
+        and channel_id not in fake.forbidden and message_id not in fake.deleted
+    ]
+    stored = conn.execute('SELECT count(*) AS n FROM message WHERE id = ANY(%s)', [ids]).fetchone()['n']
+    return len(ids) - stored
+
+
+def run(label: str, fake, env: dict, conn, seconds: float, warmup: float, refresh: float, gateway: bool) -> None:
+    procs = []
+    if gateway:
+        procs.append(subprocess.Popen([sys.executable, 'gateway_ingest.py'], env=env, stdout=subprocess.DEVNULL))
+    procs.append(subprocess.Popen([sys.executable, 'message_history.py'], env=env, stdout=subprocess.DEVNULL))
+
+    requests_before = None
+    started_at = time.monotonic()
+    while time.monotonic() - started_at < seconds:
+        if requests_before is None and time.monotonic() - started_at >= warmup:
+            requests_before, measured_at = dict(fake.route_requests), time.monotonic()
+        subprocess.run([sys.executable, 'refresh_channels.py'], env=env, stdout=subprocess.DEVNULL)
+        time.sleep(max(0.0, min(refresh, seconds - (time.monotonic() - started_at))))
+    ended_at = time.monotonic()
+
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        proc.wait()
+    time.sleep(GRACE)
+
+    def rate(route: str) -> float:
+        return (fake.route_requests.get(route, 0) - requests_before.get(route, 0)) / (ended_at - measured_at)
+
+    print('{0:<20} {1:>8.1f} message req/s {2:>6.1f} channel list req/s {3:>6} messages not stored'.format(
+        label, rate('messages'), rate('channels'), unstored(conn, fake, started_at, ended_at),
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--seconds', type=float, default=45, help='Length of each run')
+    parser.add_argument('--warmup', type=float, default=15, help='Seconds of each run not counted in req/s')
+    parser.add_argument('--refresh', type=float, default=2, help='Seconds between refresh_channels runs')
+    parser.set_defaults(latency_ms=5, messages=100, live_rate=20)
+    args = parser.parse_args()
+
+    fake = from_arguments(args)
+    conn = get_db_conn()
+    reset(conn)
+
+    with FakeDiscordServer(fake) as server:
+        env = dict(
+            os.environ,
+            DISCORD_API_URL=server.base_url,
+            DISCORD_GATEWAY_URL=server.gateway_url,
+            CRAWL_IDLE_SLEEP='0.5',
+            CRAWL_MIN_INTERVAL='1',
+            CRAWL_TARGET_MESSAGES='1',
+            GATEWAY_BATCH_SECONDS='0.2',
+        )
+        print('fake server {0} | {1} guilds x {2} channels | {3} messages/sec posted live | latency {4}ms'.format(
+            server.base_url, args.guilds, args.channels, args.live_rate, args.latency_ms,
+        ))
+
+        subprocess.run([sys.executable, 'refresh_guilds.py'], env=env, stdout=subprocess.DEVNULL, check=True)
+        subprocess.run([sys.executable, 'refresh_channels.py'], env=env, stdout=subprocess.DEVNULL, check=True)
+        # History already stored: crawls only pick up new messages.
+        conn.execute('INSERT INTO channel_cursor (channel_id, high_message_id) SELECT id, last_message_id FROM channel')
+
+        run('polling', fake, env, conn, args.seconds, args.warmup, args.refresh, gateway=False)
+        run('polling + gateway', fake, env, conn, args.seconds, args.warmup, args.refresh, gateway=True)
+    conn.close()
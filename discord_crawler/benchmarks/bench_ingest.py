@@ -0,0 +1,54 @@
+"""Rows/sec for upsert_messages (executemany) vs bulk_upsert_messages (COPY).
+
+Every run happens inside a transaction that is rolled back, but use a
+scratch database anyway. Run from the discord_crawler directory:
+
+    DATABASE_URL=postgres://... python -m benchmarks.bench_ingest
+"""
+import argparse
+import os
+import time
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from benchmarks.fake_discord import make_message, make_snowflake
+from libs.db_operations import get_db_conn, upsert_messages, bulk_upsert_messages
+
+
+CHANNEL_ID = make_snowflake(1640995200000)
+
+
+def make_batch(size: int) -> list:
+    return [
+        make_message(CHANNEL_ID, make_snowflake(1640995200000 + i * 1000), i)
+        for i in range(size)
+    ]
+
+
+def run(conn, func, messages: list, duplicates: bool) -> float:
+    with conn.transaction(force_rollback=True):
+        if duplicates:
+            bulk_upsert_messages(conn, messages, CHANNEL_ID)
+        start = time.perf_counter()
+        func(conn, messages, CHANNEL_ID)
+        return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--duplicates', action='store_true', help='Insert every batch twice and time the second pass')
+    args = parser.parse_args()
+
+    conn = get_db_conn()
+    print('{0:>8} {1:>18} {2:>18} {3:>8}'.format('batch', 'executemany r/s', 'COPY r/s', 'speedup'))
+
+    for size in args.sizes:
+        messages = make_batch(size)
+        slow = run(conn, upsert_messages, messages, args.duplicates)
+        fast = run(conn, bulk_upsert_messages, messages, args.duplicates)
+        print('{0:>8} {1:>18.0f} {2:>18.0f} {3:>7.1f}x'.format(
+            size, size / slow, size / fast, slow / fast,
+        ))
+
+    conn.close()
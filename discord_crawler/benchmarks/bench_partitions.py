@@ -0,0 +1,138 @@
+"""Insert rate and per-channel range query latency: heap vs monthly partitions.
+
+Builds a plain `message` table (the layout before partitioning) and a
+partitioned one (create_message_partitions) in two scratch schemas, loads
+the same messages into both through bulk_upsert_messages, then times keyset
+pages and one month counts for random channels. The schemas are dropped
+afterwards. Needs a database migrated to at least the partitioning
+migration. Run from the discord_crawler directory:
+
+    DATABASE_URL=postgres://... python -m benchmarks.bench_partitions
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from benchmarks.fake_discord import make_message
+from libs.db_operations import get_db_conn, bulk_upsert_messages
+from libs.snowflake import datetime_to_snowflake
+
+
+COLUMNS = '''
+    id bigint NOT NULL, raw_data json, channel_id bigint, data jsonb, author_id bigint,
+    sent_at timestamptz, edited_at timestamptz, type smallint, content text,
+    reference_id bigint, attachment_count smallint
+'''
+
+LAYOUTS = {
+    'bench_heap': """
+        CREATE TABLE message ({0});
+        ALTER TABLE message ADD CONSTRAINT message_pkey PRIMARY KEY (id);
+        CREATE INDEX message_channel_id_id_idx ON message (channel_id, id);
+    """.format(COLUMNS),
+    'bench_part': """
+        CREATE TABLE message ({0}) PARTITION BY RANGE (id);
+        ALTER TABLE message ADD CONSTRAINT message_pkey PRIMARY KEY (id);
+        CREATE INDEX message_channel_id_id_idx ON message (channel_id, id);
+        CREATE TABLE message_default PARTITION OF message DEFAULT;
+    """.format(COLUMNS),
+}
+
+
+def connect(schema: str):
+    conn = get_db_conn()
+    conn.execute('SET search_path TO {0}, public'.format(schema))
+    return conn
+
+
+def make_messages(total: int, channels: int, months: int) -> list:
+    """Messages spread evenly over `months` up to now, in id order per batch."""
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(days=30 * months)
+    step = (end - start) / total
+    messages = []
+    for n in range(total):
+        channel_id = 1000 + n % channels
+        message_id = datetime_to_snowflake(start + step * n) | (n & 0x3FFFFF)
+        messages.append(make_message(channel_id, message_id, n))
+    return messages
+
+
+def load(conn, messages: list, batch: int) -> float:
+    start = time.perf_counter()
+    for i in range(0, len(messages), batch):
+        chunk = messages[i:i + batch]
+        bulk_upsert_messages(conn, chunk, int(chunk[0]['channel_id']))
+    return len(messages) / (time.perf_counter() - start)
+
+
+def timed(conn, sql: str, params_list: list) -> tuple:
+    latencies = []
+    for params in params_list:
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    admin = get_db_conn()
+    messages = make_messages(args.messages, args.channels, args.months)
+    lowest, highest = int(messages[0]['id']), int(messages[-1]['id'])
+
+    rng = random.Random(1)
+    month_ids = (highest - lowest) // args.months
+    windows = []
+    for _ in range(args.queries):
+        lo = rng.randrange(lowest, highest - month_ids)
+        windows.append((1000 + rng.randrange(args.channels), lo, lo + month_ids))
+
+    print('{0:<12} {1:>10} {2:>18} {3:>18}'.format(
+        'layout', 'rows/sec', 'page p50/p95 ms', 'month count p50/p95',
+    ))
+
+    try:
+        for schema, ddl in LAYOUTS.items():
+            admin.execute('DROP SCHEMA IF EXISTS {0} CASCADE'.format(schema))
+            admin.execute('CREATE SCHEMA {0}'.format(schema))
+            conn = connect(schema)
+            conn.execute(ddl)
+            if schema == 'bench_part':
+                since = datetime.now(timezone.utc) - timedelta(days=30 * args.months + 31)
+                conn.execute('SELECT create_message_partitions(0, %s)', [since])
+
+            rate = load(conn, messages, args.batch)
+            conn.execute('ANALYZE message')
+
+            page = timed(conn, """
+                SELECT id, data FROM message
+                WHERE channel_id = %s AND id > %s AND id < %s
+                ORDER BY id LIMIT 100
+            """, windows)
+            count = timed(conn, """
+                SELECT count(*) FROM message
+                WHERE channel_id = %s AND id >= %s AND id < %s
+            """, windows)
+
+            print('{0:<12} {1:>10.0f} {2:>8.2f} / {3:<7.2f} {4:>8.2f} / {5:<7.2f}'.format(
+                schema, rate, page[0], page[1], count[0], count[1],
+            ))
+            conn.close()
+    finally:
+        for schema in LAYOUTS:
+            admin.execute('DROP SCHEMA IF EXISTS {0} CASCADE'.format(schema))
+        admin.close()
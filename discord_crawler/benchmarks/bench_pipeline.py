@@ -0,0 +1,113 @@
+"""Messages/sec for crawl_channel writing inline vs through a PageWriter.
+
+Crawls generated channels from a local fake server with injected latency,
+once with every page written before the next is fetched (the old loop) and
+once with libs.pipeline.PageWriter overlapping the two. Messages are
+committed and deleted again afterwards, so use a scratch database. Run from
+the discord_crawler directory:
+
+    DATABASE_URL=postgres://... python -m benchmarks.bench_pipeline --latency-ms 20
+"""
+import argparse
+import os
+import time
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from benchmarks.fake_discord import FakeDiscord, FakeDiscordServer
+from libs.api import DiscordAPI
+from libs.codec import dumps
+from libs.db_operations import get_db_conn
+from libs.pipeline import PageWriter, store_records
+from libs.spool import Record
+from message_history import crawl_channel
+
+
+TOKEN = 'bench-token'
+
+
+class InlineWriter(object):
+    """Writes each page before returning, like crawl_channel used to."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def append(self, channel_id, high_id, low_id=None, payload=b''):
+        with self.conn.transaction():
+            store_records(self.conn, [Record(channel_id, high_id, low_id, payload)])
+
+    def append_update(self, channel_id, update):
+        self.append(channel_id, 0, None, dumps(update))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakePool(object):
+    """Stands in for TokenPool: one token, no guild lookup."""
+
+    def __init__(self, base_url: str):
+        self.api = DiscordAPI(TOKEN)
+        self.api.BASE_URL = base_url + '/{0}'
+
+    def get_messages(self, guild_id, channel_id, after=None):
+        return self.api.get_messages(channel_id, after=after)
+
+
+def cleanup(conn, channel_ids: list) -> None:
+    with conn.transaction():
+        for table in ('message', 'channel_cursor', 'channel_stats', 'channel_stats_daily', 'channel_crawl_log'):
+            conn.execute('DELETE FROM {0} WHERE channel_id = ANY(%s)'.format(table), [channel_ids])
+
+
+def run(label: str, writer, pool: FakePool, fake: FakeDiscord) -> None:
+    start = time.perf_counter()
+    messages = 0
+    for guild_id, channels in fake.channels.items():
+        for channel in channels:
+            row = {
+                'channel_id': int(channel['id']),
+                'guild_id': guild_id,
+                'guild_name': 'bench',
+                'channel_name': channel['name'],
+                'last_message_id': None,
+            }
+            # Start before the first message so every page is crawled.
+            fetched, _ = crawl_channel(pool, row, 1, writer)
+            messages += fetched
+    writer.close()
+    elapsed = time.perf_counter() - start
+    print('{0:<24} {1:>8} messages {2:>7.2f}s {3:>10.0f} messages/sec'.format(
+        label, messages, elapsed, messages / elapsed,
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=2000, help='Messages per channel')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    args = parser.parse_args()
+
+    fake = FakeDiscord(
+        guilds=1,
+        channels_per_guild=args.channels,
+        messages_per_channel=args.messages,
+        latency_ms=args.latency_ms,
+    )
+    channel_ids = [int(c['id']) for chans in fake.channels.values() for c in chans]
+    conn = get_db_conn()
+
+    with FakeDiscordServer(fake) as server:
+        print('fake server {0} | injected latency {1}ms'.format(server.base_url, args.latency_ms))
+        try:
+            cleanup(conn, channel_ids)
+            run('inline', InlineWriter(conn), FakePool(server.base_url), fake)
+            cleanup(conn, channel_ids)
+            run('PageWriter', PageWriter('bench-writer'), FakePool(server.base_url), fake)
+        finally:
+            cleanup(conn, channel_ids)
+    conn.close()
@@ -0,0 +1,684 @@
+"""A local fake of the Discord REST API and gateway for benchmarks.
+
+Serves generated guilds, channels and messages with the same URL layout and
+pagination rules as https://discord.com/api/v10 so the crawler can be pointed
+at it with DISCORD_API_URL. Optionally it enforces per token and route
+rate limits the way Discord does (X-RateLimit-* headers, 429 with
+retry_after), answers some channels with 403 and delays responses.
+
+A gateway on /gateway (point DISCORD_GATEWAY_URL at gateway_url) speaks
+enough of the real protocol for gateway_ingest.py: hello, identify, ready,
+heartbeats and resume with replay of missed events. Messages posted,
+edited and deleted through FakeDiscord, or generated with --live-rate, are
+dispatched to every session and show up in the REST API as well.
+
+With --attachments a share of the messages carries an attachment whose url
+points at /attachments on the same server, a CDN that answers Range
+requests and can cut off a share of its responses halfway (--cdn-cut).
+--attachment-variants limits how many different files there are, so the
+same content is posted many times.
+
+    python -m benchmarks.fake_discord --guilds 2 --latency-ms 20 --rate-limit 5 --live-rate 10
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import WSMsgType, web
+
+
+DISCORD_EPOCH = 1420070400000
+MESSAGE_INTERVAL_MS = 60 * 1000
+
+# User id of the first generated member. Every guild has the same users.
+FIRST_USER_ID = 200000000000000000
+
+# Events a disconnected session keeps for a resume.
+SESSION_BUFFER = 10000
+
+BYTE_RANGE = re.compile(r'bytes=(\d+)-$')
+
+
+def make_snowflake(timestamp_ms: int, sequence: int = 0) -> int:
+    return ((timestamp_ms - DISCORD_EPOCH) << 22) | (sequence & 0xFFF)
+
+
+def make_message(channel_id: int, message_id: int, number: int) -> Dict:
+    """Build a message object shaped like the ones Discord returns."""
+    author_id = 100000000000000000 + number % 50
+    return {
+        'id': str(message_id),
+        'type': 0,
+        'content': 'Message {0} in channel {1}. '.format(number, channel_id) * 3,
+        'channel_id': str(channel_id),
+        'author': {
+            'id': str(author_id),
+            'username': 'user{0}'.format(number % 50),
+            'avatar': 'a1b2c3d4e5f60718293a4b5c6d7e8f90',
+            'discriminator': '0',
+            'public_flags': 0,
+        },
+        'attachments': [],
+        'embeds': [],
+        'mentions': [],
+        'mention_roles': [],
+        'pinned': False,
+        'mention_everyone': False,
+        'tts': False,
+        'timestamp': '2022-11-01T00:00:00.000000+00:00',
+        'edited_timestamp': None,
+        'flags': 0,
+        'components': [],
+    }
+
+
+def make_member(user_id: int, nick: Optional[str] = None) -> Dict:
+    """Build a guild member object shaped like the ones Discord returns."""
+    number = user_id - FIRST_USER_ID
+    return {
+        'user': {
+            'id': str(user_id),
+            'username': 'user{0}'.format(number),
+            'avatar': 'a1b2c3d4e5f60718293a4b5c6d7e8f90',
+            'discriminator': '0',
+            'public_flags': 0,
+        },
+        'nick': nick,
+        'avatar': None,
+        'roles': [],
+        'joined_at': '2022-01-01T00:00:00.000000+00:00',
+        'premium_since': None,
+        'deaf': False,
+        'mute': False,
+        'flags': 0,
+        'pending': False,
+    }
+
+
+class GatewaySession(object):
+    """Events of one gateway session, kept so they can be replayed on resume."""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.sequence = 0
+        self.events: deque = deque(maxlen=SESSION_BUFFER)
+        # Set while a connection is attached: (its loop, its wake-up event, the socket)
+        self.waiter: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Event, web.WebSocketResponse]] = None
+
+
+class FakeDiscord(object):
+    """
+    In-memory guilds, channels and messages.
+
+    Message ids are real snowflakes one minute apart so that cursors, ordering
+    and timestamp decoding behave like production.
+    """
+
+    def __init__(
+        self,
+        guilds: int = 1,
+        channels_per_guild: int = 10,
+        messages_per_channel: int = 1000,
+        latency_ms: float = 0,
+        start_ms: int = 1640995200000,
+        rate_limit: int = 0,
+        rate_window: float = 1.0,
+        forbidden_channels: int = 0,
+        live_rate: float = 0,
+        live_churn: float = 0,
+        members_per_guild: int = 0,
+        attachment_share: float = 0,
+        attachment_kb: int = 64,
+        attachment_variants: int = 0,
+        cdn_cut: float = 0,
+    ):
+        """
+        :param guilds: Guilds every token is a member of
+        :param channels_per_guild: Text channels per guild
+        :param messages_per_channel: Messages per channel
+        :param latency_ms: Mean delay added to every response
+        :param start_ms: Unix time in ms of the first guild, channel and message
+        :param rate_limit: Requests per token, route and major parameter
+            allowed every `rate_window` seconds. 0 disables rate limits.
+        :param rate_window: Seconds of a rate limit window
+        :param forbidden_channels: Channels per guild whose messages answer
+            403 Missing Access
+        :param live_rate: Messages/sec posted while the server runs, see live
+        :param live_churn: Share of live events that edit or delete instead
+        :param members_per_guild: Members listed per guild, generated on
+            request so large guilds cost no memory
+        :param attachment_share: Share of messages with an attachment
+        :param attachment_kb: Size of every attachment
+        :param attachment_variants: Different attachment contents, 0 for
+            a different one per attachment
+        :param cdn_cut: Share of attachment responses cut off halfway
+        """
+        self.latency = latency_ms / 1000
+        self.live_rate = live_rate
+        self.live_churn = live_churn
+        self.members_per_guild = members_per_guild
+        self.attachment_share = attachment_share
+        self.attachment_kb = attachment_kb
+        self.attachment_variants = attachment_variants
+        self.cdn_cut = cdn_cut
+        # Where attachment urls point, set by FakeDiscordServer
+        self.cdn_url = 'http://127.0.0.1:8080'
+        self.cdn_requests = 0
+        self.cdn_bytes = 0
+        self.cdn_cuts = 0
+        self.cdn_active = 0
+        self.cdn_peak = 0
+        # user id: nick, for members renamed since they were generated
+        self.nicks: Dict[int, str] = {}
+        # user ids that left every guild
+        self.left: set = set()
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.guilds: List[Dict] = []
+        self.channels: Dict[int, List[Dict]] = {}
+        self.messages: Dict[int, List[int]] = {}
+        self.forbidden: set = set()
+        # (token, bucket, major): [window reset time, requests left]
+        self.windows: Dict[Tuple, list] = {}
+        self.requests = 0
+        self.route_requests: Dict[str, int] = {}
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, GatewaySession] = {}
+        self.session_ids = itertools.count(1)
+        self.heartbeat_interval_ms = 41250
+        self.channel_guilds: Dict[int, int] = {}
+        self.last_live_id = 0
+        # (time.monotonic(), channel id, message id) of every message posted
+        self.posted: List[Tuple[float, int, int]] = []
+        self.deleted: set = set()
+
+        for g in range(guilds):
+            guild_id = make_snowflake(start_ms, g)
+            self.guilds.append({'id': str(guild_id), 'name': 'guild-{0}'.format(g)})
+            self.channels[guild_id] = []
+
+            for c in range(channels_per_guild):
+                sequence = g * channels_per_guild + c
+                channel_id = make_snowflake(start_ms + 1, sequence)
+                ids = [
+                    make_snowflake(start_ms + (i + 1) * MESSAGE_INTERVAL_MS, sequence)
+                    for i in range(messages_per_channel)
+                ]
+                self.messages[channel_id] = ids
+                self.channel_guilds[channel_id] = guild_id
+                if c < forbidden_channels:
+                    self.forbidden.add(channel_id)
+                self.channels[guild_id].append({
+                    'id': str(channel_id),
+                    'type': 0,
+                    'name': 'channel-{0}'.format(c),
+                    'guild_id': str(guild_id),
+                    'position': c,
+                    'last_message_id': str(ids[-1]) if ids else None,
+                })
+
+    def page(
+        self,
+        channel_id: int,
+        after: Optional[int],
+        limit: int,
+        before: Optional[int] = None,
+    ) -> List[Dict]:
+        """Newest-first page of messages, like the real endpoint."""
+        ids = self.messages.get(channel_id, [])
+
+        if after is not None:
+            start = bisect.bisect_right(ids, after)
+            selected = ids[start:start + limit]
+        elif before is not None:
+            end = bisect.bisect_left(ids, before)
+            selected = ids[max(end - limit, 0):end]
+        else:
+            selected = ids[-limit:]
+
+        return [self.message(channel_id, i, n) for n, i in enumerate(reversed(selected))]
+
+    def message(self, channel_id: int, message_id: int, number: int) -> Dict:
+        """make_message, with an attachment for `attachment_share` of the message ids."""
+        message = make_message(channel_id, message_id, number)
+        if zlib.crc32(message_id.to_bytes(8, 'little')) < self.attachment_share * 2 ** 32:
+            attachment_id = message_id | (1 << 21)
+            if self.attachment_variants:
+                key = zlib.crc32(attachment_id.to_bytes(8, 'little')) % self.attachment_variants
+            else:
+                key = attachment_id
+            message['attachments'] = [{
+                'id': str(attachment_id),
+                'filename': 'file-{0}.bin'.format(key),
+                'size': self.attachment_kb * 1024,
+                'url': '{0}/attachments/{1}/{2}/file-{3}.bin'.format(self.cdn_url, channel_id, attachment_id, key),
+                'proxy_url': '{0}/attachments/{1}/{2}/file-{3}.bin'.format(self.cdn_url, channel_id, attachment_id, key),
+                'content_type': 'application/octet-stream',
+            }]
+        return message
+
+    def attachment_content(self, key: int) -> bytes:
+        """Content of the attachments named file-<key>.bin."""
+        return hashlib.sha256(str(key).encode()).digest() * 32 * self.attachment_kb
+
+    def _dispatch(self, event: str, data: Dict) -> None:
+        """Send an event to every gateway session. Call with the lock held."""
+        for session in self.sessions.values():
+            session.sequence += 1
+            session.events.append((session.sequence, {'op': 0, 's': session.sequence, 't': event, 'd': data}))
+            if session.waiter is not None:
+                loop, wake, _ = session.waiter
+                loop.call_soon_threadsafe(wake.set)
+
+    def post_message(self, channel_id: int) -> Dict:
+        """Add a message to a channel now and dispatch MESSAGE_CREATE. Thread-safe."""
+        with self.lock:
+            ids = self.messages[channel_id]
+            # Unique over all channels, like real snowflakes.
+            message_id = self.last_live_id = max(make_snowflake(int(time.time() * 1000)), self.last_live_id + 1)
+            ids.append(message_id)
+            self.posted.append((time.monotonic(), channel_id, message_id))
+            message = self.message(channel_id, message_id, len(ids))
+            guild_id = self.channel_guilds[channel_id]
+            for channel in self.channels[guild_id]:
+                if int(channel['id']) == channel_id:
+                    channel['last_message_id'] = str(message_id)
+            if channel_id not in self.forbidden:
+                self._dispatch('MESSAGE_CREATE', dict(message, guild_id=str(guild_id)))
+            return message
+
+    def edit_message(self, channel_id: int, message_id: int, content: str) -> None:
+        """Dispatch MESSAGE_UPDATE with the changed fields only. Thread-safe."""
+        with self.lock:
+            self._dispatch('MESSAGE_UPDATE', {
+                'id': str(message_id),
+                'channel_id': str(channel_id),
+                'guild_id': str(self.channel_guilds[channel_id]),
+                'content': content,
+                'edited_timestamp': '2022-11-02T00:00:00.000000+00:00',
+            })
+
+    def delete_message(self, channel_id: int, message_id: int) -> None:
+        """Remove a message and dispatch MESSAGE_DELETE. Thread-safe."""
+        with self.lock:
+            ids = self.messages[channel_id]
+            i = bisect.bisect_left(ids, message_id)
+            if i < len(ids) and ids[i] == message_id:
+                del ids[i]
+            self.deleted.add(message_id)
+            self._dispatch('MESSAGE_DELETE', {
+                'id': str(message_id),
+                'channel_id': str(channel_id),
+                'guild_id': str(self.channel_guilds[channel_id]),
+            })
+
+    def disconnect(self, resumable: bool = True) -> None:
+        """Drop every gateway connection, optionally ending the sessions too. Thread-safe."""
+        with self.lock:
+            for session in self.sessions.values():
+                if session.waiter is not None:
+                    loop, _, ws = session.waiter
+                    asyncio.run_coroutine_threadsafe(ws.close(code=4000), loop)
+            if not resumable:
+                self.sessions.clear()
+
+    async def live(self, rate: float, churn: float = 0.0) -> None:
+        """
+        Post `rate` messages/sec to random channels, forever.
+
+        :param rate: Messages per second over all channels
+        :param churn: Share of events that edit or delete a recent message
+        """
+        channel_ids = list(self.messages)
+        while True:
+            await asyncio.sleep(random.expovariate(rate))
+            channel_id = random.choice(channel_ids)
+            ids = self.messages[channel_id]
+            if ids and random.random() < churn:
+                message_id = ids[-random.randint(1, min(len(ids), 20))]
+                if random.random() < 0.5:
+                    self.edit_message(channel_id, message_id, 'Edited {0}'.format(message_id))
+                else:
+                    self.delete_message(channel_id, message_id)
+            else:
+                self.post_message(channel_id)
+
+    def _rate_limit(self, request: web.Request, bucket: str, major: Optional[int]) -> Tuple[Dict, float]:
+        """
+        Count a request against its rate limit window.
+
+        :return: Tuple of (X-RateLimit-* headers, seconds to retry after if
+            the request is over the limit, else 0)
+        """
+        if not self.rate_limit:
+            return {}, 0
+
+        now = time.monotonic()
+        key = (request.headers.get('authorization'), bucket, major)
+        window = self.windows.get(key)
+        if window is None or now >= window[0]:
+            window = self.windows[key] = [now + self.rate_window, self.rate_limit]
+
+        retry_after = 0
+        if window[1] > 0:
+            window[1] -= 1
+        else:
+            retry_after = window[0] - now
+            self.rate_limited += 1
+
+        return {
+            'X-RateLimit-Bucket': bucket,
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(window[1]),
+            'X-RateLimit-Reset-After': '{0:.3f}'.format(window[0] - now),
+        }, retry_after
+
+    async def _respond(
+        self,
+        request: web.Request,
+        bucket: str,
+        major: Optional[int],
+        body,
+        status: int = 200,
+    ) -> web.Response:
+        """Delay, apply the rate limit and send `body` (called for it if callable)."""
+        self.requests += 1
+        self.route_requests[bucket] = self.route_requests.get(bucket, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        headers, retry_after = self._rate_limit(request, bucket, major)
+        if retry_after:
+            headers['Retry-After'] = str(int(retry_after) + 1)
+            return web.json_response(
+                {'message': 'You are being rate limited.', 'retry_after': round(retry_after, 3), 'global': False},
+                status=429,
+                headers=headers,
+            )
+
+        return web.json_response(body() if callable(body) else body, status=status, headers=headers)
+
+    async def get_guilds(self, request: web.Request) -> web.Response:
+        after = int(request.query.get('after', 0))
+        limit = min(int(request.query.get('limit', 200)), 200)
+        guilds = [g for g in self.guilds if int(g['id']) > after][:limit]
+        return await self._respond(request, 'guilds', None, guilds)
+
+    async def get_channels(self, request: web.Request) -> web.Response:
+        guild_id = int(request.match_info['guild_id'])
+        if guild_id not in self.channels:
+            return await self._respond(request, 'channels', guild_id, {'message': 'Unknown Guild', 'code': 10004}, 404)
+        return await self._respond(request, 'channels', guild_id, self.channels[guild_id])
+
+    def member_page(self, after: int, limit: int) -> List[Dict]:
+        """Members by ascending user id, like the real endpoint."""
+        members = []
+        user_id = max(after + 1, FIRST_USER_ID)
+        while len(members) < limit and user_id < FIRST_USER_ID + self.members_per_guild:
+            if user_id not in self.left:
+                members.append(make_member(user_id, self.nicks.get(user_id)))
+            user_id += 1
+        return members
+
+    async def get_members(self, request: web.Request) -> web.Response:
+        guild_id = int(request.match_info['guild_id'])
+        if guild_id not in self.channels:
+            return await self._respond(request, 'members', guild_id, {'message': 'Unknown Guild', 'code': 10004}, 404)
+
+        after = int(request.query.get('after', 0))
+        limit = min(int(request.query.get('limit', 1)), 1000)
+        return await self._respond(request, 'members', guild_id, lambda: self.member_page(after, limit))
+
+    async def get_messages(self, request: web.Request) -> web.Response:
+        channel_id = int(request.match_info['channel_id'])
+        if channel_id not in self.messages:
+            return await self._respond(request, 'messages', channel_id, {'message': 'Unknown Channel', 'code': 10003}, 404)
+        if channel_id in self.forbidden:
+            return await self._respond(request, 'messages', channel_id, {'message': 'Missing Access', 'code': 50001}, 403)
+
+        after = request.query.get('after')
+        before = request.query.get('before')
+        limit = min(int(request.query.get('limit', 50)), 100)
+        return await self._respond(request, 'messages', channel_id, lambda: self.page(
+            channel_id,
+            int(after) if after is not None else None,
+            limit,
+            before=int(before) if before is not None else None,
+        ))
+
+    async def get_attachment(self, request: web.Request) -> web.StreamResponse:
+        body = self.attachment_content(int(request.match_info['key']))
+        self.cdn_requests += 1
+        self.cdn_active += 1
+        self.cdn_peak = max(self.cdn_peak, self.cdn_active)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+            start, status, headers = 0, 200, {'Accept-Ranges': 'bytes'}
+            match = BYTE_RANGE.match(request.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                if start >= len(body):
+                    return web.Response(status=416, headers={'Content-Range': 'bytes */{0}'.format(len(body))})
+                status = 206
+                headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, len(body) - 1, len(body))
+
+            part = body[start:]
+            resp = web.StreamResponse(status=status, headers=headers)
+            resp.content_length = len(part)
+            resp.content_type = 'application/octet-stream'
+            await resp.prepare(request)
+            if random.random() < self.cdn_cut:
+                self.cdn_cuts += 1
+                await resp.write(part[:len(part) // 2])
+                self.cdn_bytes += len(part) // 2
+                request.transport.close()
+                return resp
+
+            await resp.write(part)
+            self.cdn_bytes += len(part)
+            await resp.write_eof()
+            return resp
+        finally:
+            self.cdn_active -= 1
+
+    async def _send_events(self, ws: web.WebSocketResponse, session: GatewaySession, after: int) -> None:
+        """Send the session's events after sequence `after`, then each new one."""
+        loop, wake, _ = session.waiter
+        while not ws.closed:
+            with self.lock:
+                pending = [payload for sequence, payload in session.events if sequence > after]
+            for payload in pending:
+                await ws.send_str(json.dumps(payload))
+                after = payload['s']
+            await wake.wait()
+            wake.clear()
+
+    def _attach(self, session: GatewaySession, ws: web.WebSocketResponse, event: str, data: Dict) -> None:
+        """Queue READY or RESUMED and make `ws` the session's connection. Call with the lock held."""
+        if session.waiter is not None:
+            asyncio.ensure_future(session.waiter[2].close(code=4000))
+        session.waiter = (asyncio.get_running_loop(), asyncio.Event(), ws)
+        session.sequence += 1
+        session.events.append((session.sequence, {'op': 0, 's': session.sequence, 't': event, 'd': data}))
+        session.waiter[1].set()
+
+    async def gateway(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        await ws.send_str(json.dumps({'op': 10, 'd': {'heartbeat_interval': self.heartbeat_interval_ms}}))
+        session: Optional[GatewaySession] = None
+        sender: Optional[asyncio.Task] = None
+
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                payload = json.loads(msg.data)
+                op, data = payload.get('op'), payload.get('d')
+
+                if op == 1:
+                    await ws.send_str(json.dumps({'op': 11}))
+                elif op == 2 and session is None:
+                    if not data.get('token'):
+                        await ws.close(code=4004)
+                        break
+                    with self.lock:
+                        session = GatewaySession(str(next(self.session_ids)))
+                        self.sessions[session.session_id] = session
+                        self._attach(session, ws, 'READY', {
+                            'v': 10,
+                            'session_id': session.session_id,
+                            'resume_gateway_url': 'ws://{0}/gateway'.format(request.host),
+                            'user': {'id': '1', 'username': 'fake'},
+                            'guilds': [{'id': guild['id']} for guild in self.guilds],
+                        })
+                    sender = asyncio.ensure_future(self._send_events(ws, session, 0))
+                elif op == 6 and session is None:
+                    with self.lock:
+                        session = self.sessions.get(data.get('session_id'))
+                        seq = data.get('seq') or 0
+                        if session is None or seq > session.sequence or \
+                                (session.events and session.events[0][0] > seq + 1):
+                            session = None
+                        else:
+                            self._attach(session, ws, 'RESUMED', {})
+                    if session is None:
+                        await ws.send_str(json.dumps({'op': 9, 'd': False}))
+                    else:
+                        sender = asyncio.ensure_future(self._send_events(ws, session, seq))
+        finally:
+            if sender is not None:
+                sender.cancel()
+            with self.lock:
+                if session is not None and session.waiter is not None and session.waiter[2] is ws:
+                    session.waiter = None
+        return ws
+
+    async def _start_live(self, app: web.Application) -> None:
+        if self.live_rate:
+            app['live'] = asyncio.ensure_future(self.live(self.live_rate, self.live_churn))
+
+    async def _stop_live(self, app: web.Application) -> None:
+        if 'live' in app:
+            app['live'].cancel()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.on_startup.append(self._start_live)
+        app.on_cleanup.append(self._stop_live)
+        app.add_routes([
+            web.get('/gateway', self.gateway),
+            web.get('/gateway/', self.gateway),
+            web.get('/api/v10/users/@me/guilds', self.get_guilds),
+            web.get('/api/v10/guilds/{guild_id}/channels', self.get_channels),
+            web.get('/api/v10/guilds/{guild_id}/members', self.get_members),
+            web.get('/api/v10/channels/{channel_id}/messages', self.get_messages),
+            web.get(r'/attachments/{channel_id}/{attachment_id}/file-{key:\d+}.bin', self.get_attachment),
+        ])
+        return app
+
+
+class FakeDiscordServer(object):
+    """Runs a FakeDiscord app on a background thread with its own event loop."""
+
+    def __init__(self, fake: FakeDiscord, host: str = '127.0.0.1', port: int = 0):
+        self.fake = fake
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.runner: Optional[web.AppRunner] = None
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return 'http://{0}:{1}/api/v10'.format(self.host, self.port)
+
+    @property
+    def gateway_url(self) -> str:
+        return 'ws://{0}:{1}/gateway?v=10&encoding=json'.format(self.host, self.port)
+
+    async def _start(self) -> None:
+        self.runner = web.AppRunner(self.fake.app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.fake.cdn_url = 'http://{0}:{1}'.format(self.host, self.port)
+
+    def start(self) -> 'FakeDiscordServer':
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        return self
+
+    def stop(self) -> None:
+        self.fake.disconnect(resumable=False)
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def __enter__(self) -> 'FakeDiscordServer':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options shaping a FakeDiscord, shared with the benchmarks that start one."""
+    parser.add_argument('--guilds', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=10, help='Channels per guild')
+    parser.add_argument('--messages', type=int, default=1000, help='Messages per channel')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Mean delay of every response')
+    parser.add_argument('--rate-limit', type=int, default=0, help='Requests per route and window, 0 for none')
+    parser.add_argument('--rate-window', type=float, default=1.0, help='Seconds of a rate limit window')
+    parser.add_argument('--forbidden', type=int, default=0, help='Channels per guild answering 403')
+    parser.add_argument('--members', type=int, default=0, help='Members per guild')
+    parser.add_argument('--live-rate', type=float, default=0, help='Messages/sec posted while running')
+    parser.add_argument('--live-churn', type=float, default=0, help='Share of live events editing or deleting')
+    parser.add_argument('--attachments', type=float, default=0, help='Share of messages with an attachment')
+    parser.add_argument('--attachment-kb', type=int, default=64, help='Size of every attachment')
+    parser.add_argument('--attachment-variants', type=int, default=0, help='Different attachment contents, 0 for all')
+    parser.add_argument('--cdn-cut', type=float, default=0, help='Share of attachment responses cut off halfway')
+
+
+def from_arguments(args: argparse.Namespace) -> FakeDiscord:
+    return FakeDiscord(
+        guilds=args.guilds,
+        channels_per_guild=args.channels,
+        messages_per_channel=args.messages,
+        latency_ms=args.latency_ms,
+        rate_limit=args.rate_limit,
+        rate_window=args.rate_window,
+        forbidden_channels=args.forbidden,
+        live_rate=args.live_rate,
+        live_churn=args.live_churn,
+        members_per_guild=args.members,
+        attachment_share=args.attachments,
+        attachment_kb=args.attachment_kb,
+        attachment_variants=args.attachment_variants,
+        cdn_cut=args.cdn_cut,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    fake = from_arguments(args)
+    fake.cdn_url = 'http://127.0.0.1:{0}'.format(args.port)
+    web.run_app(fake.app(), host='127.0.0.1', port=args.port)
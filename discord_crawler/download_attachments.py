@@ -0,0 +1,219 @@
+"""Download the attachments of stored messages into a content addressed store.
+
+Attachments are queued in the `attachment` table by the statement that
+inserts their message (MESSAGE_STATS_SQL), so every crawler and
+gateway_ingest feed the queue. This claims due attachments and downloads
+ATTACHMENT_CONCURRENCY of them at once, at most ATTACHMENT_HOST_CONCURRENCY
+against one host:
+
+    ATTACHMENT_DIR=/data/attachments python download_attachments.py
+
+Files are stored under ATTACHMENT_DIR by the SHA-256 of their content
+(libs/blobstore.py), so a file posted again is kept once, and the hash is
+written to attachment.sha256. A download that is cut off continues where it
+stopped (libs/download.py). Failed downloads are retried with a growing
+delay, up to ATTACHMENT_MAX_ATTEMPTS attempts; expired or deleted links are
+not retried. Several downloaders can share the queue. Resuming needs the
+partial file though, which only the host that started the download has.
+"""
+
+import logging.config
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Deque, Dict, List, Tuple
+
+import psycopg
+import requests
+from psycopg.rows import Row
+
+import settings
+from libs import metrics
+from libs.blobstore import BlobStore
+from libs.db_operations import (
+    get_db_conn,
+    claim_attachments,
+    finish_attachments,
+    fail_attachment,
+    release_attachments,
+)
+from libs.download import DownloadError, HostLimits, fetch, get_session, host_of
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+# Seconds to wait when nothing is queued or the database is unreachable.
+IDLE_SLEEP = 1.0
+
+# Seconds between progress lines.
+REPORT_INTERVAL = 60
+
+# Seconds before the first retry of a failed download, doubled with every
+# attempt up to MAX_RETRY_DELAY.
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 6 * 3600
+
+
+def download(
+    session: requests.Session,
+    store: BlobStore,
+    attachment: Row,
+    stop: threading.Event,
+) -> Tuple[bytes, int, bool]:
+    """
+    Download one attachment into the store.
+
+    :param session: See libs.download.get_session
+    :param store: Where to keep the file
+    :param attachment: Claimed attachment row
+    :param stop: Set to abort the download
+    :return: Tuple of (SHA-256 digest, size, whether the content is new to
+        the store)
+    :raises DownloadError: The download failed
+    """
+    if attachment['size'] is not None and attachment['size'] > settings.ATTACHMENT_MAX_BYTES:
+        raise DownloadError('{0} bytes, more than ATTACHMENT_MAX_BYTES'.format(attachment['size']), retry=False)
+
+    partial = store.partial_path(attachment['id'])
+    try:
+        digest, size = fetch(session, attachment['url'], partial, attachment['size'], stop=stop)
+        return digest, size, store.commit(partial, digest)
+    except OSError as e:
+        # The store's disk, not the download.
+        raise DownloadError('{0}: {1}'.format(type(e).__name__, e)) from e
+
+
+def record_failure(db_conn: psycopg.Connection, store: BlobStore, attachment: Row, error: DownloadError) -> str:
+    """
+    Schedule the next attempt of a failed download, or give it up.
+
+    :return: 'retry' or 'failed'
+    """
+    if error.retry and attachment['attempts'] < settings.ATTACHMENT_MAX_ATTEMPTS:
+        delay = min(RETRY_DELAY * 2 ** (attachment['attempts'] - 1), MAX_RETRY_DELAY)
+        fail_attachment(db_conn, attachment['id'], str(error), retry_in=delay)
+        logger.debug('Attachment {0} failed, retrying in {1}s: {2}'.format(attachment['id'], delay, error))
+        return 'retry'
+
+    fail_attachment(db_conn, attachment['id'], str(error))
+    store.discard(store.partial_path(attachment['id']))
+    logger.warning('Giving up attachment {0} of message {1} after {2} attempts: {3}'.format(
+        attachment['id'], attachment['message_id'], attachment['attempts'], error,
+    ))
+    return 'failed'
+
+
+if __name__ == '__main__':
+
+    if not settings.ATTACHMENT_DIR:
+        logger.critical('Set ATTACHMENT_DIR to the directory attachments are stored in.')
+        exit(1)
+
+    # SIGTERM is handled like Ctrl-C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    metrics.serve()
+
+    store = BlobStore(settings.ATTACHMENT_DIR)
+    session = get_session(settings.ATTACHMENT_HOST_CONCURRENCY)
+    limits = HostLimits(settings.ATTACHMENT_HOST_CONCURRENCY)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=settings.ATTACHMENT_CONCURRENCY, thread_name_prefix='download')
+
+    # Claimed attachments waiting for a free slot of their host, and the
+    # ones downloading. Twice the pool is claimed so the pool stays busy
+    # while some hosts are at their limit.
+    waiting: Deque[Row] = deque()
+    running: Dict[Future, Row] = {}
+    finished: List[Tuple[int, bytes, int]] = []
+    failed: List[Tuple[Row, DownloadError]] = []
+    counts = {'stored': 0, 'duplicate': 0, 'retry': 0, 'failed': 0}
+    db_conn = None
+    reported_at = time.monotonic()
+    logger.info('Downloading attachments to {0}'.format(settings.ATTACHMENT_DIR))
+
+    try:
+        while True:
+            try:
+                if db_conn is None or db_conn.broken:
+                    db_conn = get_db_conn()
+
+                finish_attachments(db_conn, finished)
+                finished = []
+                while failed:
+                    result = record_failure(db_conn, store, *failed[-1])
+                    failed.pop()
+                    counts[result] += 1
+                    metrics.ATTACHMENTS.inc(result)
+
+                room = 2 * settings.ATTACHMENT_CONCURRENCY - len(waiting) - len(running)
+                if room > 0:
+                    waiting.extend(claim_attachments(db_conn, room, settings.ATTACHMENT_CLAIM_TTL))
+            except psycopg.Error:
+                logger.exception('Could not update the attachment queue, retrying')
+
+            for attachment in list(waiting):
+                if len(running) >= settings.ATTACHMENT_CONCURRENCY:
+                    break
+                if limits.acquire(host_of(attachment['url'])):
+                    waiting.remove(attachment)
+                    running[executor.submit(download, session, store, attachment, stop)] = attachment
+
+            if not running:
+                time.sleep(IDLE_SLEEP)
+                continue
+
+            done, _ = wait(running, timeout=IDLE_SLEEP, return_when=FIRST_COMPLETED)
+            for future in done:
+                attachment = running.pop(future)
+                limits.release(host_of(attachment['url']))
+                try:
+                    digest, size, new = future.result()
+                except DownloadError as e:
+                    failed.append((attachment, e))
+                    continue
+                finished.append((attachment['id'], digest, size))
+                result = 'stored' if new else 'duplicate'
+                counts[result] += 1
+                metrics.ATTACHMENTS.inc(result)
+
+            if time.monotonic() - reported_at >= REPORT_INTERVAL:
+                logger.info('{0} stored, {1} duplicates, {2} to retry, {3} failed'.format(
+                    counts['stored'], counts['duplicate'], counts['retry'], counts['failed'],
+                ))
+                reported_at = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+
+    # Abort the downloads in progress. Their partial files are kept, so the
+    # next attempt continues them.
+    stop.set()
+    executor.shutdown(wait=True)
+    unfinished = [attachment['id'] for attachment in waiting]
+    for future, attachment in running.items():
+        if future.exception() is None:
+            digest, size, _ = future.result()
+            finished.append((attachment['id'], digest, size))
+        else:
+            unfinished.append(attachment['id'])
+
+    try:
+        if db_conn is None or db_conn.broken:
+            db_conn = get_db_conn()
+        finish_attachments(db_conn, finished)
+        for attachment, error in failed:
+            counts[record_failure(db_conn, store, attachment, error)] += 1
+        release_attachments(db_conn, unfinished)
+        db_conn.close()
+    except psycopg.Error as e:
+        logger.warning('Could not hand back {0} attachments, they are retried once their claim expires: {1}'.format(
+            len(unfinished), e,
+        ))
+
+    logger.info('{0} stored, {1} duplicates, {2} to retry, {3} failed'.format(
+        counts['stored'], counts['duplicate'], counts['retry'], counts['failed'],
+    ))
+    print('DONE')
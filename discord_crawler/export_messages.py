@@ -0,0 +1,340 @@
+"""Export stored messages to Parquet or NDJSON files, one set per channel and month.
+
+Streams each channel through a server-side cursor in id (snowflake) order,
+so memory use does not grow with the table. Files are laid out as
+
+    <out>/<guild id>/<channel id>/<YYYY-MM>/part-<first message id>.<ext>
+
+Parquet files hold the typed message columns, guild_id and the message
+object as JSON (`data`) and need pyarrow. NDJSON files hold one message
+object per line. The lowest and highest exported id of every channel are
+kept in <out>/_export_state.json (Parquet readers skip files starting with
+`_`), so running the export again into the same directory only writes what
+is new: messages after the highest id, and older history the crawler has
+stored since (channel_stats.first_message_id below the lowest id). Part
+names come from their first message id, so a part that is written again
+after an interrupted run replaces the old one instead of duplicating it.
+
+    python export_messages.py --out /data/export
+    python export_messages.py --out /data/export --format ndjson --guild 123 --guild 456
+
+Point --database-url at a replica to keep the load off the crawler database.
+"""
+
+import abc
+import argparse
+import glob
+import json
+import logging.config
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import psycopg
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import settings
+from libs.db_operations import (
+    get_db_conn,
+    get_export_channels,
+    iter_channel_messages,
+    EXPORT_COLUMNS,
+)
+from libs.snowflake import snowflake_to_datetime, datetime_to_snowflake
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+STATE_FILE = '_export_state.json'
+
+
+def parquet_schema():
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('guild_id', pyarrow.int64()),
+        ('channel_id', pyarrow.int64()),
+        ('author_id', pyarrow.int64()),
+        ('sent_at', pyarrow.timestamp('us', tz='UTC')),
+        ('edited_at', pyarrow.timestamp('us', tz='UTC')),
+        ('type', pyarrow.int16()),
+        ('content', pyarrow.string()),
+        ('reference_id', pyarrow.int64()),
+        ('attachment_count', pyarrow.int16()),
+        ('data', pyarrow.string()),
+    ])
+
+
+class Part(abc.ABC):
+    """
+    One output file. Written under a temporary name and renamed on close,
+    so readers never see a half written part.
+    """
+
+    extension = ''
+
+    def __init__(self, directory: str, guild_id: int, first_id: int):
+        self.guild_id = guild_id
+        self.path = os.path.join(directory, 'part-{0}.{1}'.format(first_id, self.extension))
+        self.tmp_path = self.path + '.tmp'
+        self.rows = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @abc.abstractmethod
+    def write(self, rows: List[tuple]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def _close_file(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self._close_file()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self) -> None:
+        self._close_file()
+        os.remove(self.tmp_path)
+
+
+class NdjsonPart(Part):
+    extension = 'ndjson'
+
+    def __init__(self, directory: str, guild_id: int, first_id: int):
+        super().__init__(directory, guild_id, first_id)
+        self.file = open(self.tmp_path, 'w', encoding='utf-8')
+        self.data = EXPORT_COLUMNS.index('data')
+
+    def write(self, rows: List[tuple]) -> None:
+        # data is JSON text already. raw_data keeps the formatting it was
+        # stored with, which may span lines.
+        self.file.writelines(row[self.data].replace('\n', ' ') + '\n' for row in rows)
+        self.rows += len(rows)
+
+    def _close_file(self) -> None:
+        self.file.close()
+
+
+class ParquetPart(Part):
+    extension = 'parquet'
+
+    def __init__(self, directory: str, guild_id: int, first_id: int):
+        super().__init__(directory, guild_id, first_id)
+        self.schema = parquet_schema()
+        self.writer = pyarrow.parquet.ParquetWriter(self.tmp_path, self.schema, compression='zstd')
+
+    def write(self, rows: List[tuple]) -> None:
+        columns = dict(zip(EXPORT_COLUMNS, zip(*rows)))
+        columns['guild_id'] = [self.guild_id] * len(rows)
+
+        # One row group per batch.
+        self.writer.write_table(pyarrow.table(
+            {name: list(columns[name]) for name in self.schema.names},
+            schema=self.schema,
+        ))
+        self.rows += len(rows)
+
+    def _close_file(self) -> None:
+        self.writer.close()
+
+
+FORMATS = {'parquet': ParquetPart, 'ndjson': NdjsonPart}
+
+
+def load_state(out: str) -> Dict[str, dict]:
+    """
+    Exported range of every channel, keyed by channel id.
+
+    :return: Dict of channel id to {'low': lowest id, 'high': highest id}.
+        Entries written before ranges were tracked are a bare highest id
+    """
+    path = os.path.join(out, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['channels']
+
+
+def save_state(out: str, channels: Dict[str, dict]) -> None:
+    path = os.path.join(out, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'channels': channels}, f)
+    os.replace(path + '.tmp', path)
+
+
+def lowest_part(out: str, guild_id: int, channel_id: int) -> int:
+    """
+    First message id of the oldest part on disk for a channel. Used for
+    state entries that only recorded the highest id.
+
+    :return: Lowest part id, or 0 if there are no parts
+    """
+    pattern = os.path.join(out, str(guild_id), str(channel_id), '*', 'part-*.*')
+    ids = [int(os.path.basename(path)[5:].split('.')[0]) for path in glob.glob(pattern)
+           if not path.endswith('.tmp')]
+    return min(ids, default=0)
+
+
+def pending_ranges(channel: dict, exported: Optional[dict]) -> List[Tuple[int, Optional[int]]]:
+    """
+    Id ranges of a channel that are stored but not exported yet.
+
+    :param channel: Row from get_export_channels
+    :param exported: The channel's state entry, None if never exported
+    :return: List of (after, before) bounds, before None for no limit
+    """
+    if exported is None:
+        return [(0, None)]
+
+    ranges = []
+    if channel['first_message_id'] < exported['low']:
+        ranges.append((0, exported['low']))
+    if channel['last_message_id'] > exported['high']:
+        ranges.append((exported['high'], None))
+    return ranges
+
+
+def month_range(message_id: int) -> Tuple[str, int]:
+    """
+    Month a message was sent in and the first id of the following month.
+
+    :return: Tuple of ('YYYY-MM', first id of the next month)
+    """
+    sent = snowflake_to_datetime(message_id)
+    next_month = datetime(sent.year + sent.month // 12, sent.month % 12 + 1, 1, tzinfo=timezone.utc)
+    return sent.strftime('%Y-%m'), datetime_to_snowflake(next_month)
+
+
+def export_channel(
+    db_conn: psycopg.Connection,
+    part_class: type,
+    out: str,
+    guild_id: int,
+    channel_id: int,
+    after: int,
+    before: Optional[int],
+    batch: int,
+    file_rows: int,
+) -> Tuple[int, Optional[int], Optional[int]]:
+    """
+    Write a channel's messages between `after` and `before` into monthly
+    parts.
+
+    :return: Tuple of (messages written, first id written, last id written),
+        the ids None if nothing was written
+    """
+    part: Optional[Part] = None
+    month_end = 0
+    written = 0
+    first_id = last_id = None
+
+    try:
+        for rows in iter_channel_messages(db_conn, channel_id, after, before, batch):
+            if first_id is None:
+                first_id = rows[0][0]
+
+            start = 0
+            while start < len(rows):
+                part_id = rows[start][0]
+
+                if part is None or part_id >= month_end or part.rows >= file_rows:
+                    if part is not None:
+                        part.close()
+                        part = None
+                    month, month_end = month_range(part_id)
+                    directory = os.path.join(out, str(guild_id), str(channel_id), month)
+                    part = part_class(directory, guild_id, part_id)
+
+                # Rows up to the end of the batch, the month or the part.
+                end = start + 1
+                limit = min(len(rows), start + file_rows - part.rows)
+                while end < limit and rows[end][0] < month_end:
+                    end += 1
+
+                part.write(rows[start:end])
+                written += end - start
+                last_id = rows[end - 1][0]
+                start = end
+
+        if part is not None:
+            part.close()
+            part = None
+    except BaseException:
+        # The state still points before the unfinished part.
+        if part is not None:
+            part.discard()
+        raise
+
+    return written, first_id, last_id
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--out', required=True, help='Output directory')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='parquet')
+    parser.add_argument('--guild', type=int, action='append', help='Only this guild. Repeatable')
+    parser.add_argument('--channel', type=int, action='append', help='Only this channel. Repeatable')
+    parser.add_argument('--batch', type=int, default=10000, help='Rows fetched and written at a time')
+    parser.add_argument('--file-rows', type=int, default=1000000, help='Start a new part after this many rows')
+    parser.add_argument('--database-url', help='Database to export from. Default DATABASE_URL')
+    args = parser.parse_args()
+
+    if args.format == 'parquet' and pyarrow is None:
+        logger.critical('Parquet export needs pyarrow: pip install pyarrow')
+        exit(1)
+
+    os.makedirs(args.out, exist_ok=True)
+    state = load_state(args.out)
+    db_conn = get_db_conn(args.database_url)
+    started_at = time.monotonic()
+    total = 0
+
+    channels = get_export_channels(db_conn, args.guild, args.channel)
+    for channel in channels:
+        key = str(channel['channel_id'])
+        if isinstance(state.get(key), int):
+            state[key] = {
+                'low': lowest_part(args.out, channel['guild_id'], channel['channel_id']),
+                'high': state[key],
+            }
+
+    pending = [c for c in channels if pending_ranges(c, state.get(str(c['channel_id'])))]
+    logger.info('{0} of {1} channels have messages to export'.format(len(pending), len(channels)))
+
+    try:
+        for channel in pending:
+            key = str(channel['channel_id'])
+            written = 0
+            for after, before in pending_ranges(channel, state.get(key)):
+                count, first_id, last_id = export_channel(
+                    db_conn,
+                    FORMATS[args.format],
+                    args.out,
+                    channel['guild_id'],
+                    channel['channel_id'],
+                    after,
+                    before,
+                    args.batch,
+                    args.file_rows,
+                )
+                if count:
+                    exported = state.setdefault(key, {'low': first_id, 'high': last_id})
+                    exported['low'] = min(exported['low'], first_id)
+                    exported['high'] = max(exported['high'], last_id)
+                    save_state(args.out, state)
+                written += count
+            total += written
+            logger.info('Channel {0}: {1} messages'.format(channel['channel_id'], written))
+    except KeyboardInterrupt:
+        logger.info('Interrupted. Run again to continue')
+
+    logger.info('Exported {0} messages in {1:.0f}s'.format(total, time.monotonic() - started_at))
+    db_conn.close()
+    print('DONE')
@@ -0,0 +1,60 @@
+"""Receive new, edited and deleted messages from the Discord gateway.
+
+Connects every selfbot to the gateway and stores its message events in
+micro-batches (libs/gateway.py). Channels the gateway keeps up to date have
+their cursors moved along, so message_history only crawls them to fill the
+gaps left by disconnects and restarts. Run it next to message_history:
+
+    python gateway_ingest.py
+"""
+
+import asyncio
+import logging.config
+import signal
+
+import settings
+from libs import metrics
+from libs.db_operations import get_db_conn, get_selfbots, create_message_partitions
+from libs.gateway import EventWriter, GatewayClient
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+async def ingest(clients) -> None:
+    try:
+        await asyncio.gather(*(client.run() for client in clients))
+    finally:
+        await asyncio.gather(*(client.close() for client in clients))
+
+
+if __name__ == '__main__':
+
+    logger.info('Starting up...')
+    db_conn = get_db_conn()
+    selfbots = get_selfbots(db_conn)
+
+    if not selfbots:
+        logger.critical('No selfbot tokens. Add them to the database.')
+        exit(1)
+
+    # Messages of the current month need their partition.
+    create_message_partitions(db_conn, settings.MESSAGE_PARTITIONS_AHEAD)
+    db_conn.close()
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    metrics.serve()
+
+    writer = EventWriter()
+    clients = [GatewayClient(sb['token'], sb['username'], writer.add) for sb in selfbots]
+    logger.info('Connecting {0} selfbots to {1}'.format(len(clients), settings.GATEWAY_URL))
+
+    try:
+        asyncio.run(ingest(clients))
+    except KeyboardInterrupt:
+        pass
+
+    logger.info('Writing the last events...')
+    writer.close()
+    print('DONE')
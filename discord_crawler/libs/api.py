@@ -1,13 +1,28 @@
-from typing import Union, List, Dict, Optional
+import asyncio
+import time
+from typing import Union, List, Dict, Optional, Mapping
 import settings
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
 import logging.config
 
+from libs.codec import loads, loads_page
+from libs.metrics import REQUEST_SECONDS, RESPONSES
+from libs.ratelimit import get_limiter
+
 logging.config.dictConfig(settings.DEFAULT_LOGGING)
 logger = logging.getLogger(__name__)
 
 
 MESSAGE_LIMIT = 100
+GUILD_LIMIT = 200
+MEMBER_LIMIT = 1000
+
+# Connection pools are shared by every client using the same token so
+# keep-alive connections survive across DiscordAPI instances.
+_sessions: Dict[str, requests.Session] = {}
+_async_sessions: Dict[str, aiohttp.ClientSession] = {}
 
 
 class DiscordAPIException(Exception):
@@ -18,9 +33,86 @@ class DiscordAPI429(Exception):
     pass
 
 
+def get_session(token: str) -> requests.Session:
+    """
+    Get the pooled requests session for a token, creating it on first use.
+
+    :param token: selfbot token
+    :return: A requests Session with a keep-alive connection pool
+    """
+    session = _sessions.get(token)
+
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=settings.HTTP_MAX_CONNECTIONS,
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _sessions[token] = session
+
+    return session
+
+
+def get_async_session(token: str) -> aiohttp.ClientSession:
+    """
+    Get the pooled aiohttp session for a token, creating it on first use.
+
+    Must be called from inside a running event loop.
+
+    :param token: selfbot token
+    :return: An aiohttp ClientSession with a keep-alive connection pool
+    """
+    session = _async_sessions.get(token)
+
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=settings.HTTP_MAX_CONNECTIONS,
+            limit_per_host=settings.HTTP_MAX_CONNECTIONS,
+            keepalive_timeout=60,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=settings.HTTP_TIMEOUT),
+            auto_decompress=True,
+        )
+        _async_sessions[token] = session
+
+    return session
+
+
+async def close_async_sessions() -> None:
+    """Close every pooled aiohttp session. Call before the event loop exits."""
+    while _async_sessions:
+        _, session = _async_sessions.popitem()
+        await session.close()
+
+
+class AsyncResponse(object):
+    """The parts of an aiohttp response we keep once the body is read."""
+
+    def __init__(self, status_code: int, headers: Mapping, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self) -> Union[List[Dict], Dict, None]:
+        return loads(self.content)
+
+
+def _rate_limit_body(resp) -> Dict:
+    """Decode a 429 body. Cloudflare bans come back as html, not json."""
+    try:
+        body = resp.json()
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
 class DiscordAPI(object):
 
-    def __init__(self, token: str = None):
+    def __init__(self, token: str = None, name: str = None):
         if not token:
             raise DiscordAPIException('Token required')
         self.TOKEN = token
@@ -28,62 +120,128 @@ class DiscordAPI(object):
         self.HEADERS = {
             'User-Agent': settings.USER_AGENT,
             'authorization': '{0}'.format(self.TOKEN),
+            'Accept-Encoding': 'gzip, deflate',
         }
         self.VERBOSE = settings.VERBOSE
+        self.session = get_session(self.TOKEN)
+        self.limiter = get_limiter(self.TOKEN, name)
 
     def _get(
         self, url: str = None,
         params: Dict = None,
+        route: str = None,
+        major: int = None,
     ) -> Optional[requests.models.Response]:
+        """
+        GET a url, waiting out rate limits instead of tripping them.
 
+        :param url: Full url
+        :param params: Query string parameters
+        :param route: Route template used to find the rate limit bucket
+        :param major: The route's major parameter (channel_id / guild_id)
+        :return: The response
+        :raises DiscordAPI429: If still rate limited after
+            RATE_LIMIT_MAX_RETRIES retries.
+        """
         if params is None:
             params = {}
         if not url:
             raise DiscordAPIException('"url" is a required parameter ')
 
-        resp = requests.get(url, headers=self.HEADERS, params=params)
+        route = route or url
+        body = {}
+
+        for _ in range(settings.RATE_LIMIT_MAX_RETRIES + 1):
+            delay = self.limiter.reserve(route, major)
+            while delay > 0:
+                self.limiter.record_wait(delay)
+                time.sleep(delay)
+                delay = self.limiter.reserve(route, major)
+
+            started_at = time.monotonic()
+            resp = self.session.get(
+                url,
+                headers=self.HEADERS,
+                params=params,
+                timeout=settings.HTTP_TIMEOUT,
+            )
+            REQUEST_SECONDS.observe(route, self.limiter.name, value=time.monotonic() - started_at)
+            RESPONSES.inc(route, self.limiter.name, str(resp.status_code))
 
-        if self.VERBOSE:
-            logger.debug("""Response headers: {0}""".format(resp.headers))
+            if self.VERBOSE:
+                logger.debug("""Response headers: {0}""".format(resp.headers))
 
-        if resp.status_code == 429:
-            raise DiscordAPI429(resp.json())
+            body = _rate_limit_body(resp) if resp.status_code == 429 else None
+            retry_after = self.limiter.update(route, major, resp.headers, resp.status_code, body)
 
-        return resp
+            if resp.status_code != 429:
+                return resp
 
-    def get_guilds(self) -> Union[List[Dict], Dict, None]:
+            logger.warning('Rate limited on {0} ({1}). Retrying in {2}s'.format(
+                route, self.limiter.name, retry_after,
+            ))
+            self.limiter.record_wait(retry_after)
+            time.sleep(retry_after)
+
+        raise DiscordAPI429(body)
+
+    def get_guilds(self, after: int = None) -> Union[List[Dict], Dict, None]:
+        """
+        One page of the guilds the token is a member of, GUILD_LIMIT at most.
+
+        :param after: Only return guilds with a higher id
+        :return:
+        """
         url = self.BASE_URL.format('users/@me/guilds')
-        return self._get(url).json()
+        params = {'limit': GUILD_LIMIT}
+        if after is not None:
+            params['after'] = after
+        return loads(self._get(url, params=params, route='users/@me/guilds').content)
 
-    def get_channels(self, guild_id: int) -> Union[List[Dict], Dict, None]:
+    def get_channels(self, guild_id: int, json_response: bool = True) -> Union[List[Dict], Dict, None]:
+        """
+        :param guild_id:
+        :param json_response: Return decoded json (True) or the Response
+        :return:
+        """
         channel_url = 'guilds/{0}/channels'.format(guild_id)
         url = self.BASE_URL.format(channel_url)
-        return self._get(url).json()
+        ret = self._get(url, route='guilds/{guild_id}/channels', major=guild_id)
+
+        if json_response:
+            return loads(ret.content)
 
-    def get_members(self, guild_id: int) -> Union[List[Dict], Dict, None]:
+        return ret
+
+    def get_members(self, guild_id: int, after: int = None) -> Union[List[Dict], Dict, None]:
         """
-        Get the members from a guild given the URL
+        One page of the members of a guild, MEMBER_LIMIT at most, by user id.
 
         :param guild_id:
+        :param after: Only return members with a higher user id
         :return:
-        :raises requests.exceptions.JSONDecodeError: If the response body does not
-            contain valid json.
+        :raises ValueError: If the response body does not contain valid json.
         """
         members_url = 'guilds/{0}/members'.format(guild_id)
         url = self.BASE_URL.format(members_url)
-        return self._get(url).json()
+        params = {'limit': MEMBER_LIMIT}
+        if after is not None:
+            params['after'] = after
+        return loads(self._get(url, params=params, route='guilds/{guild_id}/members', major=guild_id).content)
 
     def get_messages(
         self,
         channel_id: int,
         after: int = None,
         json_response: bool = True,
+        before: int = None,
     ) -> Union[List[Dict], Dict, None]:
         """
 
         :param channel_id:
-        :param after:
+        :param after: Only return messages newer than this snowflake
         :param json_response:
+        :param before: Only return messages older than this snowflake
         :return:
         """
 
@@ -97,14 +255,158 @@ class DiscordAPI(object):
         if after is not None:
             params['after'] = after
 
-        logger.debug(f'Fetching messages snowflake channel_id: {channel_id} | message_id: {after}')
+        if before is not None:
+            params['before'] = before
+
+        logger.debug(
+            f'Fetching messages snowflake channel_id: {channel_id} | message_id: {after} | before: {before}'
+        )
 
         if self.VERBOSE == True:
             logger.debug(f"\nrequests.get(\n\t'{url}',\n\tparams={params},\n\theaders={self.HEADERS}\n)\n")
 
-        ret = self._get(url, params=params)
+        ret = self._get(
+            url,
+            params=params,
+            route='channels/{channel_id}/messages',
+            major=channel_id,
+        )
+
+        if json_response:
+            return loads_page(ret.content)
+
+        return ret
+
+
+class AsyncDiscordAPI(object):
+    """
+    asyncio twin of DiscordAPI.
+
+    Every instance for the same token shares one aiohttp connection pool, so a
+    single process can keep hundreds of requests in flight over keep-alive
+    connections. Methods and return values mirror DiscordAPI.
+    """
+
+    def __init__(self, token: str = None, name: str = None):
+        if not token:
+            raise DiscordAPIException('Token required')
+        self.TOKEN = token
+        self.BASE_URL = settings.BASE_URL
+        self.HEADERS = {
+            'User-Agent': settings.USER_AGENT,
+            'authorization': '{0}'.format(self.TOKEN),
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        self.VERBOSE = settings.VERBOSE
+        self.limiter = get_limiter(self.TOKEN, name)
+
+    async def _get(
+        self, url: str = None,
+        params: Dict = None,
+        route: str = None,
+        major: int = None,
+    ) -> AsyncResponse:
+
+        if params is None:
+            params = {}
+        if not url:
+            raise DiscordAPIException('"url" is a required parameter ')
+
+        route = route or url
+        body = {}
+        session = get_async_session(self.TOKEN)
+
+        for _ in range(settings.RATE_LIMIT_MAX_RETRIES + 1):
+            delay = self.limiter.reserve(route, major)
+            while delay > 0:
+                self.limiter.record_wait(delay)
+                await asyncio.sleep(delay)
+                delay = self.limiter.reserve(route, major)
+
+            started_at = time.monotonic()
+            async with session.get(url, headers=self.HEADERS, params=params) as resp:
+                ret = AsyncResponse(resp.status, resp.headers, await resp.read())
+            REQUEST_SECONDS.observe(route, self.limiter.name, value=time.monotonic() - started_at)
+            RESPONSES.inc(route, self.limiter.name, str(ret.status_code))
+
+            if self.VERBOSE:
+                logger.debug("""Response headers: {0}""".format(ret.headers))
+
+            body = _rate_limit_body(ret) if ret.status_code == 429 else None
+            retry_after = self.limiter.update(route, major, ret.headers, ret.status_code, body)
+
+            if ret.status_code != 429:
+                return ret
+
+            logger.warning('Rate limited on {0} ({1}). Retrying in {2}s'.format(
+                route, self.limiter.name, retry_after,
+            ))
+            self.limiter.record_wait(retry_after)
+            await asyncio.sleep(retry_after)
+
+        raise DiscordAPI429(body)
+
+    async def get_guilds(self, after: int = None) -> Union[List[Dict], Dict, None]:
+        url = self.BASE_URL.format('users/@me/guilds')
+        params = {'limit': GUILD_LIMIT}
+        if after is not None:
+            params['after'] = after
+        return (await self._get(url, params=params, route='users/@me/guilds')).json()
+
+    async def get_channels(self, guild_id: int) -> Union[List[Dict], Dict, None]:
+        channel_url = 'guilds/{0}/channels'.format(guild_id)
+        url = self.BASE_URL.format(channel_url)
+        return (await self._get(url, route='guilds/{guild_id}/channels', major=guild_id)).json()
+
+    async def get_members(self, guild_id: int, after: int = None) -> Union[List[Dict], Dict, None]:
+        members_url = 'guilds/{0}/members'.format(guild_id)
+        url = self.BASE_URL.format(members_url)
+        params = {'limit': MEMBER_LIMIT}
+        if after is not None:
+            params['after'] = after
+        return (await self._get(url, params=params, route='guilds/{guild_id}/members', major=guild_id)).json()
+
+    async def get_messages(
+        self,
+        channel_id: int,
+        after: int = None,
+        json_response: bool = True,
+        before: int = None,
+    ) -> Union[List[Dict], Dict, AsyncResponse, None]:
+        """
+        Fetch one page of messages from a channel.
+
+        :param channel_id: Discord channel snowflake
+        :param after: Only return messages newer than this snowflake
+        :param json_response: Return decoded json (True) or the AsyncResponse
+        :param before: Only return messages older than this snowflake
+        :return:
+        """
+        messages_url = 'channels/{0}/messages'.format(channel_id)
+        url = self.BASE_URL.format(messages_url)
+
+        params = {
+            'limit': MESSAGE_LIMIT
+        }
+
+        if after is not None:
+            params['after'] = after
+
+        if before is not None:
+            params['before'] = before
+
+        logger.debug(
+            f'Fetching messages snowflake channel_id: {channel_id} | message_id: {after} | before: {before}'
+        )
+
+        ret = await self._get(
+            url,
+            params=params,
+            route='channels/{channel_id}/messages',
+            major=channel_id,
+        )
 
         if json_response:
-            return ret.json()
+            return loads_page(ret.content)
 
         return ret
@@ -0,0 +1,75 @@
+"""Content addressed file store for downloaded attachments.
+
+Files are named by the SHA-256 of their content, two directory levels deep:
+
+    <root>/ab/cd/abcd0123...   (64 hex digits)
+
+so a file posted many times is stored once. Downloads in progress live in
+<root>/partial/<attachment id> and are moved into place once complete. The
+move is a hard link within one file system, so a blob is either missing or
+whole. A partial file left by an interrupted download is continued from
+where it ends (see libs/download.py).
+"""
+import os
+
+
+class BlobStore(object):
+
+    def __init__(self, root: str):
+        """
+        :param root: Directory of the store, created if missing
+        """
+        self.root = root
+        self.partial_dir = os.path.join(root, 'partial')
+        os.makedirs(self.partial_dir, exist_ok=True)
+
+    def path(self, digest: bytes) -> str:
+        """
+        :param digest: SHA-256 of the content
+        :return: Path of the blob
+        """
+        name = digest.hex()
+        return os.path.join(self.root, name[:2], name[2:4], name)
+
+    def partial_path(self, attachment_id: int) -> str:
+        """
+        :param attachment_id: Attachment being downloaded
+        :return: Path its download is written to
+        """
+        return os.path.join(self.partial_dir, str(attachment_id))
+
+    def __contains__(self, digest: bytes) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def commit(self, partial: str, digest: bytes) -> bool:
+        """
+        Move a complete download into the store under its digest. If the
+        store has the content already the download is deleted instead.
+
+        :param partial: Path of the downloaded file
+        :param digest: SHA-256 of its content
+        :return: True if the blob is new, False for a duplicate
+        """
+        path = self.path(digest)
+        new = False
+        if not os.path.exists(path):
+            with open(partial, 'rb') as f:
+                os.fsync(f.fileno())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                # Unlike a rename, a link never replaces the blob of another
+                # download of the same content that finished meanwhile.
+                os.link(partial, path)
+                new = True
+            except FileExistsError:
+                pass
+
+        os.unlink(partial)
+        return new
+
+    def discard(self, partial: str) -> None:
+        """Delete a partial download that cannot be continued."""
+        try:
+            os.unlink(partial)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,85 @@
+"""JSON encoding and decoding for the API clients and the database.
+
+Uses orjson when it is installed and the standard library otherwise. Both
+DiscordAPI and db_operations go through here (db_operations also hands it to
+psycopg), so swapping the backend changes every JSON round trip at once.
+
+Message pages keep the bytes they were decoded from (Page.raw), so they can
+be written to the database as they came off the wire instead of being
+encoded again message by message.
+"""
+import json
+from typing import Any, Dict, List, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+class Page(list):
+    """
+    Decoded list of messages plus the response body it came from.
+
+    Behaves exactly like the list Discord returned. `raw` is the JSON array
+    as bytes. Do not modify the list, `raw` would no longer match it.
+    """
+
+    def __init__(self, messages: List[Dict], raw: bytes = None):
+        super().__init__(messages)
+        self.raw = raw
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Decode JSON.
+
+    :param data: JSON text as bytes or str
+    :return: The decoded object
+    :raises ValueError: If data is not valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Encode an object as compact UTF-8 JSON.
+
+    :param obj: Object to encode
+    :return: JSON as bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def loads_page(data: bytes) -> Union[Page, Dict]:
+    """
+    Decode a message page response.
+
+    :param data: Response body
+    :return: Page of messages, or the error dict Discord returned instead
+    """
+    decoded = loads(data)
+
+    if isinstance(decoded, list):
+        return Page(decoded, raw=data)
+
+    return decoded
+
+
+def dumps_page(messages: List[Dict]) -> bytes:
+    """
+    Encode a message page, reusing the response body of a Page.
+
+    :param messages: Page or list of messages
+    :return: JSON array as bytes
+    """
+    if isinstance(messages, Page) and messages.raw is not None:
+        return messages.raw
+    return dumps(list(messages))
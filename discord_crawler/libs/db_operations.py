@@ -1,17 +1,26 @@
 import datetime
-import json
-from typing import Optional, List, Dict
+import hashlib
+from typing import Iterator, Optional, List, Dict, Tuple
 
 import psycopg
-from psycopg.rows import dict_row, Row
+from psycopg.rows import dict_row, tuple_row, Row
+from psycopg.types.json import Json, Jsonb, set_json_dumps, set_json_loads
 import os
+import socket
+import threading
 import logging.config
 import settings
+from libs.codec import Page, dumps, loads
 
 
 logging.config.dictConfig(settings.DEFAULT_LOGGING)
 logger = logging.getLogger(__name__)
 
+# Json/Jsonb parameters and json columns go through the same codec as the
+# API client.
+set_json_dumps(dumps)
+set_json_loads(loads)
+
 
 def get_db_conn(
     url: Optional[str] = None,
@@ -45,7 +54,7 @@ def get_selfbots(conn: psycopg.Connection) -> Optional[List[Row]]:
     """
     with conn.cursor() as cur:
         selfbots = cur.execute("""
-            SELECT id, username, token 
+            SELECT id, username, token, crawl_concurrency
                 FROM selfbot
         """).fetchall()
         if selfbots:
@@ -54,29 +63,191 @@ def get_selfbots(conn: psycopg.Connection) -> Optional[List[Row]]:
     return None
 
 
-def upsert_guild(conn: psycopg.Connection, guild: Dict, selfbot_id: int) -> None:
+# Fields left out of payload_hash. A partial guild from users/@me/guilds
+# describes the selfbot's membership in these, so they differ per selfbot;
+# a channel's last_message_id moves with every message and has its own
+# column.
+GUILD_HASH_IGNORE = ('owner', 'permissions', 'permissions_new')
+CHANNEL_HASH_IGNORE = ('last_message_id',)
+
+
+def payload_hash(obj: Dict, ignore: Tuple[str, ...] = ()) -> bytes:
     """
-    Upsert a guild into the database.
+    Hash of an API object, to tell whether the stored copy changed.
+
+    :param obj: Guild or channel object
+    :param ignore: Top level fields to leave out
+    :return: 16 byte digest
+    """
+    kept = {key: obj[key] for key in sorted(obj) if key not in ignore}
+    return hashlib.blake2b(dumps(kept), digest_size=16).digest()
 
-    Conflicts / duplicates are ignored.
+
+def upsert_guild(conn: psycopg.Connection, guild: Dict, selfbot_id: int) -> None:
+    """
+    Upsert a guild into the database. See upsert_guilds.
 
     :param conn: Database handle
     :param guild: Guild object
     :param selfbot_id: primary key on the selfbot database row
     :return: None
     """
+    upsert_guilds(conn, [guild], selfbot_id)
+
+
+def upsert_guilds(conn: psycopg.Connection, guilds: List[Dict], selfbot_id: int) -> int:
+    """
+    Upsert guilds into the database in one statement.
+
+    New guilds are assigned to `selfbot_id`. Existing guilds are only
+    rewritten when their payload_hash changed (renamed, new icon, ...) and
+    keep their selfbot.
+
+    :param conn: Database handle
+    :param guilds: Guild objects
+    :param selfbot_id: primary key on the selfbot database row
+    :return: Guilds inserted or changed
+    """
+    if not guilds:
+        return 0
+
     with conn.cursor() as cur:
         cur.execute("""
-            INSERT INTO guild (id, name, raw_data, selfbot_id) 
-            VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING 
+            INSERT INTO guild AS g (id, name, raw_data, payload_hash, selfbot_id)
+            SELECT t.id, t.name, t.raw_data, t.payload_hash, %s
+            FROM unnest(%s::bigint[], %s::text[], %s::json[], %s::bytea[])
+                AS t (id, name, raw_data, payload_hash)
+            ON CONFLICT (id) DO UPDATE SET
+                name = EXCLUDED.name,
+                raw_data = EXCLUDED.raw_data,
+                payload_hash = EXCLUDED.payload_hash
+            WHERE g.payload_hash IS DISTINCT FROM EXCLUDED.payload_hash
             """,
             [
-                guild['id'],
-                guild['name'],
-                json.dumps(guild),
                 selfbot_id,
+                [int(g['id']) for g in guilds],
+                [g.get('name') for g in guilds],
+                [Json(g) for g in guilds],
+                [payload_hash(g, GUILD_HASH_IGNORE) for g in guilds],
             ]
         )
+        return cur.rowcount
+
+
+def upsert_guild_memberships(
+    conn: psycopg.Connection,
+    selfbot_id: int,
+    guild_ids: List[int],
+) -> None:
+    """
+    Record the guilds a selfbot is a member of.
+
+    Guilds missing from `guild_ids` are marked inactive for the selfbot: it
+    left them or was removed.
+
+    :param conn: Database handle
+    :param selfbot_id: primary key on the selfbot database row
+    :param guild_ids: Every guild the selfbot's token can see
+    :return: None
+    """
+    with conn.transaction(), conn.cursor() as cur:
+        cur.executemany("""
+            INSERT INTO guild_selfbot (guild_id, selfbot_id)
+            VALUES (%s, %s)
+            ON CONFLICT (guild_id, selfbot_id) DO UPDATE SET
+                active = true,
+                last_seen_at = now()
+            """,
+            [(guild_id, selfbot_id) for guild_id in guild_ids],
+        )
+        cur.execute("""
+            UPDATE guild_selfbot SET active = false
+            WHERE selfbot_id = %s AND active AND guild_id <> ALL(%s)
+            """,
+            [selfbot_id, list(guild_ids)],
+        )
+
+
+def get_guild_memberships(conn: psycopg.Connection) -> List[Row]:
+    """
+    Fetch which selfbots can crawl which guild.
+
+    :param conn: Database handle
+    :return: Rows of guild_id, selfbot_id and home (the selfbot is the one
+        guild.selfbot_id assigns the guild to) for active memberships
+    """
+    with conn.cursor() as cur:
+        return cur.execute("""
+            SELECT gs.guild_id, gs.selfbot_id, gs.selfbot_id = g.selfbot_id AS home
+            FROM guild_selfbot gs
+            JOIN guild g ON g.id = gs.guild_id
+            WHERE gs.active AND g.crawl_enabled
+        """).fetchall()
+
+
+def get_guild_placement(conn: psycopg.Connection) -> List[Row]:
+    """
+    Fetch what the placement planner needs for every crawled guild.
+
+    :param conn: Database handle
+    :return: Rows of id, name, selfbot_id, crawl_priority, members (active
+        member selfbot ids) and message_rates (of the crawled channels)
+    """
+    with conn.cursor() as cur:
+        return cur.execute("""
+            SELECT
+                g.id,
+                g.name,
+                g.selfbot_id,
+                g.crawl_priority,
+                array(
+                    SELECT gs.selfbot_id FROM guild_selfbot gs
+                    WHERE gs.guild_id = g.id AND gs.active
+                    ORDER BY gs.selfbot_id
+                ) AS members,
+                array(
+                    SELECT c.message_rate FROM channel c
+                    WHERE c.guild_id = g.id AND c.crawl_enabled AND c.deleted_at IS NULL
+                ) AS message_rates
+            FROM guild g
+            WHERE g.crawl_enabled
+            ORDER BY g.id
+        """).fetchall()
+
+
+def assign_guild_selfbots(conn: psycopg.Connection, assignment: Dict[int, int]) -> int:
+    """
+    Write a placement plan to guild.selfbot_id.
+
+    :param conn: Database handle
+    :param assignment: guild id -> selfbot id
+    :return: Number of guilds that moved
+    """
+    with conn.transaction(), conn.cursor() as cur:
+        cur.executemany("""
+            UPDATE guild SET selfbot_id = %(selfbot_id)s
+            WHERE id = %(guild_id)s AND selfbot_id IS DISTINCT FROM %(selfbot_id)s
+            """,
+            [{'guild_id': guild_id, 'selfbot_id': selfbot_id} for guild_id, selfbot_id in assignment.items()],
+        )
+        return cur.rowcount
+
+
+def deactivate_selfbot_memberships(conn: psycopg.Connection, selfbot_id: int) -> None:
+    """
+    Take a selfbot out of every guild, e.g. after Discord rejected its token.
+
+    refresh_guilds.py adds it back once the token works again.
+
+    :param conn: Database handle
+    :param selfbot_id: primary key on the selfbot database row
+    :return: None
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            'UPDATE guild_selfbot SET active = false WHERE selfbot_id = %s AND active',
+            [selfbot_id],
+        )
 
 
 def upsert_channel(
@@ -102,7 +273,7 @@ def upsert_channel(
             [
                 channel['id'],
                 channel['name'],
-                json.dumps(channel),
+                Json(channel),
                 guild_id,
             ]
         )
@@ -111,29 +282,264 @@ def upsert_channels(
     conn: psycopg.Connection,
     channels: List,
     guild_id: int,
-) -> None:
+) -> Dict[str, int]:
     """
-    Upsert a list of channel objects into the database.
+    Sync the channels of a guild with its channel list, in one statement.
 
-    Conflicts / duplicates are ignored.
+    Rows are only written when something changed: the payload_hash
+    (renamed, moved, new permission overwrites, ...) or last_message_id.
+    changed_at records a payload_hash change; last_update is the channel's
+    last crawl and is left alone. Channels of the guild missing from the list get deleted_at, which stops
+    them being crawled; if one comes back it is cleared. crawl_enabled is
+    left alone either way, so a channel disabled by an operator or a 403
+    stays disabled when it reappears.
 
     :param conn: database handle
-    :param channels: List of Discord API channel objects
+    :param channels: Every channel object of the guild, as listed by the API
     :param guild_id: Primary key on the Guild database table
-    :return: None
+    :return: Dict of created, changed (payload_hash differs) and deleted
+        channel counts
     """
     if not channels:
+        # An empty list is more likely an API hiccup than a guild without
+        # channels, so nothing is marked deleted.
         logger.warning('No channels to upsert! guild_id: {0}'.format(guild_id))
-        return
+        return {'created': 0, 'changed': 0, 'deleted': 0}
 
     if not guild_id:
         raise Exception('guild_id is required.')
 
     logger.debug('Got {0} Channels. Upserting'.format(len(channels)))
-    payload = [(c['id'], c['name'], json.dumps(c), guild_id) for c in channels]
-    sql = 'INSERT INTO channel (id, name, raw_data, guild_id) VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING'
+    ids = [int(c['id']) for c in channels]
+
     with conn.cursor() as cur:
-        cur.executemany(sql, payload)
+        return cur.execute("""
+            WITH written AS (
+                INSERT INTO channel AS c (id, name, raw_data, payload_hash, guild_id, last_message_id)
+                SELECT t.id, t.name, t.raw_data, t.payload_hash, %(guild_id)s, t.last_message_id
+                FROM unnest(%(ids)s::bigint[], %(names)s::text[], %(raw)s::json[], %(hashes)s::bytea[], %(last)s::bigint[])
+                    AS t (id, name, raw_data, payload_hash, last_message_id)
+                ON CONFLICT (id) DO UPDATE SET
+                    name = EXCLUDED.name,
+                    raw_data = EXCLUDED.raw_data,
+                    payload_hash = EXCLUDED.payload_hash,
+                    last_message_id = EXCLUDED.last_message_id,
+                    changed_at = CASE
+                        WHEN c.payload_hash IS DISTINCT FROM EXCLUDED.payload_hash THEN now()
+                        ELSE c.changed_at
+                    END,
+                    deleted_at = NULL
+                WHERE c.payload_hash IS DISTINCT FROM EXCLUDED.payload_hash
+                    OR c.last_message_id IS DISTINCT FROM EXCLUDED.last_message_id
+                    OR c.deleted_at IS NOT NULL
+                RETURNING xmax = 0 AS created, c.changed_at = now() AS changed
+            ),
+            deleted AS (
+                UPDATE channel SET deleted_at = now()
+                WHERE guild_id = %(guild_id)s AND deleted_at IS NULL AND id <> ALL(%(ids)s::bigint[])
+                RETURNING id
+            )
+            SELECT
+                count(*) FILTER (WHERE created) AS created,
+                count(*) FILTER (WHERE changed AND NOT created) AS changed,
+                (SELECT count(*) FROM deleted) AS deleted
+            FROM written
+            """,
+            {
+                'guild_id': guild_id,
+                'ids': ids,
+                'names': [c.get('name') for c in channels],
+                'raw': [Json(c) for c in channels],
+                'hashes': [payload_hash(c, CHANNEL_HASH_IGNORE) for c in channels],
+                'last': [int(c['last_message_id']) if c.get('last_message_id') else None for c in channels],
+            }
+        ).fetchone()
+
+
+def start_member_stage(conn: psycopg.Connection) -> None:
+    """
+    Empty this connection's staging table for the member list of one guild,
+    creating it on first use. Fill it with stage_members, then call
+    merge_members.
+
+    :param conn: Database handle, used for the whole guild
+    :return: None
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS member_stage (
+                user_id bigint,
+                data jsonb,
+                payload_hash bytea
+            )
+        """)
+        cur.execute('TRUNCATE member_stage')
+
+
+def stage_members(conn: psycopg.Connection, members: List[Dict]) -> None:
+    """
+    Stream one page of guild members into the staging table with a binary
+    COPY.
+
+    :param conn: Database handle the stage was started on
+    :param members: Guild member objects
+    :return: None
+    """
+    with conn.cursor() as cur:
+        with cur.copy('COPY member_stage (user_id, data, payload_hash) FROM STDIN (FORMAT BINARY)') as copy:
+            copy.set_types(['int8', 'jsonb', 'bytea'])
+            for member in members:
+                copy.write_row((int(member['user']['id']), Jsonb(member), payload_hash(member)))
+
+
+def merge_members(conn: psycopg.Connection, guild_id: int) -> Dict[str, int]:
+    """
+    Sync the members of a guild with its complete, staged member list, in
+    one transaction.
+
+    Only new members and members whose payload_hash changed are written.
+    Members of the guild missing from the list get left_at, which is
+    cleared again if they come back.
+
+    :param conn: Database handle the stage was filled on
+    :param guild_id: Primary key on the Guild database table
+    :return: Dict of created, changed and left member counts
+    """
+    with conn.transaction():
+        with conn.cursor() as cur:
+            # Temporary tables are never analyzed automatically.
+            cur.execute('ANALYZE member_stage')
+            counts = cur.execute("""
+                WITH staged AS (
+                    SELECT DISTINCT ON (user_id) user_id, data, payload_hash
+                    FROM member_stage
+                    ORDER BY user_id
+                ), written AS (
+                    INSERT INTO member AS m (guild_id, user_id, username, nick, joined_at, data, payload_hash)
+                    SELECT
+                        %(guild_id)s,
+                        s.user_id,
+                        s.data -> 'user' ->> 'username',
+                        s.data ->> 'nick',
+                        (s.data ->> 'joined_at')::timestamptz,
+                        s.data,
+                        s.payload_hash
+                    FROM staged s
+                    ON CONFLICT (guild_id, user_id) DO UPDATE SET
+                        username = EXCLUDED.username,
+                        nick = EXCLUDED.nick,
+                        joined_at = EXCLUDED.joined_at,
+                        data = EXCLUDED.data,
+                        payload_hash = EXCLUDED.payload_hash,
+                        last_update = CASE
+                            WHEN m.payload_hash IS DISTINCT FROM EXCLUDED.payload_hash THEN now()
+                            ELSE m.last_update
+                        END,
+                        left_at = NULL
+                    WHERE m.payload_hash IS DISTINCT FROM EXCLUDED.payload_hash OR m.left_at IS NOT NULL
+                    RETURNING xmax = 0 AS created
+                ), gone AS (
+                    UPDATE member m SET left_at = now()
+                    WHERE m.guild_id = %(guild_id)s AND m.left_at IS NULL
+                        AND NOT EXISTS (SELECT 1 FROM member_stage s WHERE s.user_id = m.user_id)
+                    RETURNING 1
+                )
+                SELECT
+                    count(*) FILTER (WHERE created) AS created,
+                    count(*) FILTER (WHERE NOT created) AS changed,
+                    (SELECT count(*) FROM gone) AS left
+                FROM written
+            """, {'guild_id': guild_id}).fetchone()
+            cur.execute('UPDATE guild SET members_refreshed_at = now() WHERE id = %s', [guild_id])
+            cur.execute('TRUNCATE member_stage')
+
+    return counts
+
+
+# Typed message columns and how each is read from the message object. `{0}`
+# is the jsonb expression holding the message. The ingest merge and
+# convert_message_batch both use these, so rows look the same either way.
+MESSAGE_COLUMNS = (
+    ('author_id', "({0} -> 'author' ->> 'id')::bigint"),
+    ('sent_at', "({0} ->> 'timestamp')::timestamptz"),
+    ('edited_at', "({0} ->> 'edited_timestamp')::timestamptz"),
+    ('type', "({0} ->> 'type')::smallint"),
+    ('content', "{0} ->> 'content'"),
+    ('reference_id', "coalesce({0} -> 'message_reference' ->> 'message_id', {0} -> 'referenced_message' ->> 'id')::bigint"),
+    ('attachment_count', "jsonb_array_length(coalesce({0} -> 'attachments', '[]'))::smallint"),
+)
+
+
+def message_columns(source: str) -> Tuple[str, str]:
+    """
+    SQL for the typed message columns.
+
+    :param source: jsonb expression holding the message, e.g. `staged.data`
+    :return: Tuple of (column list, matching expression list)
+    """
+    names = ', '.join(name for name, _ in MESSAGE_COLUMNS)
+    values = ', '.join(expr.format(source) for _, expr in MESSAGE_COLUMNS)
+    return names, values
+
+
+# Wraps an INSERT INTO message so the same statement adds the rows it
+# actually inserted to channel_stats and channel_stats_daily, queues their
+# attachments for download_attachments.py and returns their number. Counter
+# rows are upserted in key order, so two crawls of one channel cannot
+# deadlock on them.
+MESSAGE_STATS_SQL = """
+    inserted AS (
+        {0}
+        RETURNING message.id, message.channel_id,
+            CASE WHEN message.attachment_count > 0 THEN message.data -> 'attachments' END AS attachments
+    ),
+    queued AS (
+        INSERT INTO attachment (id, message_id, channel_id, filename, url, size, content_type)
+        SELECT (a ->> 'id')::bigint, inserted.id, inserted.channel_id,
+            a ->> 'filename', a ->> 'url', (a ->> 'size')::bigint, a ->> 'content_type'
+        FROM inserted, jsonb_array_elements(inserted.attachments) AS a
+        WHERE inserted.attachments IS NOT NULL
+        ORDER BY 1
+        ON CONFLICT (id) DO NOTHING
+    ),
+    daily AS (
+        INSERT INTO channel_stats_daily AS s (channel_id, day, message_count)
+        SELECT channel_id, (snowflake_time(id) AT TIME ZONE 'UTC')::date, count(*)
+        FROM inserted
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (channel_id, day) DO UPDATE
+        SET message_count = s.message_count + EXCLUDED.message_count
+    ),
+    totals AS (
+        INSERT INTO channel_stats AS s (channel_id, message_count, first_message_id, last_message_id)
+        SELECT channel_id, count(*), min(id), max(id)
+        FROM inserted
+        GROUP BY 1
+        ORDER BY 1
+        ON CONFLICT (channel_id) DO UPDATE
+        SET message_count = s.message_count + EXCLUDED.message_count,
+            first_message_id = least(s.first_message_id, EXCLUDED.first_message_id),
+            last_message_id = greatest(s.last_message_id, EXCLUDED.last_message_id),
+            updated_at = now()
+    )
+    SELECT count(*) AS inserted FROM inserted
+"""
+
+
+def counted_message_insert(insert_sql: str, before: str = None) -> str:
+    """
+    Turn an INSERT INTO message into a statement that also maintains the
+    message counters and queues attachments (MESSAGE_STATS_SQL).
+
+    :param insert_sql: INSERT INTO message ... without RETURNING
+    :param before: CTEs the INSERT reads from, without the leading WITH
+    :return: SQL returning one row with the number of rows inserted
+    """
+    ctes = MESSAGE_STATS_SQL.format(insert_sql)
+    if before:
+        ctes = before + ',' + ctes
+    return 'WITH ' + ctes
 
 
 def upsert_message(
@@ -145,14 +551,18 @@ def upsert_message(
     if not isinstance(message, Dict):
         return
 
+    names, values = message_columns('v.data')
+
     with conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO message (id, raw_data, channel_id) 
-            VALUES (%s, %s, %s) ON CONFLICT DO NOTHING 
-            """,
+        cur.execute(counted_message_insert("""
+            INSERT INTO message (id, data, channel_id, {0})
+            SELECT v.id, v.data, v.channel_id, {1}
+            FROM (VALUES (%s::bigint, %s::jsonb, %s::bigint)) v (id, data, channel_id)
+            ON CONFLICT DO NOTHING
+            """.format(names, values)),
             [
                 message['id'],
-                json.dumps(message),
+                Jsonb(message),
                 channel_id,
             ]
         )
@@ -168,10 +578,16 @@ def upsert_messages(
         logger.warning('Message length was 0 for channel {0}'.format(channel_id))
         return None
 
-    payload = [(m['id'], json.dumps(m), m['channel_id']) for m in messages]
+    payload = [(m['id'], Jsonb(m), m['channel_id']) for m in messages]
+    names, values = message_columns('v.data')
 
     with conn.cursor() as cur:
-        sql = "INSERT INTO message (id, raw_data, channel_id) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING"
+        sql = counted_message_insert("""
+            INSERT INTO message (id, data, channel_id, {0})
+            SELECT v.id, v.data, v.channel_id, {1}
+            FROM (VALUES (%s::bigint, %s::jsonb, %s::bigint)) v (id, data, channel_id)
+            ON CONFLICT DO NOTHING
+        """.format(names, values))
         cur.executemany(sql, payload)
         logger.debug(
             'Upserted {0} to channel {1}'.format(
@@ -183,6 +599,487 @@ def upsert_messages(
     return None
 
 
+def bulk_upsert_messages(
+    conn: psycopg.Connection,
+    messages: List,
+    channel_id: int,
+) -> Tuple[int, int]:
+    """
+    Insert messages with one set-based merge into `message`, counting the
+    new ones in channel_stats and channel_stats_daily.
+
+    A codec.Page (a page as DiscordAPI returned it) is sent as the response
+    body it was decoded from, one jsonb parameter that the database splits
+    into messages, so nothing is encoded again. Other lists are streamed
+    with a binary COPY into a staging table first. Either way the merge also
+    fills the typed columns (MESSAGE_COLUMNS), and existing messages are
+    left untouched.
+
+    :param conn: Database handle
+    :param messages: List of Discord API message objects
+    :param channel_id: Primary key on the channel table, used for logging
+    :return: Tuple of (new rows inserted, duplicates skipped)
+    """
+    if not messages:
+        logger.warning('Message length was 0 for channel {0}'.format(channel_id))
+        return 0, 0
+
+    names, values = message_columns('staged.data')
+
+    with conn.transaction():
+        with conn.cursor() as cur:
+            if isinstance(messages, Page) and messages.raw is not None:
+                # The body is JSON already, pass it through untouched.
+                cur.execute(counted_message_insert("""
+                    INSERT INTO message (id, data, channel_id, {0})
+                    SELECT (staged.data ->> 'id')::bigint, staged.data, (staged.data ->> 'channel_id')::bigint, {1}
+                    FROM jsonb_array_elements(%s) AS staged (data)
+                    ON CONFLICT DO NOTHING
+                """.format(names, values)), [Jsonb(messages.raw, dumps=bytes)])
+                inserted = cur.fetchone()['inserted']
+            else:
+                inserted = _copy_upsert_messages(cur, messages, names, values)
+
+    duplicates = len(messages) - inserted
+    logger.debug(
+        'Upserted {0} to channel {1}: {2} new, {3} duplicates'.format(
+            len(messages),
+            channel_id,
+            inserted,
+            duplicates,
+        )
+    )
+
+    return inserted, duplicates
+
+
+def _copy_upsert_messages(cur: psycopg.Cursor, messages: List, names: str, values: str) -> int:
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS message_stage (
+            id bigint,
+            data jsonb,
+            channel_id bigint
+        )
+    """)
+
+    copy_sql = 'COPY message_stage (id, data, channel_id) FROM STDIN (FORMAT BINARY)'
+    with cur.copy(copy_sql) as copy:
+        copy.set_types(['int8', 'jsonb', 'int8'])
+        for m in messages:
+            copy.write_row((int(m['id']), Jsonb(m), int(m['channel_id'])))
+
+    cur.execute(counted_message_insert(
+        """
+        INSERT INTO message (id, data, channel_id, {0})
+        SELECT staged.id, staged.data, staged.channel_id, {1} FROM staged
+        ON CONFLICT DO NOTHING
+        """.format(names, values),
+        before='staged AS (DELETE FROM message_stage RETURNING id, data, channel_id)',
+    ))
+    return cur.fetchone()['inserted']
+
+
+def insert_message_pages(conn: psycopg.Connection, pages: List[bytes]) -> int:
+    """
+    Insert pages of messages given as JSON arrays, as they were fetched.
+
+    The database splits the pages, so nothing is decoded here. Messages
+    already stored are skipped, which makes replaying a page harmless.
+
+    :param conn: Database handle
+    :param pages: JSON arrays of Discord API message objects
+    :return: New rows inserted
+    """
+    pages = [page for page in pages if page]
+    if not pages:
+        return 0
+
+    names, values = message_columns('staged.data')
+
+    with conn.cursor() as cur:
+        cur.execute(counted_message_insert("""
+            INSERT INTO message (id, data, channel_id, {0})
+            SELECT (staged.data ->> 'id')::bigint, staged.data, (staged.data ->> 'channel_id')::bigint, {1}
+            FROM unnest(%s::jsonb[]) AS page (body), jsonb_array_elements(page.body) AS staged (data)
+            ON CONFLICT DO NOTHING
+        """.format(names, values)), [[Jsonb(page, dumps=bytes) for page in pages]])
+        return cur.fetchone()['inserted']
+
+
+def get_spool_checkpoint(conn: psycopg.Connection, spool_id: str) -> Optional[Tuple[int, int]]:
+    """
+    Position up to which a spool was written to the database.
+
+    :param conn: Database handle
+    :param spool_id: Name of the spool
+    :return: Tuple of (segment, offset), or None for a new spool
+    """
+    with conn.cursor() as cur:
+        row = cur.execute(
+            'SELECT segment, "offset" FROM spool_checkpoint WHERE spool_id = %s', [spool_id],
+        ).fetchone()
+    return (row['segment'], row['offset']) if row else None
+
+
+def set_spool_checkpoint(conn: psycopg.Connection, spool_id: str, segment: int, offset: int) -> None:
+    """
+    Record the spool position drained so far. Call it in the transaction
+    that stored the records before it.
+
+    :param conn: Database handle
+    :param spool_id: Name of the spool
+    :param segment: Segment number
+    :param offset: Byte offset in the segment
+    :return: None
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO spool_checkpoint (spool_id, segment, "offset")
+            VALUES (%s, %s, %s)
+            ON CONFLICT (spool_id) DO UPDATE SET
+                segment = EXCLUDED.segment,
+                "offset" = EXCLUDED."offset",
+                updated_at = now()
+        """, [spool_id, segment, offset])
+
+
+def get_ingest_channel_ids(conn: psycopg.Connection, channel_ids: List[int]) -> set:
+    """
+    Which of the given channels are stored and crawled, so their messages
+    can be ingested.
+
+    :param conn: Database handle
+    :param channel_ids: Channel ids from gateway events
+    :return: Set of the channel ids with crawling enabled in channel and guild
+    """
+    with conn.cursor() as cur:
+        rows = cur.execute("""
+            SELECT c.id FROM channel c
+            JOIN guild g ON g.id = c.guild_id
+            WHERE c.id = ANY(%s) AND c.crawl_enabled AND c.deleted_at IS NULL AND g.crawl_enabled
+        """, [channel_ids]).fetchall()
+    return {row['id'] for row in rows}
+
+
+def update_messages(conn: psycopg.Connection, patches: List[Dict]) -> int:
+    """
+    Merge MESSAGE_UPDATE payloads into stored messages.
+
+    Updates only carry the fields that changed, so each patch is merged into
+    data and the typed columns are read again from the result. Messages not
+    stored yet are skipped; the crawl fetches their current version.
+
+    :param conn: Database handle
+    :param patches: Partial message objects, at most one per message id
+    :return: Messages updated
+    """
+    if not patches:
+        return 0
+
+    names, values = message_columns('merged.data')
+
+    with conn.cursor() as cur:
+        cur.execute("""
+            WITH patch AS (
+                SELECT (p.body ->> 'id')::bigint AS id, p.body
+                FROM unnest(%(patches)s::jsonb[]) AS p (body)
+            ), merged AS (
+                SELECT m.id, coalesce(m.data, m.raw_data::jsonb) || patch.body AS data
+                FROM message m
+                JOIN patch ON patch.id = m.id
+                WHERE m.id = ANY(%(ids)s::bigint[])
+            )
+            UPDATE message m
+            SET (data, raw_data, {0}) = (merged.data, NULL, {1})
+            FROM merged
+            WHERE m.id = merged.id AND m.id = ANY(%(ids)s::bigint[])
+        """.format(names, values), {
+            'patches': [Jsonb(patch) for patch in patches],
+            'ids': [int(patch['id']) for patch in patches],
+        })
+        return cur.rowcount
+
+
+def mark_messages_deleted(conn: psycopg.Connection, deleted: Dict[int, datetime.datetime]) -> int:
+    """
+    Set deleted_at on stored messages. The rows are kept.
+
+    :param conn: Database handle
+    :param deleted: Dict of message id: time the delete was received
+    :return: Messages marked
+    """
+    if not deleted:
+        return 0
+
+    ids = list(deleted)
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE message m SET deleted_at = d.deleted_at
+            FROM unnest(%s::bigint[], %s::timestamptz[]) AS d (id, deleted_at)
+            WHERE m.id = d.id AND m.id = ANY(%s::bigint[]) AND m.deleted_at IS NULL
+        """, [ids, list(deleted.values()), ids])
+        return cur.rowcount
+
+
+def advance_gateway_cursors(
+    conn: psycopg.Connection,
+    channel_ids: List[int],
+    floor_ids: List[int],
+    high_ids: List[int],
+) -> int:
+    """
+    Move channel cursors up to messages received from the gateway, where
+    that leaves no gap.
+
+    A gateway session receives every message sent after it connected, so
+    messages from `floor_id` up to `high_id` are all stored once its events
+    are. A cursor at or above the floor therefore moves to `high_id`; one
+    below it (the channel was not crawled since the session started) stays
+    put and the crawl fills the gap first.
+
+    Also raises channel.last_message_id and reschedules the crawl: a channel
+    whose cursor covers the messages received is left alone for
+    GATEWAY_CRAWL_DEFER seconds, one whose cursor could not move is due
+    now, so the gap is filled right away.
+
+    :param conn: Database handle
+    :param channel_ids: Channel of each entry
+    :param floor_ids: Lowest message id the entry's session is known to
+        have received everything from
+    :param high_ids: Highest message id stored for the entry
+    :return: Cursors moved
+    """
+    if not channel_ids:
+        return 0
+
+    with conn.cursor() as cur:
+        # Rows are locked in id order, like every other cursor update.
+        cur.execute("""
+            WITH entry AS (
+                SELECT * FROM unnest(%(channels)s::bigint[], %(floors)s::bigint[], %(highs)s::bigint[])
+                    AS t (channel_id, floor_id, high_id)
+            ), locked AS (
+                SELECT id, last_message_id FROM channel
+                WHERE id = ANY(%(channels)s::bigint[])
+                ORDER BY id
+                FOR NO KEY UPDATE
+            )
+            UPDATE channel c SET last_message_id = e.high_id
+            FROM (SELECT channel_id, max(high_id) AS high_id FROM entry GROUP BY 1) e, locked
+            WHERE c.id = e.channel_id AND locked.id = c.id
+                AND coalesce(locked.last_message_id, 0) < e.high_id
+        """, {'channels': channel_ids, 'floors': floor_ids, 'highs': high_ids})
+
+        cur.execute("""
+            WITH entry AS (
+                SELECT * FROM unnest(%(channels)s::bigint[], %(floors)s::bigint[], %(highs)s::bigint[])
+                    AS t (channel_id, floor_id, high_id)
+            ), locked AS (
+                SELECT channel_id, high_message_id FROM channel_cursor
+                WHERE channel_id = ANY(%(channels)s::bigint[])
+                ORDER BY channel_id
+                FOR NO KEY UPDATE
+            ), advance AS (
+                SELECT e.channel_id, max(e.high_id) AS high_id
+                FROM entry e
+                JOIN locked l USING (channel_id)
+                WHERE e.floor_id <= l.high_message_id
+                GROUP BY 1
+            )
+            UPDATE channel_cursor cc SET high_message_id = a.high_id, updated_at = now()
+            FROM advance a
+            WHERE cc.channel_id = a.channel_id AND cc.high_message_id < a.high_id
+        """, {'channels': channel_ids, 'floors': floor_ids, 'highs': high_ids})
+        advanced = cur.rowcount
+
+        cur.execute("""
+            WITH entry AS (
+                SELECT channel_id, max(high_id) AS high_id
+                FROM unnest(%(channels)s::bigint[], %(highs)s::bigint[]) AS t (channel_id, high_id)
+                GROUP BY 1
+            )
+            UPDATE channel c SET next_crawl_at = CASE
+                WHEN cc.high_message_id >= e.high_id
+                    THEN greatest(c.next_crawl_at, now() + make_interval(secs => %(defer)s))
+                ELSE now()
+            END
+            FROM entry e
+            JOIN channel_cursor cc USING (channel_id)
+            WHERE c.id = e.channel_id AND (cc.high_message_id >= e.high_id OR c.next_crawl_at > now())
+        """, {'channels': channel_ids, 'highs': high_ids, 'defer': settings.GATEWAY_CRAWL_DEFER})
+        return advanced
+
+
+def get_unconverted_message_range(conn: psycopg.Connection) -> Optional[Tuple[int, int]]:
+    """
+    Lowest and highest id of the messages that only have raw_data.
+
+    :param conn: Database handle
+    :return: Tuple of (lowest id, highest id), or None if every message is converted
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT
+                (SELECT id FROM message WHERE raw_data IS NOT NULL ORDER BY id LIMIT 1) AS low,
+                (SELECT id FROM message WHERE raw_data IS NOT NULL ORDER BY id DESC LIMIT 1) AS high
+        """)
+        row = cur.fetchone()
+
+    if row['low'] is None:
+        return None
+    return row['low'], row['high']
+
+
+def convert_message_batch(
+    conn: psycopg.Connection,
+    low: int,
+    high: int,
+    limit: int,
+) -> Tuple[int, Optional[int]]:
+    """
+    Move up to `limit` messages with ids in [low, high) from raw_data into
+    data and the typed columns, lowest ids first.
+
+    raw_data is cleared on converted rows, so running it again only picks up
+    what is left.
+
+    :param conn: Database handle
+    :param low: Lowest id to convert
+    :param high: Id to stop before
+    :param limit: Rows per batch
+    :return: Tuple of (rows converted, highest id converted or None)
+    """
+    names, values = message_columns('batch.data')
+
+    with conn.cursor() as cur:
+        cur.execute("""
+            WITH batch AS (
+                SELECT id, raw_data::jsonb AS data FROM message
+                WHERE id >= %(low)s AND id < %(high)s AND raw_data IS NOT NULL
+                ORDER BY id
+                LIMIT %(limit)s
+            )
+            UPDATE message m
+            SET (data, raw_data, {0}) = (batch.data, NULL, {1})
+            FROM batch
+            WHERE m.id = batch.id
+            RETURNING m.id
+        """.format(names, values), {'low': low, 'high': high, 'limit': limit})
+        ids = [row['id'] for row in cur.fetchall()]
+
+    return len(ids), max(ids, default=None)
+
+
+# Columns of an exported message, in order. data falls back to raw_data for
+# messages backfill_message_columns.py has not converted yet.
+EXPORT_COLUMNS = (
+    'id', 'channel_id', 'author_id', 'sent_at', 'edited_at', 'type',
+    'content', 'reference_id', 'attachment_count', 'data',
+)
+
+
+def get_export_channels(
+    conn: psycopg.Connection,
+    guild_ids: Optional[List[int]] = None,
+    channel_ids: Optional[List[int]] = None,
+) -> List[Row]:
+    """
+    Channels with stored messages, optionally limited to some guilds or
+    channels.
+
+    :param conn: Database handle
+    :param guild_ids: Only channels of these guilds
+    :param channel_ids: Only these channels
+    :return: Rows with channel_id, guild_id, first_message_id and
+        last_message_id
+    """
+    with conn.cursor() as cur:
+        return cur.execute("""
+            SELECT s.channel_id, c.guild_id, s.first_message_id, s.last_message_id
+            FROM channel_stats s
+            JOIN channel c ON c.id = s.channel_id
+            WHERE s.message_count > 0
+              AND (%(guild_ids)s::bigint[] IS NULL OR c.guild_id = ANY(%(guild_ids)s::bigint[]))
+              AND (%(channel_ids)s::bigint[] IS NULL OR s.channel_id = ANY(%(channel_ids)s::bigint[]))
+            ORDER BY c.guild_id, s.channel_id
+        """, {'guild_ids': guild_ids, 'channel_ids': channel_ids}).fetchall()
+
+
+def iter_channel_messages(
+    conn: psycopg.Connection,
+    channel_id: int,
+    after: int,
+    before: Optional[int],
+    batch: int,
+) -> Iterator[List[tuple]]:
+    """
+    Stream a channel's messages between `after` and `before` in id order.
+
+    Uses a server-side cursor inside a transaction on `conn`, so only one
+    batch is held in memory at a time.
+
+    :param conn: Database handle
+    :param channel_id: Channel to export
+    :param after: Only messages with a greater id
+    :param before: Only messages with a smaller id. None for no limit
+    :param batch: Rows fetched per round trip
+    :return: Iterator of row batches, each row a tuple in EXPORT_COLUMNS order
+    """
+    with conn.transaction():
+        with conn.cursor(name='export_{0}'.format(channel_id), row_factory=tuple_row) as cur:
+            cur.itersize = batch
+            cur.execute("""
+                SELECT id, channel_id, author_id, sent_at, edited_at, type,
+                       content, reference_id, attachment_count,
+                       coalesce(data::text, raw_data::text) AS data
+                FROM message
+                WHERE channel_id = %(channel_id)s AND id > %(after)s
+                  AND (%(before)s::bigint IS NULL OR id < %(before)s::bigint)
+                ORDER BY id
+            """, {'channel_id': channel_id, 'after': after, 'before': before})
+
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    break
+                yield rows
+
+
+def create_message_partitions(conn: psycopg.Connection, months_ahead: int) -> int:
+    """
+    Make sure the monthly message partitions exist up to `months_ahead`
+    months from now.
+
+    Safe to call from every node: the database serialises the calls and only
+    creates what is missing.
+
+    :param conn: Database handle
+    :param months_ahead: Months after the current one to create
+    :return: Number of partitions created
+    """
+    with conn.cursor() as cur:
+        return cur.execute(
+            'SELECT create_message_partitions(%s) AS created', [months_ahead],
+        ).fetchone()['created']
+
+
+def split_message_legacy(conn: psycopg.Connection, batch: int) -> Optional[int]:
+    """
+    One step of moving message_legacy into monthly partitions, in its own
+    transaction (autocommit): detach it, move a batch of its newest
+    messages into their months or drop it once it is empty.
+
+    :param conn: Database handle, autocommit on
+    :param batch: Most messages to move
+    :return: Messages moved (0 for the detach), None once message_legacy
+        is gone
+    """
+    with conn.cursor() as cur:
+        return cur.execute(
+            'SELECT split_message_legacy(%s) AS moved', [batch],
+        ).fetchone()['moved']
+
+
 def channel_crawl_enabled(
     conn: psycopg.Connection,
     channel_id: int,
@@ -272,6 +1169,36 @@ def get_channels_with_no_messages(conn: psycopg.Connection) -> List[Dict]:
         """).fetchall()
 
 
+def channel_schedule_next_crawl(
+    conn: psycopg.Connection,
+    channel_id: int,
+    message_rate: float,
+    messages: int,
+    interval: float,
+) -> None:
+    """
+    Record a finished crawl and when the channel is due again.
+
+    Also sets last_update to now(), like channel_mark_last_update.
+
+    :param conn: Database handle
+    :param channel_id: Primary key on the Channel table
+    :param message_rate: Smoothed messages per hour
+    :param messages: Messages fetched by the crawl
+    :param interval: Seconds until the next crawl
+    :return: None
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE channel SET
+                last_update = now(),
+                message_rate = %s,
+                last_crawl_messages = %s,
+                next_crawl_at = now() + make_interval(secs => %s)
+            WHERE id = %s
+        """, [message_rate, messages, interval, channel_id])
+
+
 def create_channel_crawl_log(
     conn: psycopg.Connection,
     channel_id: int,
@@ -292,3 +1219,345 @@ def create_channel_crawl_log(
     with conn.cursor() as cur:
         cur.execute(sql, [start_time, end_time, low_id, high_id, channel_id])
         logger.debug('Created crawl_entry for {0}'.format(channel_id))
+
+
+def lease_owner() -> str:
+    """Identify this worker thread in crawl_lease.owner."""
+    return '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), threading.current_thread().name)
+
+
+def claim_channels(
+    conn: psycopg.Connection,
+    selfbot_id: int,
+    owner: str,
+    limit: int = 1,
+) -> List[Row]:
+    """
+    Lease up to `limit` of the most overdue channels of a selfbot for the
+    forward crawl.
+
+    Channels whose cursor already reached the last_message_id seen by the
+    channel refresh have nothing new and are skipped. Channels never
+    crawled are always eligible.
+
+    The leases are taken in one short statement that also returns
+    everything the crawl needs (guild, selfbot and cursor). No transaction
+    or row lock is held while the channels are crawled: keep the leases
+    alive with renew_crawl_leases and give them back with
+    release_crawl_leases. A lease that is not renewed expires after
+    LEASE_TTL seconds and the channel can be claimed again.
+
+    :param conn: Database handle
+    :param selfbot_id: Only channels in guilds this selfbot is a member of
+    :param owner: Lease owner id, see lease_owner
+    :param limit: Most channels to claim
+    :return: Channel rows, most overdue first, with their cursor as
+        snowflake_id. Empty if there is nothing to crawl.
+    """
+    with conn.cursor() as cur:
+        return cur.execute("""
+            WITH candidate AS (
+                SELECT c.id
+                FROM channel c
+                JOIN guild g on g.id = c.guild_id
+                LEFT JOIN channel_cursor cc on cc.channel_id = c.id
+                LEFT JOIN crawl_lease l on l.channel_id = c.id AND l.lane = 'forward'
+                WHERE c.crawl_enabled = true and g.crawl_enabled = true
+                    AND c.deleted_at IS NULL
+                    AND EXISTS (
+                        SELECT 1 FROM guild_selfbot gs
+                        WHERE gs.guild_id = g.id AND gs.selfbot_id = %(selfbot_id)s AND gs.active
+                    )
+                    AND c.next_crawl_at <= now()
+                    AND (cc.channel_id IS NULL OR cc.high_message_id < coalesce(c.last_message_id, 0))
+                    AND (l.channel_id IS NULL OR l.expires_at < now())
+                ORDER BY c.next_crawl_at ASC
+                LIMIT %(limit)s
+                FOR UPDATE of c SKIP LOCKED
+            ), leased AS (
+                INSERT INTO crawl_lease (channel_id, lane, owner, expires_at)
+                SELECT id, 'forward', %(owner)s, now() + make_interval(secs => %(ttl)s)
+                FROM candidate
+                ON CONFLICT (channel_id, lane) DO UPDATE SET
+                    owner = EXCLUDED.owner,
+                    acquired_at = now(),
+                    heartbeat_at = now(),
+                    expires_at = EXCLUDED.expires_at
+                WHERE crawl_lease.expires_at < now()
+                RETURNING channel_id
+            )
+            SELECT
+                c.id as channel_id,
+                c.name as channel_name,
+                c.guild_id,
+                g.name as guild_name,
+                s.username as selfbot_name,
+                coalesce(cc.high_message_id, 0) as snowflake_id,
+                c.last_message_id,
+                c.message_rate,
+                extract(epoch FROM now() - c.last_update)::float AS seconds_since_crawl,
+                g.crawl_priority
+            FROM leased
+            JOIN channel c on c.id = leased.channel_id
+            LEFT JOIN guild g on g.id = c.guild_id
+            LEFT JOIN selfbot s on s.id = g.selfbot_id
+            LEFT JOIN channel_cursor cc on cc.channel_id = c.id
+            ORDER BY c.next_crawl_at ASC
+        """, {
+            'selfbot_id': selfbot_id,
+            'owner': owner,
+            'ttl': settings.LEASE_TTL,
+            'limit': limit,
+        }).fetchall()
+
+
+def renew_crawl_leases(conn: psycopg.Connection, lane: str, owner: str) -> List[int]:
+    """
+    Heartbeat every lease an owner holds in a lane and push their expiry
+    LEASE_TTL seconds out.
+
+    :param conn: Database handle
+    :param lane: 'forward' or 'backfill'
+    :param owner: Lease owner id
+    :return: Channel ids still leased by `owner`. Leases that expired and
+        were taken by someone else are missing.
+    """
+    with conn.cursor() as cur:
+        rows = cur.execute("""
+            UPDATE crawl_lease SET
+                heartbeat_at = now(),
+                expires_at = now() + make_interval(secs => %s)
+            WHERE lane = %s AND owner = %s
+            RETURNING channel_id
+        """, [settings.LEASE_TTL, lane, owner]).fetchall()
+    return [row['channel_id'] for row in rows]
+
+
+def release_crawl_leases(
+    conn: psycopg.Connection,
+    channel_ids: List[int],
+    lane: str,
+    owner: str,
+) -> None:
+    """
+    Give leases back so the channels can be claimed again.
+
+    :param conn: Database handle
+    :param channel_ids: Primary keys on the Channel table
+    :param lane: 'forward' or 'backfill'
+    :param owner: Lease owner id. Leases taken over by someone else are kept.
+    :return: None
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            'DELETE FROM crawl_lease WHERE channel_id = ANY(%s) AND lane = %s AND owner = %s',
+            [channel_ids, lane, owner],
+        )
+
+
+def advance_channel_cursor(
+    conn: psycopg.Connection,
+    channel_id: int,
+    high_id: Optional[int] = None,
+    low_id: Optional[int] = None,
+) -> None:
+    """
+    Move a channel's crawl cursor outwards to cover high_id and low_id.
+
+    The cursor only ever grows: high_message_id never goes down and
+    low_message_id never goes up. Call it in the same transaction as the
+    insert of the messages it covers.
+
+    :param conn: Database handle
+    :param channel_id: Primary key on the Channel table
+    :param high_id: Newest message id now stored
+    :param low_id: Oldest message id now stored
+    :return: None
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO channel_cursor (channel_id, high_message_id, low_message_id)
+            VALUES (%s, coalesce(%s, 0), %s)
+            ON CONFLICT (channel_id) DO UPDATE SET
+                high_message_id = greatest(channel_cursor.high_message_id, EXCLUDED.high_message_id),
+                low_message_id = least(channel_cursor.low_message_id, EXCLUDED.low_message_id),
+                updated_at = now()
+        """, [channel_id, high_id, low_id])
+
+
+def mark_channel_history_complete(conn: psycopg.Connection, channel_id: int) -> None:
+    """
+    Flag a channel whose history has been backfilled down to its first message.
+
+    :param conn: Database handle
+    :param channel_id: Primary key on the Channel table
+    :return: None
+    """
+    if not channel_id:
+        raise Exception('channel_id is required')
+
+    logger.debug('Marking channel history_crawled \'true\': {0}'.format(channel_id))
+
+    with conn.cursor() as cur:
+        sql = 'UPDATE channel SET history_crawled = true WHERE id = %s'
+        cur.execute(sql, [channel_id])
+
+
+def claim_backfill_channel(
+    conn: psycopg.Connection,
+    selfbot_id: int,
+    owner: str,
+) -> Optional[Row]:
+    """
+    Lease a channel whose history still needs backfilling.
+
+    Backfill leases live in their own lane, so a backfill never stops the
+    forward crawler from claiming the same channel. See claim_channels for
+    the lease rules.
+
+    :param conn: Database handle
+    :param selfbot_id: Only channels in guilds this selfbot is a member of
+    :param owner: Lease owner id, see lease_owner
+    :return: The channel row, with its low cursor as message_id, or None
+    """
+    with conn.cursor() as cur:
+        return cur.execute("""
+            WITH candidate AS (
+                SELECT c.id
+                FROM channel c
+                JOIN guild g on g.id = c.guild_id
+                LEFT JOIN crawl_lease l on l.channel_id = c.id AND l.lane = 'backfill'
+                WHERE c.crawl_enabled = true and g.crawl_enabled = true
+                    AND c.deleted_at IS NULL
+                    AND c.history_crawled = false
+                    AND EXISTS (
+                        SELECT 1 FROM guild_selfbot gs
+                        WHERE gs.guild_id = g.id AND gs.selfbot_id = %(selfbot_id)s AND gs.active
+                    )
+                    AND (l.channel_id IS NULL OR l.expires_at < now())
+                ORDER BY g.crawl_priority DESC, c.created_at ASC
+                LIMIT 1
+                FOR UPDATE of c SKIP LOCKED
+            ), leased AS (
+                INSERT INTO crawl_lease (channel_id, lane, owner, expires_at)
+                SELECT id, 'backfill', %(owner)s, now() + make_interval(secs => %(ttl)s)
+                FROM candidate
+                ON CONFLICT (channel_id, lane) DO UPDATE SET
+                    owner = EXCLUDED.owner,
+                    acquired_at = now(),
+                    heartbeat_at = now(),
+                    expires_at = EXCLUDED.expires_at
+                WHERE crawl_lease.expires_at < now()
+                RETURNING channel_id
+            )
+            SELECT
+                c.id as channel_id,
+                c.name as channel_name,
+                c.guild_id,
+                g.name as guild_name,
+                s.username as selfbot_name,
+                cc.low_message_id as message_id
+            FROM leased
+            JOIN channel c on c.id = leased.channel_id
+            LEFT JOIN guild g on g.id = c.guild_id
+            LEFT JOIN selfbot s on s.id = g.selfbot_id
+            LEFT JOIN channel_cursor cc on cc.channel_id = c.id
+        """, {'selfbot_id': selfbot_id, 'owner': owner, 'ttl': settings.LEASE_TTL}).fetchone()
+
+
+def claim_attachments(conn: psycopg.Connection, limit: int, ttl: float) -> List[Row]:
+    """
+    Take up to `limit` attachments that are due for download, oldest first.
+
+    Claiming moves next_attempt_at `ttl` seconds ahead and counts the
+    attempt, so the attachment is not handed out again while it downloads.
+    If the downloader dies it becomes due again once the claim runs out.
+
+    :param conn: Database handle
+    :param limit: Most attachments to claim
+    :param ttl: Seconds a claim lasts
+    :return: Attachment rows with id, message_id, url, size and attempts
+    """
+    with conn.cursor() as cur:
+        return cur.execute("""
+            WITH due AS (
+                SELECT id
+                FROM attachment
+                WHERE next_attempt_at <= now()
+                ORDER BY next_attempt_at ASC
+                LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE attachment a
+            SET attempts = a.attempts + 1,
+                next_attempt_at = now() + make_interval(secs => %(ttl)s)
+            FROM due
+            WHERE a.id = due.id
+            RETURNING a.id, a.message_id, a.url, a.size, a.attempts
+        """, {'limit': limit, 'ttl': ttl}).fetchall()
+
+
+def finish_attachments(conn: psycopg.Connection, downloads: List[Tuple[int, bytes, int]]) -> None:
+    """
+    Record completed downloads.
+
+    :param conn: Database handle
+    :param downloads: List of (attachment id, sha256 digest, size in bytes)
+    :return: None
+    """
+    if not downloads:
+        return
+
+    ids, digests, sizes = zip(*sorted(downloads))
+    conn.execute("""
+        UPDATE attachment a
+        SET sha256 = d.sha256,
+            size = d.size,
+            downloaded_at = now(),
+            next_attempt_at = NULL,
+            error = NULL
+        FROM unnest(%s::bigint[], %s::bytea[], %s::bigint[]) AS d (id, sha256, size)
+        WHERE a.id = d.id
+    """, [list(ids), list(digests), list(sizes)])
+
+
+def fail_attachment(
+    conn: psycopg.Connection,
+    attachment_id: int,
+    error: str,
+    retry_in: Optional[float] = None,
+) -> None:
+    """
+    Record a failed download.
+
+    :param conn: Database handle
+    :param attachment_id: Attachment id
+    :param error: Why it failed
+    :param retry_in: Seconds until the next attempt, None to give up
+    :return: None
+    """
+    conn.execute("""
+        UPDATE attachment
+        SET error = %(error)s,
+            next_attempt_at = now() + make_interval(secs => %(retry_in)s)
+        WHERE id = %(id)s
+    """, {'id': attachment_id, 'error': error[:1000], 'retry_in': retry_in})
+
+
+def release_attachments(conn: psycopg.Connection, attachment_ids: List[int]) -> None:
+    """
+    Hand back claimed attachments that were not attempted, e.g. on shutdown.
+
+    :param conn: Database handle
+    :param attachment_ids: Claimed attachment ids
+    :return: None
+    """
+    if not attachment_ids:
+        return
+
+    conn.execute("""
+        UPDATE attachment
+        SET attempts = greatest(attempts - 1, 0),
+            next_attempt_at = now()
+        WHERE id = ANY(%s) AND sha256 IS NULL
+    """, [sorted(attachment_ids)])
@@ -0,0 +1,216 @@
+"""Resumable file downloads for download_attachments.py.
+
+fetch() streams a url into a partial file of the BlobStore, hashing it on
+the way. If the partial file already holds the start of the content from
+an attempt that was cut off, only the rest is requested (a `Range`
+request) and the bytes on disk are hashed first. A server that ignores the
+range sends everything again and the file is rewritten.
+
+HostLimits counts the downloads running against each host, so one host
+with a burst of attachments cannot take every download slot.
+"""
+import hashlib
+import logging.config
+import os
+import re
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import settings
+from libs.metrics import ATTACHMENT_BYTES
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+CHUNK_SIZE = 64 * 1024
+
+# Attempts in a row at a download that keeps being cut off midway, each
+# continuing from where the last one stopped.
+RESUME_ATTEMPTS = 3
+
+# Statuses of a link that expired or a file that was deleted.
+GONE = (401, 403, 404, 410)
+
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class DownloadError(Exception):
+
+    def __init__(self, message: str, retry: bool = True):
+        """
+        :param message: What went wrong
+        :param retry: Whether a later attempt may succeed
+        """
+        super().__init__(message)
+        self.retry = retry
+
+
+class CutOff(DownloadError):
+    """The connection closed before the whole file arrived."""
+
+
+def get_session(pool_size: int) -> requests.Session:
+    """
+    :param pool_size: Keep-alive connections per host
+    :return: A requests Session for downloads, without Discord credentials
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = settings.USER_AGENT
+    return session
+
+
+def host_of(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+class HostLimits(object):
+    """
+    Download slots per host. Not thread-safe: the thread handing out the
+    downloads takes and returns the slots.
+    """
+
+    def __init__(self, per_host: int):
+        """
+        :param per_host: Downloads allowed at once against one host
+        """
+        self.per_host = per_host
+        self.active: Dict[str, int] = {}
+
+    def acquire(self, host: str) -> bool:
+        """Take a slot of `host`. False if they are all taken."""
+        active = self.active.get(host, 0)
+        if active >= self.per_host:
+            return False
+        self.active[host] = active + 1
+        return True
+
+    def release(self, host: str) -> None:
+        active = self.active[host] - 1
+        if active:
+            self.active[host] = active
+        else:
+            del self.active[host]
+
+
+def _hash_file(path: str, hasher) -> int:
+    """Feed a file to `hasher`. :return: Its size"""
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def _fetch_once(
+    session: requests.Session,
+    url: str,
+    partial: str,
+    expected_size: Optional[int],
+    max_bytes: int,
+    stop: threading.Event,
+) -> Tuple[bytes, int]:
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if expected_size is not None and offset > expected_size:
+        offset = 0
+    headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+
+    with session.get(url, headers=headers, stream=True, timeout=settings.HTTP_TIMEOUT) as resp:
+        if resp.status_code == 416 and offset:
+            if offset == expected_size:
+                # Everything arrived last time, only the check was missed.
+                hasher = hashlib.sha256()
+                _hash_file(partial, hasher)
+                return hasher.digest(), offset
+            os.truncate(partial, 0)
+            raise DownloadError('HTTP 416')
+        if resp.status_code in GONE:
+            raise DownloadError('HTTP {0}'.format(resp.status_code), retry=False)
+        if resp.status_code not in (200, 206):
+            raise DownloadError('HTTP {0}'.format(resp.status_code), retry=resp.status_code == 429 or resp.status_code >= 500)
+
+        if resp.status_code == 206:
+            match = CONTENT_RANGE.match(resp.headers.get('Content-Range', ''))
+            if match is None or int(match.group(1)) != offset:
+                if offset:
+                    os.truncate(partial, 0)
+                raise DownloadError('Unexpected Content-Range {0!r}'.format(resp.headers.get('Content-Range')))
+        else:
+            offset = 0
+
+        length = resp.headers.get('Content-Length')
+        end = offset + int(length) if length is not None else expected_size
+        if end is not None and end > max_bytes:
+            raise DownloadError('{0} bytes, more than ATTACHMENT_MAX_BYTES'.format(end), retry=False)
+
+        hasher = hashlib.sha256()
+        if offset:
+            _hash_file(partial, hasher)
+
+        size = offset
+        with open(partial, 'ab' if offset else 'wb') as f:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                if stop.is_set():
+                    raise DownloadError('Stopped')
+                size += len(chunk)
+                if size > max_bytes:
+                    f.truncate(0)
+                    raise DownloadError('More than ATTACHMENT_MAX_BYTES', retry=False)
+                hasher.update(chunk)
+                f.write(chunk)
+                ATTACHMENT_BYTES.inc(amount=len(chunk))
+
+    if end is not None and size < end:
+        # The connection closed early without an error. Keep what arrived.
+        raise CutOff('Got {0} of {1} bytes'.format(size, end))
+    if expected_size is not None and size != expected_size:
+        os.truncate(partial, 0)
+        raise DownloadError('Got {0} bytes, the message said {1}'.format(size, expected_size))
+    return hasher.digest(), size
+
+
+def fetch(
+    session: requests.Session,
+    url: str,
+    partial: str,
+    expected_size: Optional[int] = None,
+    max_bytes: int = settings.ATTACHMENT_MAX_BYTES,
+    stop: Optional[threading.Event] = None,
+) -> Tuple[bytes, int]:
+    """
+    Download a url into `partial`, continuing what is there already.
+
+    A download cut off midway is continued right away, up to RESUME_ATTEMPTS
+    times in a row. Otherwise, and after any other failure, the partial file
+    is kept for the next attempt.
+
+    :param session: See get_session
+    :param url: What to download
+    :param partial: File to write to
+    :param expected_size: Size the message gave, checked when known
+    :param max_bytes: Give up on larger files
+    :param stop: Set to abort, keeping the partial file
+    :return: Tuple of (SHA-256 digest, size) of the complete file
+    :raises DownloadError: The download failed
+    """
+    stop = stop or threading.Event()
+    attempt = 1
+    while True:
+        try:
+            return _fetch_once(session, url, partial, expected_size, max_bytes, stop)
+        except (CutOff, requests.exceptions.ChunkedEncodingError) as e:
+            if stop.is_set() or attempt >= RESUME_ATTEMPTS:
+                raise CutOff('{0}: {1}'.format(type(e).__name__, e)) from e
+            logger.debug('Resuming {0} at {1} bytes after {2}'.format(url, os.path.getsize(partial), e))
+            attempt += 1
+        except requests.RequestException as e:
+            raise DownloadError('{0}: {1}'.format(type(e).__name__, e)) from e
@@ -0,0 +1,450 @@
+"""Real-time message ingestion from the Discord gateway.
+
+GatewayClient keeps one selfbot connected to the gateway (hello, identify,
+heartbeats, resume after a disconnect) and hands the message events to an
+EventWriter. The writer stores them in micro-batches, one transaction
+each, once GATEWAY_BATCH_EVENTS events are waiting or the oldest has waited
+GATEWAY_BATCH_SECONDS: new messages go through the same insert as crawled
+pages, edits are merged into the stored messages, deletes set deleted_at.
+
+The same transaction moves the channel cursors, so message_history does not
+claim channels the gateway keeps up to date. A session only receives what
+is sent while it is connected, so every session has a floor: the snowflake
+of the moment it became ready. Everything above the floor reaches the
+session (resuming replays what was missed), so a cursor at or above the
+floor can jump to the newest message received. Below it messages may be
+missing, and the cursor stays until the crawl has filled the gap. A lost
+batch raises every floor to the time of the loss in the same way.
+
+https://discord.com/developers/docs/topics/gateway
+"""
+import asyncio
+import datetime
+import logging.config
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import aiohttp
+import psycopg
+
+import settings
+from libs.codec import dumps, loads
+from libs.db_operations import (
+    get_db_conn,
+    get_ingest_channel_ids,
+    insert_message_pages,
+    update_messages,
+    mark_messages_deleted,
+    advance_gateway_cursors,
+)
+from libs.metrics import (
+    DB_WRITE_SECONDS,
+    GATEWAY_CONNECTED,
+    GATEWAY_EVENTS,
+    GATEWAY_CURSORS_ADVANCED,
+    MESSAGES_INSERTED,
+)
+from libs.snowflake import datetime_to_snowflake
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+# Gateway opcodes.
+DISPATCH = 0
+HEARTBEAT = 1
+IDENTIFY = 2
+RESUME = 6
+RECONNECT = 7
+INVALID_SESSION = 9
+HELLO = 10
+HEARTBEAT_ACK = 11
+
+# Close codes after which connecting again cannot help (bad token, bad
+# intents, ...).
+FATAL_CLOSE_CODES = {4004, 4010, 4011, 4012, 4013, 4014}
+# Close codes after which the session cannot be resumed.
+NEW_SESSION_CLOSE_CODES = {4003, 4005, 4007, 4009}
+# Closing with 1000 or 1001 ends the session on Discord's side. Any other
+# code keeps it resumable.
+RESUMABLE_CLOSE = 4000
+
+MESSAGE_EVENTS = ('MESSAGE_CREATE', 'MESSAGE_UPDATE', 'MESSAGE_DELETE', 'MESSAGE_DELETE_BULK')
+
+# Fields of message events that REST message objects do not have.
+EVENT_ONLY_FIELDS = ('guild_id', 'member')
+
+# Seconds between our clock and Discord's that session floors allow for.
+CLOCK_SKEW = 5
+
+# Longest wait between connection attempts, in seconds.
+MAX_BACKOFF = 60
+
+
+def floor_now() -> int:
+    """Session floor for a session (or gap) starting now, see the module docstring."""
+    return datetime_to_snowflake(datetime.datetime.utcnow() + datetime.timedelta(seconds=CLOCK_SKEW))
+
+
+def strip_event(data: Dict) -> Dict:
+    """A message event payload without the gateway-only fields."""
+    return {key: value for key, value in data.items() if key not in EVENT_ONLY_FIELDS}
+
+
+class EventBatch(object):
+    """Message events collected for one transaction, merged per message."""
+
+    __slots__ = ('created', 'updated', 'deleted', 'highs', 'events', 'started_at')
+
+    def __init__(self):
+        # message id: message, in arrival order
+        self.created: Dict[int, Dict] = {}
+        # message id: merged partial message
+        self.updated: Dict[int, Dict] = {}
+        # message id: when the delete arrived
+        self.deleted: Dict[int, datetime.datetime] = {}
+        # (channel id, session floor): highest message id created
+        self.highs: Dict[Tuple[int, int], int] = {}
+        self.events = 0
+        self.started_at: Optional[float] = None
+
+    def add(self, event: str, data: Dict, floor: int) -> None:
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        self.events += 1
+
+        if event == 'MESSAGE_CREATE':
+            message_id = int(data['id'])
+            self.created[message_id] = strip_event(data)
+            key = (int(data['channel_id']), floor)
+            self.highs[key] = max(self.highs.get(key, 0), message_id)
+        elif event == 'MESSAGE_UPDATE':
+            message_id = int(data['id'])
+            if message_id in self.created:
+                self.created[message_id].update(strip_event(data))
+            else:
+                self.updated.setdefault(message_id, {}).update(strip_event(data))
+        elif event == 'MESSAGE_DELETE':
+            self.deleted[int(data['id'])] = datetime.datetime.now(datetime.timezone.utc)
+        elif event == 'MESSAGE_DELETE_BULK':
+            deleted_at = datetime.datetime.now(datetime.timezone.utc)
+            for message_id in data['ids']:
+                self.deleted[int(message_id)] = deleted_at
+
+    def raise_floors(self, floor: int) -> None:
+        """Make the cursors of this batch prove continuity from `floor` on."""
+        highs: Dict[Tuple[int, int], int] = {}
+        for (channel_id, old_floor), high_id in self.highs.items():
+            key = (channel_id, max(old_floor, floor))
+            highs[key] = max(highs.get(key, 0), high_id)
+        self.highs = highs
+
+
+def store_events(conn: psycopg.Connection, batch: EventBatch) -> Tuple[int, int]:
+    """
+    Store a batch of message events. Call it in a transaction.
+
+    Messages of channels that are not stored or not crawled are skipped.
+
+    :param conn: Database handle
+    :param batch: Events to store
+    :return: Tuple of (new messages inserted, cursors moved)
+    """
+    channel_ids = {int(message['channel_id']) for message in batch.created.values()}
+    known = get_ingest_channel_ids(conn, list(channel_ids)) if channel_ids else set()
+
+    created = [message for message in batch.created.values() if int(message['channel_id']) in known]
+    inserted = insert_message_pages(conn, [dumps(created)] if created else [])
+    update_messages(conn, [dict(patch, id=str(message_id)) for message_id, patch in batch.updated.items()])
+    mark_messages_deleted(conn, batch.deleted)
+
+    entries = sorted((key, high_id) for key, high_id in batch.highs.items() if key[0] in known)
+    advanced = advance_gateway_cursors(
+        conn,
+        [channel_id for (channel_id, _), _ in entries],
+        [floor for (_, floor), _ in entries],
+        [high_id for _, high_id in entries],
+    )
+    return inserted, advanced
+
+
+class EventWriter(object):
+    """
+    Background writer of the message events of every gateway session in a
+    process, with its own connection.
+
+    `add` never blocks the event loop. While the database is unavailable
+    events pile up to GATEWAY_MAX_PENDING; past that, and whenever a batch
+    cannot be written, they are dropped and the floors raised, so the
+    crawl picks the missed messages up.
+    """
+
+    def __init__(
+        self,
+        batch_events: int = settings.GATEWAY_BATCH_EVENTS,
+        batch_seconds: float = settings.GATEWAY_BATCH_SECONDS,
+        max_pending: int = settings.GATEWAY_MAX_PENDING,
+    ):
+        """
+        :param batch_events: Most events stored in one transaction
+        :param batch_seconds: Longest an event waits for its batch to fill
+        :param max_pending: Events held before new ones are dropped
+        """
+        self.batch_events = batch_events
+        self.batch_seconds = batch_seconds
+        self.max_pending = max_pending
+        self.batch = EventBatch()
+        self.error_floor = 0
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.conn: Optional[psycopg.Connection] = None
+        self.thread = threading.Thread(target=self._run, name='gateway-writer', daemon=True)
+        self.thread.start()
+
+    def add(self, event: str, data: Dict, floor: int) -> None:
+        """
+        Queue a message event.
+
+        :param event: Dispatch event name, one of MESSAGE_EVENTS
+        :param data: Event payload
+        :param floor: Floor of the session that received it
+        :return: None
+        """
+        GATEWAY_EVENTS.inc(event)
+        with self.condition:
+            if self.batch.events >= self.max_pending:
+                self._gap('{0} events pending'.format(self.batch.events))
+                self.batch = EventBatch()
+            self.batch.add(event, data, max(floor, self.error_floor))
+            # The first event starts the batch's clock.
+            if self.batch.events == 1 or self.batch.events >= self.batch_events:
+                self.condition.notify()
+
+    def close(self) -> None:
+        """Write what is queued and stop the thread."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+        if self.conn is not None:
+            self.conn.close()
+
+    def _gap(self, reason: str) -> None:
+        """Events were lost. Call with the condition held."""
+        self.error_floor = floor_now()
+        self.batch.raise_floors(self.error_floor)
+        logger.warning('Dropping gateway events ({0}), the crawl will fill the gap'.format(reason))
+
+    def _take(self) -> Tuple[EventBatch, bool]:
+        """Wait for a full or old enough batch, or for close."""
+        with self.condition:
+            while not self.stopping:
+                if self.batch.events >= self.batch_events:
+                    break
+                if self.batch.started_at is None:
+                    timeout = None
+                else:
+                    timeout = self.batch.started_at + self.batch_seconds - time.monotonic()
+                    if timeout <= 0:
+                        break
+                self.condition.wait(timeout)
+
+            batch, self.batch = self.batch, EventBatch()
+            return batch, self.stopping
+
+    def _write(self, batch: EventBatch) -> None:
+        if self.conn is None or self.conn.broken:
+            self.conn = get_db_conn()
+
+        started_at = time.monotonic()
+        with self.conn.transaction():
+            inserted, advanced = store_events(self.conn, batch)
+        DB_WRITE_SECONDS.observe('gateway', value=time.monotonic() - started_at)
+        MESSAGES_INSERTED.inc(amount=inserted)
+        GATEWAY_CURSORS_ADVANCED.inc(amount=advanced)
+        logger.debug('Stored {0} gateway events: {1} new messages, {2} cursors moved'.format(
+            batch.events, inserted, advanced,
+        ))
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch, stop = self._take()
+            if not batch.events:
+                continue
+
+            try:
+                self._write(batch)
+            except psycopg.Error as e:
+                with self.condition:
+                    self._gap('writing {0} events failed: {1}'.format(batch.events, e))
+
+
+class GatewayClient(object):
+    """
+    One selfbot's gateway connection, kept alive until `close`.
+
+    Reconnects after every disconnect, resuming the session when Discord
+    allows it so no events are missed, and gives up only on close codes
+    that mean the token cannot connect.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        name: str,
+        on_event: Callable[[str, Dict, int], None],
+        url: str = settings.GATEWAY_URL,
+    ):
+        """
+        :param token: selfbot token
+        :param name: Selfbot name, for logs and metrics
+        :param on_event: Called with (event name, payload, session floor)
+            for every message event
+        :param url: Gateway URL with its query string
+        """
+        self.token = token
+        self.name = name
+        self.on_event = on_event
+        self.url = url
+        self.session_id: Optional[str] = None
+        self.resume_url: Optional[str] = None
+        self.sequence: Optional[int] = None
+        self.floor = 0
+        self.acked = True
+        self.closed = False
+        self.ws: Optional[aiohttp.ClientWebSocketResponse] = None
+
+    def _reset_session(self) -> None:
+        self.session_id = None
+        self.resume_url = None
+        self.sequence = None
+
+    def _connect_url(self) -> str:
+        if self.session_id and self.resume_url:
+            # resume_gateway_url comes without the version and encoding.
+            query = self.url.partition('?')[2]
+            return self.resume_url.rstrip('/') + '/?' + query
+        return self.url
+
+    async def _send(self, op: int, data) -> None:
+        await self.ws.send_str(dumps({'op': op, 'd': data}).decode())
+
+    async def _heartbeat(self, interval: float) -> None:
+        """Heartbeat every `interval` seconds; reconnect when one goes unanswered."""
+        await asyncio.sleep(interval * random.random())
+        while not self.ws.closed:
+            if not self.acked:
+                logger.warning('{0}: heartbeat not acknowledged, reconnecting'.format(self.name))
+                await self.ws.close(code=RESUMABLE_CLOSE)
+                return
+            self.acked = False
+            await self._send(HEARTBEAT, self.sequence)
+            await asyncio.sleep(interval)
+
+    async def _login(self) -> None:
+        if self.session_id is not None:
+            await self._send(RESUME, {
+                'token': self.token,
+                'session_id': self.session_id,
+                'seq': self.sequence,
+            })
+        else:
+            await self._send(IDENTIFY, {
+                'token': self.token,
+                'properties': {'os': 'linux', 'browser': 'discord_crawler', 'device': 'discord_crawler'},
+                'compress': False,
+                'large_threshold': 250,
+            })
+
+    async def _dispatch(self, payload: Dict) -> None:
+        op = payload.get('op')
+
+        if op == DISPATCH:
+            self.sequence = payload.get('s') or self.sequence
+            event = payload.get('t')
+            if event in MESSAGE_EVENTS:
+                self.on_event(event, payload['d'], self.floor)
+            elif event == 'READY':
+                self.session_id = payload['d']['session_id']
+                self.resume_url = payload['d'].get('resume_gateway_url')
+                self.floor = floor_now()
+                GATEWAY_CONNECTED.set(self.name, value=1)
+                logger.info('{0}: gateway session ready'.format(self.name))
+            elif event == 'RESUMED':
+                GATEWAY_CONNECTED.set(self.name, value=1)
+                logger.info('{0}: gateway session resumed'.format(self.name))
+
+        elif op == HEARTBEAT:
+            await self._send(HEARTBEAT, self.sequence)
+        elif op == HEARTBEAT_ACK:
+            self.acked = True
+        elif op == RECONNECT:
+            await self.ws.close(code=RESUMABLE_CLOSE)
+        elif op == INVALID_SESSION:
+            if not payload.get('d'):
+                self._reset_session()
+            await asyncio.sleep(random.uniform(1, 5))
+            await self.ws.close(code=RESUMABLE_CLOSE)
+
+    async def _connect(self, session: aiohttp.ClientSession) -> Optional[int]:
+        """
+        Run one connection until it closes.
+
+        :return: The close code, None if there was none
+        """
+        async with session.ws_connect(self._connect_url(), max_msg_size=0) as ws:
+            self.ws = ws
+            msg = await ws.receive(timeout=settings.HTTP_TIMEOUT)
+            hello = loads(msg.data) if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY) else {}
+            if hello.get('op') != HELLO:
+                raise aiohttp.ClientError('Expected hello, got {0}'.format(msg.type.name))
+
+            self.acked = True
+            heartbeat = asyncio.ensure_future(self._heartbeat(hello['d']['heartbeat_interval'] / 1000))
+            try:
+                await self._login()
+                async for msg in ws:
+                    if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                        await self._dispatch(loads(msg.data))
+                    elif msg.type == aiohttp.WSMsgType.ERROR:
+                        break
+            finally:
+                heartbeat.cancel()
+                GATEWAY_CONNECTED.set(self.name, value=0)
+            return ws.close_code
+
+    async def run(self) -> None:
+        """Stay connected until `close` is called or the token is refused."""
+        backoff = 1
+        async with aiohttp.ClientSession(headers={'User-Agent': settings.USER_AGENT}) as session:
+            while not self.closed:
+                connected_at = time.monotonic()
+                try:
+                    code = await self._connect(session)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                    code = None
+                    logger.warning('{0}: gateway connection failed: {1}'.format(self.name, e))
+
+                if self.closed:
+                    break
+                if code in FATAL_CLOSE_CODES:
+                    logger.critical('{0}: gateway closed with {1}, giving up'.format(self.name, code))
+                    break
+                if code in NEW_SESSION_CLOSE_CODES:
+                    self._reset_session()
+
+                if time.monotonic() - connected_at > MAX_BACKOFF:
+                    backoff = 1
+                logger.info('{0}: gateway closed ({1}), reconnecting in {2}s'.format(self.name, code, backoff))
+                await asyncio.sleep(backoff * random.uniform(0.5, 1))
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    async def close(self) -> None:
+        """Disconnect, ending the session."""
+        self.closed = True
+        if self.ws is not None and not self.ws.closed:
+            await self.ws.close()
@@ -0,0 +1,116 @@
+"""Channel leases held by crawl workers.
+
+A worker leases a channel (claim_channels / claim_backfill_channel) before
+crawling it and holds no transaction or row lock while it works. The lease
+row in crawl_lease carries an expiry that the worker pushes out as it goes;
+if the worker dies the lease runs out after LEASE_TTL seconds and another
+worker, on any host, can claim the channel.
+"""
+import logging.config
+import time
+
+import psycopg
+
+import settings
+from libs.db_operations import get_db_conn, renew_crawl_leases, release_crawl_leases
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+class Lease(object):
+    """
+    A lease this worker holds on one channel.
+
+    Call keep_alive between pages. It renews the lease once a third of
+    LEASE_TTL has passed and reports whether the lease is still ours.
+    Renewing heartbeats every lease the owner holds in the lane, so
+    channels claimed in a batch and still waiting their turn stay leased
+    too.
+    """
+
+    def __init__(
+        self,
+        conn: psycopg.Connection,
+        channel_id: int,
+        lane: str,
+        owner: str,
+        renewed_at: float = None,
+    ):
+        """
+        :param conn: Database handle, autocommit on
+        :param channel_id: The leased channel
+        :param lane: 'forward' or 'backfill'
+        :param owner: Lease owner id
+        :param renewed_at: time.monotonic() of the claim or last renewal
+            of the owner's leases. Defaults to now.
+        """
+        self.conn = conn
+        self.channel_id = channel_id
+        self.lane = lane
+        self.owner = owner
+        self.renewed_at = time.monotonic() if renewed_at is None else renewed_at
+        self.lost = False
+        self.unreachable = False
+
+    def keep_alive(self) -> bool:
+        """
+        Renew the lease if it is due.
+
+        While the database cannot be reached the lease is kept until it would
+        have expired: no other worker can take the channel before that either.
+        This lets a crawl writing to the spool (libs/spool.py) carry on
+        through a short database outage. A broken connection is replaced by
+        a new one in `conn` once the database is back.
+
+        :return: False once the lease expired and another worker took the
+            channel, or the database was unreachable for LEASE_TTL. Stop
+            crawling it.
+        """
+        if self.lost:
+            return False
+
+        if time.monotonic() - self.renewed_at < settings.LEASE_TTL / 3:
+            return True
+
+        try:
+            if self.conn.broken:
+                self.conn = get_db_conn()
+            return self.renew()
+        except psycopg.OperationalError:
+            if time.monotonic() - self.renewed_at < settings.LEASE_TTL:
+                if not self.unreachable:
+                    logger.warning('Could not renew the {0} lease on channel {1}. Keeping it until it expires'.format(
+                        self.lane, self.channel_id,
+                    ))
+                self.unreachable = True
+                return True
+
+            self.lost = True
+            logger.warning('Could not renew the {0} lease on channel {1} for {2}s. Giving it up'.format(
+                self.lane, self.channel_id, settings.LEASE_TTL,
+            ))
+            return False
+
+    def renew(self) -> bool:
+        """
+        Renew the lease now.
+
+        :return: False if the lease expired and another worker took the
+            channel.
+        """
+        if self.channel_id in renew_crawl_leases(self.conn, self.lane, self.owner):
+            self.renewed_at = time.monotonic()
+            self.unreachable = False
+            return True
+
+        self.lost = True
+        logger.warning('Lost the {0} lease on channel {1} to another worker'.format(
+            self.lane, self.channel_id,
+        ))
+        return False
+
+    def release(self) -> None:
+        """Give the channel back. A lease already taken over is left alone."""
+        release_crawl_leases(self.conn, [self.channel_id], self.lane, self.owner)
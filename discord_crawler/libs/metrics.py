@@ -0,0 +1,277 @@
+"""Process metrics in the Prometheus text format.
+
+Counters, gauges and histograms live in memory. Updating one takes a lock,
+a dict lookup and an add, so the instrumentation stays on in production.
+Totals kept elsewhere already (the rate limiters') are read when scraped
+through a `collect` callback instead of being counted twice.
+
+Every metric of the crawler is declared at the bottom of this module. A
+process calls serve() to expose them on METRICS_PORT:
+
+    curl localhost:9100/metrics
+"""
+import bisect
+import logging.config
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import settings
+from libs.ratelimit import get_limiters
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+# Seconds. From a fast local write up to a request stuck behind timeouts.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY: List['Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(n, _escape(str(v))) for n, v in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(object):
+    """
+    Base class of a metric with a fixed set of label names.
+
+    :param name: Metric name
+    :param documentation: HELP text
+    :param labels: Label names. Values are passed positionally when updating.
+    :param collect: Called on every scrape, returns {label values: value}.
+        Replaces the values kept in memory.
+    """
+
+    kind = 'untyped'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        collect: Optional[Callable[[], Dict[Tuple, float]]] = None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple, float] = {}
+        REGISTRY.append(self)
+
+    def _lines(self) -> List[str]:
+        values = self.collect() if self.collect is not None else self.values
+        with self.lock:
+            items = sorted(values.items())
+        return [
+            '{0}{1} {2}'.format(self.name, _format_labels(self.labels, key), _format_value(value))
+            for key, value in items
+        ]
+
+    def render(self) -> str:
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.documentation),
+            '# TYPE {0} {1}'.format(self.name, self.kind),
+        ]
+        lines.extend(self._lines())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, *labels: str, value: float) -> None:
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    """Cumulative histogram with fixed upper bounds, rendered with _bucket, _sum and _count."""
+
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # label values: [count per bucket (last is +Inf), sum]
+        self.series: Dict[Tuple, list] = {}
+
+    def observe(self, *labels: str, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def _lines(self) -> List[str]:
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.series.items())
+
+        lines = []
+        names = self.labels + ('le',)
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, _format_labels(names, key + (_format_value(bound),)), cumulative,
+                ))
+            labels = _format_labels(self.labels, key)
+            lines.append('{0}_sum{1} {2}'.format(self.name, labels, _format_value(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, labels, cumulative))
+        return lines
+
+
+def render() -> str:
+    """Every registered metric in the Prometheus text format."""
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:
+        try:
+            body = render().encode()
+        except Exception:
+            logger.exception('Could not render metrics')
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # One line per scrape is noise.
+        pass
+
+
+def serve(port: int = None, host: str = None) -> Optional[ThreadingHTTPServer]:
+    """
+    Serve the metrics on a background thread.
+
+    :param port: Port to listen on. Default METRICS_PORT; 0 disables.
+    :param host: Address to bind. Default METRICS_HOST
+    :return: The server, or None when disabled
+    """
+    port = settings.METRICS_PORT if port is None else port
+    host = settings.METRICS_HOST if host is None else host
+    if not port:
+        return None
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on http://{0}:{1}/metrics'.format(host, port))
+    return server
+
+
+REQUEST_SECONDS = Histogram(
+    'discord_crawler_request_seconds',
+    'Discord API request latency, rate limit waits excluded',
+    ['route', 'selfbot'],
+)
+RESPONSES = Counter(
+    'discord_crawler_responses_total',
+    'Discord API responses by status code',
+    ['route', 'selfbot', 'status'],
+)
+RATE_LIMITED = Counter(
+    'discord_crawler_rate_limited_total',
+    '429 responses received',
+    ['selfbot'],
+    collect=lambda: {(limiter.name,): limiter.rate_limited for limiter in get_limiters()},
+)
+RATE_LIMIT_WAIT_SECONDS = Counter(
+    'discord_crawler_rate_limit_wait_seconds_total',
+    'Seconds spent waiting for rate limits, before requests and after 429s',
+    ['selfbot'],
+    collect=lambda: {(limiter.name,): limiter.wait_seconds for limiter in get_limiters()},
+)
+PAGES = Counter(
+    'discord_crawler_pages_total',
+    'Message pages fetched by message_history',
+)
+MESSAGES_FETCHED = Counter(
+    'discord_crawler_messages_fetched_total',
+    'Messages fetched by message_history',
+)
+MESSAGES_INSERTED = Counter(
+    'discord_crawler_messages_inserted_total',
+    'Fetched messages that were new. The rest of messages_fetched were duplicates',
+)
+DB_WRITE_SECONDS = Histogram(
+    'discord_crawler_db_write_seconds',
+    'Duration of database writes (transactions) by what was written',
+    ['operation'],
+)
+CHANNELS_CLAIMED = Counter(
+    'discord_crawler_channels_claimed_total',
+    'Channels leased for crawling by message_history',
+)
+CLAIM_QUEUE = Gauge(
+    'discord_crawler_claim_queue_channels',
+    'Claimed channels waiting in a worker',
+    ['worker'],
+)
+WRITE_QUEUE = Gauge(
+    'discord_crawler_write_queue_pages',
+    'Pages waiting for a PageWriter',
+    ['writer'],
+)
+GATEWAY_EVENTS = Counter(
+    'discord_crawler_gateway_events_total',
+    'Message events received from the gateway',
+    ['event'],
+)
+GATEWAY_CONNECTED = Gauge(
+    'discord_crawler_gateway_connected',
+    'Whether the selfbot\'s gateway session is ready',
+    ['selfbot'],
+)
+GATEWAY_CURSORS_ADVANCED = Counter(
+    'discord_crawler_gateway_cursors_advanced_total',
+    'Channel cursors moved by gateway_ingest, sparing message_history a crawl',
+)
+ATTACHMENTS = Counter(
+    'discord_crawler_attachments_total',
+    'Attachment downloads by result: stored, duplicate (content stored already), retry or failed',
+    ['result'],
+)
+ATTACHMENT_BYTES = Counter(
+    'discord_crawler_attachment_bytes_total',
+    'Attachment bytes downloaded',
+)
@@ -0,0 +1,252 @@
+"""Write stage of a crawl, overlapping database writes with fetching.
+
+A crawl worker fetches a page, works out the cursor it covers and hands the
+encoded page to its PageWriter (the transform step is cheap: the page keeps
+its response body, see libs/codec.py). The writer thread stores pages in
+the order they were appended, each batch in one transaction together with
+the channel cursors it covers, while the worker fetches the next page.
+The bookkeeping at the end of a crawl (crawl log, next crawl, lease) is
+queued behind the channel's pages as an update record and stored with them.
+
+The queue between the two is bounded, so a slow database slows fetching
+down instead of filling memory. The writer takes whatever is queued, up to
+a batch size it adapts to the measured write time: batches grow while
+writes are fast and shrink when they take longer than WRITE_TARGET_LATENCY.
+"""
+import logging.config
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import psycopg
+
+import settings
+from libs.codec import dumps, loads
+from libs.db_operations import (
+    get_db_conn,
+    insert_message_pages,
+    advance_channel_cursor,
+    channel_crawl_enabled,
+    channel_schedule_next_crawl,
+    create_channel_crawl_log,
+    release_crawl_leases,
+)
+from libs.metrics import DB_WRITE_SECONDS, MESSAGES_INSERTED, WRITE_QUEUE
+from libs.spool import Record
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+def channel_cursors(records: List[Record]) -> Dict[int, Tuple[int, Optional[int]]]:
+    """
+    Cursor range every channel in a batch of records covers.
+
+    :return: Dict of channel_id: (highest high_id, lowest low_id or None)
+    """
+    cursors: Dict[int, Tuple[int, Optional[int]]] = {}
+    for record in records:
+        if record.is_update:
+            continue
+        high_id, low_id = cursors.get(record.channel_id, (record.high_id, record.low_id))
+        high_id = max(high_id, record.high_id)
+        if record.low_id is not None:
+            low_id = record.low_id if low_id is None else min(low_id, record.low_id)
+        cursors[record.channel_id] = (high_id, low_id)
+    return cursors
+
+
+def apply_update(conn: psycopg.Connection, channel_id: int, update: Dict) -> None:
+    """
+    Apply a channel update record. Every key is optional:
+
+        crawl_enabled: False to disable a channel the API refused
+        crawl_log: low_id, high_id, started_at, ended_at (ISO timestamps)
+            of a crawl that reached the end of the channel
+        schedule: message_rate, messages and interval of
+            channel_schedule_next_crawl
+        release: lane and owner of the crawl lease to give back
+
+    :param conn: Database handle
+    :param channel_id: Channel the update belongs to
+    :param update: Decoded update
+    :return: None
+    """
+    if 'crawl_enabled' in update:
+        channel_crawl_enabled(conn, channel_id, update['crawl_enabled'])
+
+    log = update.get('crawl_log')
+    if log:
+        create_channel_crawl_log(
+            conn=conn,
+            channel_id=channel_id,
+            low_id=log['low_id'],
+            high_id=log['high_id'],
+            start_time=datetime.fromisoformat(log['started_at']),
+            end_time=datetime.fromisoformat(log['ended_at']),
+        )
+
+    schedule = update.get('schedule')
+    if schedule:
+        channel_schedule_next_crawl(conn, channel_id, **schedule)
+
+    release = update.get('release')
+    if release:
+        release_crawl_leases(conn, [channel_id], release['lane'], release['owner'])
+
+
+def store_records(conn: psycopg.Connection, records: List[Record]) -> int:
+    """
+    Insert the pages of a batch of records, move the cursors they cover and
+    apply the channel updates among them. Call it in a transaction.
+
+    :param conn: Database handle
+    :param records: Pages, cursors and updates, see libs/spool.py
+    :return: New messages inserted
+    """
+    cursors = channel_cursors(records)
+    inserted = insert_message_pages(conn, [record.payload for record in records if not record.is_update])
+    # Same lock order in every transaction.
+    for channel_id in sorted(cursors):
+        high_id, low_id = cursors[channel_id]
+        advance_channel_cursor(conn, channel_id, high_id=high_id, low_id=low_id)
+
+    updates = sorted((record for record in records if record.is_update), key=lambda record: record.channel_id)
+    for record in updates:
+        apply_update(conn, record.channel_id, loads(record.payload))
+    return inserted
+
+
+class PageWriter(object):
+    """
+    Background writer for the pages of one crawl worker. It has its own
+    connection so the worker's connection stays free for leases.
+
+    The interface matches Spool, so a worker can write to either.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        queue_pages: int = settings.PIPELINE_QUEUE_PAGES,
+        max_batch: int = settings.WRITE_MAX_BATCH,
+        target_latency: float = settings.WRITE_TARGET_LATENCY,
+    ):
+        """
+        :param name: Thread name
+        :param queue_pages: Pages that may wait to be written before append
+            blocks
+        :param max_batch: Most pages written in one transaction
+        :param target_latency: Seconds one batch write should take
+        """
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_pages)
+        self.max_batch = max_batch
+        self.target_latency = target_latency
+        self.batch = 1
+        self.conn: Optional[psycopg.Connection] = None
+        self.error: Optional[psycopg.Error] = None
+        self.name = name
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _check(self) -> None:
+        """Raise the error of a failed write, once its crawl's pages are dropped."""
+        if self.error is not None:
+            self.queue.join()
+            error, self.error = self.error, None
+            raise error
+
+    def append(
+        self,
+        channel_id: int,
+        high_id: int,
+        low_id: Optional[int] = None,
+        payload: bytes = b'',
+    ) -> None:
+        """
+        Queue a page. Blocks while the queue is full.
+
+        :param channel_id: Channel the page belongs to
+        :param high_id: Channel cursor high_message_id covered by the page
+        :param low_id: Channel cursor low_message_id covered by the page
+        :param payload: JSON array of messages, empty to only move the cursor
+        :return: None
+        """
+        self._check()
+        self.queue.put(Record(channel_id, high_id, low_id, payload))
+
+    def append_update(self, channel_id: int, update: Dict) -> None:
+        """
+        Queue an update to the channel's crawl bookkeeping, stored together
+        with the pages queued before it.
+
+        :param channel_id: Channel to update
+        :param update: See apply_update
+        :return: None
+        """
+        self.append(channel_id, 0, None, dumps(update))
+
+    def flush(self) -> None:
+        """Wait until every queued page is stored. Raises if a write failed."""
+        self.queue.join()
+        self._check()
+
+    def close(self) -> None:
+        """Write what is queued and stop the thread."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.conn is not None:
+            self.conn.close()
+
+    def _take(self) -> Tuple[List[Record], bool]:
+        """Next batch: one record, waiting for it, and what else is queued."""
+        records = []
+        stop = False
+        record = self.queue.get()
+        while record is not None:
+            records.append(record)
+            if len(records) >= self.batch:
+                break
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+        else:
+            stop = True
+        WRITE_QUEUE.set(self.name, value=self.queue.qsize())
+        return records, stop
+
+    def _write(self, records: List[Record]) -> None:
+        if self.conn is None or self.conn.broken:
+            self.conn = get_db_conn()
+
+        started_at = time.monotonic()
+        with self.conn.transaction():
+            inserted = store_records(self.conn, records)
+        elapsed = time.monotonic() - started_at
+        DB_WRITE_SECONDS.observe('messages', value=elapsed)
+        MESSAGES_INSERTED.inc(amount=inserted)
+
+        if elapsed > self.target_latency:
+            self.batch = max(1, self.batch // 2)
+        elif elapsed < self.target_latency / 2 and len(records) == self.batch:
+            self.batch = min(self.max_batch, self.batch * 2)
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            records, stop = self._take()
+            # After a failed write the rest of that crawl is dropped, so no
+            # cursor moves past the missing page.
+            if records and self.error is None:
+                try:
+                    self._write(records)
+                except psycopg.Error as e:
+                    logger.warning('Writing {0} pages failed: {1}'.format(len(records), e))
+                    self.error = e
+
+            for _ in range(len(records) + stop):
+                self.queue.task_done()
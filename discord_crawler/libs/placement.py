@@ -0,0 +1,158 @@
+"""Balance guilds over selfbot accounts.
+
+Each guild has a demand, the message page requests per hour its channels
+cost at their measured message rate and crawl priority (see
+scheduler.requests_per_hour), and can only be given to a selfbot that is a
+member of it. Each selfbot has a capacity, its crawl workers. The planner
+looks for the assignment with the smallest maximum load (demand / capacity)
+over all selfbots:
+
+  1. Longest processing time first: guilds by demand, biggest first, each to
+     the eligible selfbot that ends up least loaded. Ties keep the current
+     selfbot so a balanced setup is left alone.
+  2. Local search: move or swap guilds off the most loaded selfbot while
+     that lowers the maximum.
+"""
+from typing import Dict, List, Optional, Tuple
+
+
+# Loads closer than this are treated as equal, so rounding noise does not
+# move guilds around.
+EPSILON = 1e-9
+
+
+class Guild(object):
+    __slots__ = ('id', 'name', 'demand', 'members', 'selfbot_id')
+
+    def __init__(
+        self,
+        id: int,
+        name: str,
+        demand: float,
+        members: List[int],
+        selfbot_id: Optional[int] = None,
+    ):
+        self.id = id
+        self.name = name
+        self.demand = demand
+        self.members = members
+        self.selfbot_id = selfbot_id
+
+
+def loads(
+    guilds: List[Guild],
+    assignment: Dict[int, int],
+    capacities: Dict[int, float],
+) -> Dict[int, float]:
+    """
+    Load of every selfbot under an assignment.
+
+    :param guilds: Guilds to place
+    :param assignment: guild id -> selfbot id
+    :param capacities: selfbot id -> capacity
+    :return: selfbot id -> requests/hour per unit of capacity
+    """
+    result = {selfbot_id: 0.0 for selfbot_id in capacities}
+    for guild in guilds:
+        selfbot_id = assignment.get(guild.id)
+        if selfbot_id in result:
+            result[selfbot_id] += guild.demand / capacities[selfbot_id]
+    return result
+
+
+def _longest_first(guilds: List[Guild], capacities: Dict[int, float]) -> Dict[int, int]:
+    assignment: Dict[int, int] = {}
+    load = {selfbot_id: 0.0 for selfbot_id in capacities}
+
+    for guild in sorted(guilds, key=lambda g: (-g.demand, g.id)):
+        best: Optional[Tuple[float, int, int]] = None
+        for selfbot_id in guild.members:
+            after = load[selfbot_id] + guild.demand / capacities[selfbot_id]
+            key = (after, selfbot_id != guild.selfbot_id, selfbot_id)
+            if best is None or key < best:
+                best = key
+        assignment[guild.id] = best[2]
+        load[best[2]] += guild.demand / capacities[best[2]]
+
+    return assignment
+
+
+def _improve(
+    guilds: List[Guild],
+    assignment: Dict[int, int],
+    capacities: Dict[int, float],
+    max_rounds: int,
+) -> Dict[int, int]:
+    by_id = {guild.id: guild for guild in guilds}
+
+    for _ in range(max_rounds):
+        load = loads(guilds, assignment, capacities)
+        worst = max(load, key=load.get)
+        peak = load[worst]
+        best_peak = peak
+        best_change: Optional[List[Tuple[int, int]]] = None
+
+        mine = [by_id[guild_id] for guild_id, selfbot_id in assignment.items() if selfbot_id == worst]
+
+        for guild in mine:
+            share = guild.demand / capacities[worst]
+
+            for other in guild.members:
+                if other == worst:
+                    continue
+                # Move the guild over.
+                moved = load[other] + guild.demand / capacities[other]
+                new_peak = max(peak - share, moved)
+                if new_peak < best_peak - EPSILON:
+                    best_peak, best_change = new_peak, [(guild.id, other)]
+
+                # Swap it for a smaller guild of `other` that `worst` can take.
+                for swap_id, swap_owner in assignment.items():
+                    swap = by_id[swap_id]
+                    if swap_owner != other or worst not in swap.members or swap.demand >= guild.demand:
+                        continue
+                    worst_after = peak - share + swap.demand / capacities[worst]
+                    other_after = moved - swap.demand / capacities[other]
+                    new_peak = max(worst_after, other_after)
+                    if new_peak < best_peak - EPSILON:
+                        best_peak, best_change = new_peak, [(guild.id, other), (swap_id, worst)]
+
+        if best_change is None:
+            break
+        for guild_id, selfbot_id in best_change:
+            assignment[guild_id] = selfbot_id
+
+    return assignment
+
+
+def plan_placement(
+    guilds: List[Guild],
+    capacities: Dict[int, float],
+    max_rounds: int = 1000,
+) -> Dict[int, int]:
+    """
+    Assign every guild to one of its member selfbots, minimising the
+    maximum load.
+
+    Guilds without an eligible member keep their current selfbot.
+
+    :param guilds: Guilds with their demand and member selfbots
+    :param capacities: selfbot id -> capacity. Selfbots not listed are
+        not eligible.
+    :param max_rounds: Cap on local search moves
+    :return: guild id -> selfbot id
+    """
+    placeable = []
+    fixed: Dict[int, int] = {}
+
+    for guild in guilds:
+        members = [selfbot_id for selfbot_id in guild.members if capacities.get(selfbot_id, 0) > 0]
+        if members:
+            placeable.append(Guild(guild.id, guild.name, guild.demand, members, guild.selfbot_id))
+        elif guild.selfbot_id is not None:
+            fixed[guild.id] = guild.selfbot_id
+
+    assignment = _longest_first(placeable, capacities)
+    assignment = _improve(placeable, assignment, capacities, max_rounds)
+    assignment.update(fixed)
+    return assignment
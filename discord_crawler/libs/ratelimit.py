@@ -0,0 +1,285 @@
+"""Client side rate limiting driven by Discord's X-RateLimit headers.
+
+Discord groups routes into buckets. A bucket is identified by the
+`X-RateLimit-Bucket` hash plus the route's major parameter (channel_id or
+guild_id) and tells us how many requests are left in the current window.
+We track every bucket we have seen for a token and hold requests back until
+the window resets rather than sending them and collecting a 429.
+
+https://discord.com/developers/docs/topics/rate-limits
+"""
+import logging.config
+import threading
+import time
+from typing import Dict, List, Mapping, Optional
+
+import settings
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+# Small safety margin added to every wait so we land after the server resets.
+RESET_MARGIN = 0.05
+
+
+class Bucket(object):
+    __slots__ = ('name', 'limit', 'remaining', 'reset_at', 'window')
+
+    def __init__(self, name: str, limit: int, remaining: int, reset_at: float, window: float):
+        self.name = name
+        self.limit = limit
+        self.remaining = remaining
+        self.reset_at = reset_at
+        self.window = window
+
+
+class RateLimiter(object):
+    """
+    Rate limit state for one token.
+
+    Thread-safe. `reserve` never sleeps itself; it returns how long the caller
+    must wait so the same limiter serves both the threaded and asyncio
+    clients.
+    """
+
+    def __init__(self, name: str, global_per_second: int = None):
+        self.name = name
+        self.global_per_second = global_per_second or settings.RATE_LIMIT_GLOBAL_PER_SECOND
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, Bucket] = {}
+        self.route_buckets: Dict[str, str] = {}
+        self.global_reset_at = 0.0
+        self.window_start = 0.0
+        self.window_count = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.wait_seconds = 0.0
+
+    def _key(self, route: str, major: Optional[int]) -> str:
+        return '{0}:{1}'.format(self.route_buckets.get(route, route), major)
+
+    def reserve(self, route: str, major: Optional[int] = None) -> float:
+        """
+        Take a slot for a request to `route`.
+
+        :param route: Route template, e.g. 'channels/{channel_id}/messages'
+        :param major: The route's major parameter (channel_id / guild_id)
+        :return: 0 if the request may go now, otherwise seconds to wait
+            before calling reserve again.
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            if now < self.global_reset_at:
+                return self.global_reset_at - now
+
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_count = 0
+
+            if self.window_count >= self.global_per_second:
+                return self.window_start + 1 - now
+
+            bucket = self.buckets.get(self._key(route, major))
+
+            if bucket is not None:
+                if now >= bucket.reset_at:
+                    bucket.remaining = bucket.limit
+                    bucket.reset_at = now + bucket.window
+                if bucket.remaining <= 0:
+                    return bucket.reset_at - now + RESET_MARGIN
+                bucket.remaining -= 1
+
+            self.window_count += 1
+            self.requests += 1
+            return 0
+
+    def record_wait(self, seconds: float) -> None:
+        with self.lock:
+            self.wait_seconds += seconds
+
+    def update(
+        self,
+        route: str,
+        major: Optional[int],
+        headers: Mapping,
+        status: int,
+        body: Optional[Dict] = None,
+    ) -> float:
+        """
+        Update bucket state from a response.
+
+        :param route: Route template the request was reserved against
+        :param major: The route's major parameter
+        :param headers: Response headers (case-insensitive mapping)
+        :param status: HTTP status code
+        :param body: Decoded body of a 429 response, if any
+        :return: Seconds to wait before retrying when status is 429, else 0
+        """
+        now = time.monotonic()
+        bucket_hash = headers.get('X-RateLimit-Bucket')
+        limit = headers.get('X-RateLimit-Limit')
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+
+        with self.lock:
+            if bucket_hash:
+                self.route_buckets[route] = bucket_hash
+
+            if limit is not None and remaining is not None and reset_after is not None:
+                key = self._key(route, major)
+                reset_at = now + float(reset_after)
+                bucket = self.buckets.get(key)
+
+                if bucket is None:
+                    self.buckets[key] = Bucket(
+                        key, int(limit), int(remaining), reset_at, float(reset_after),
+                    )
+                else:
+                    # A reset further out than the one we know means the
+                    # server started a new window. Otherwise requests still
+                    # in flight have already been counted locally.
+                    if reset_at > bucket.reset_at + RESET_MARGIN:
+                        bucket.remaining = int(remaining)
+                    else:
+                        bucket.remaining = min(bucket.remaining, int(remaining))
+                    bucket.limit = int(limit)
+                    bucket.reset_at = reset_at
+                    bucket.window = max(bucket.window, float(reset_after))
+
+            if status != 429:
+                return 0
+
+            self.rate_limited += 1
+            body = body or {}
+            retry_after = float(
+                body.get('retry_after') or headers.get('Retry-After') or reset_after or 1
+            )
+
+            if body.get('global') or headers.get('X-RateLimit-Global'):
+                self.global_reset_at = now + retry_after
+            elif bucket_hash or limit is not None:
+                bucket = self.buckets.get(self._key(route, major))
+                if bucket is not None:
+                    bucket.remaining = 0
+                    bucket.reset_at = max(bucket.reset_at, now + retry_after)
+
+            return retry_after
+
+    def headroom(self, route: str, major: Optional[int] = None) -> float:
+        """
+        Fraction of the budget still available for `route`: the smaller of
+        what is left in its bucket (1.0 if unknown) and in the token's global
+        per-second window.
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            if now < self.global_reset_at:
+                return 0.0
+
+            headroom = 1.0
+            if now - self.window_start < 1:
+                headroom = max(self.global_per_second - self.window_count, 0) / self.global_per_second
+
+            bucket = self.buckets.get(self._key(route, major))
+            if bucket is None or now >= bucket.reset_at or not bucket.limit:
+                return headroom
+            return min(headroom, max(bucket.remaining, 0) / bucket.limit)
+
+    def snapshot(self) -> Dict:
+        """
+        Current limiter state for operators.
+
+        :return: Totals for the token plus one entry per known bucket
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            buckets: List[Dict] = []
+            for bucket in self.buckets.values():
+                if now >= bucket.reset_at:
+                    continue
+                buckets.append({
+                    'bucket': bucket.name,
+                    'limit': bucket.limit,
+                    'remaining': bucket.remaining,
+                    'reset_after': round(bucket.reset_at - now, 3),
+                })
+
+            return {
+                'name': self.name,
+                'requests': self.requests,
+                'rate_limited': self.rate_limited,
+                'wait_seconds': round(self.wait_seconds, 3),
+                'global_reset_after': round(max(self.global_reset_at - now, 0), 3),
+                'requests_this_second': self.window_count if now - self.window_start < 1 else 0,
+                'global_per_second': self.global_per_second,
+                'exhausted_buckets': sum(1 for b in buckets if b['remaining'] <= 0),
+                'buckets': sorted(buckets, key=lambda b: b['remaining']),
+            }
+
+    def prune(self) -> None:
+        """Forget buckets whose window ended long ago."""
+        cutoff = time.monotonic() - 60
+
+        with self.lock:
+            for key in [k for k, b in self.buckets.items() if b.reset_at < cutoff]:
+                del self.buckets[key]
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(token: str, name: str = None) -> RateLimiter:
+    """
+    Get the shared RateLimiter for a token, creating it on first use.
+
+    :param token: selfbot token. Rate limits are per token.
+    :param name: Human readable name used in reports, e.g. the selfbot username
+    :return: RateLimiter
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(token)
+
+        if limiter is None:
+            limiter = RateLimiter(name or 'token-{0}'.format(len(_limiters) + 1))
+            _limiters[token] = limiter
+        elif name:
+            limiter.name = name
+
+        return limiter
+
+
+def get_limiters() -> List[RateLimiter]:
+    with _limiters_lock:
+        return list(_limiters.values())
+
+
+def snapshot() -> List[Dict]:
+    """State of every limiter in this process, one entry per selfbot."""
+    return [limiter.snapshot() for limiter in get_limiters()]
+
+
+def log_snapshot() -> None:
+    """Log one summary line per selfbot: how close it runs to its ceiling."""
+    for state in snapshot():
+        tightest = state['buckets'][0] if state['buckets'] else None
+        logger.info(
+            'Rate limits {0} | requests: {1} | 429s: {2} | waited: {3}s | '
+            'this second: {4}/{5} | exhausted buckets: {6} | tightest: {7}'.format(
+                state['name'],
+                state['requests'],
+                state['rate_limited'],
+                state['wait_seconds'],
+                state['requests_this_second'],
+                state['global_per_second'],
+                state['exhausted_buckets'],
+                '{0} {1}/{2}'.format(
+                    tightest['bucket'], tightest['remaining'], tightest['limit'],
+                ) if tightest else '-',
+            )
+        )
@@ -0,0 +1,111 @@
+"""Activity-weighted crawl scheduling.
+
+Each channel keeps a smoothed estimate of its message rate. After a crawl the
+channel's next crawl is set so that, at that rate, roughly
+CRAWL_TARGET_MESSAGES messages will be waiting: busy channels come back
+quickly and quiet ones back off, never beyond CRAWL_MAX_STALENESS.
+guild.crawl_priority scales the interval.
+"""
+import math
+from typing import Optional, List
+
+import settings
+from libs.api import MESSAGE_LIMIT
+from libs.snowflake import snowflake_to_timestamp_ms
+
+
+# Shortest window a rate is measured over, so one burst does not explode it.
+MIN_RATE_WINDOW = 60
+
+
+def priority_multiplier(priority: Optional[int]) -> float:
+    """
+    How much more often a guild's channels are crawled.
+
+    0 is neutral. Each step up adds one more multiple (1 -> 2x, 2 -> 3x) and
+    each step down divides the same way (-1 -> 1/2x, -2 -> 1/3x).
+    """
+    priority = priority or 0
+    if priority >= 0:
+        return 1.0 + priority
+    return 1.0 / (1 - priority)
+
+
+def page_rate(message_ids: List[int]) -> Optional[float]:
+    """
+    Messages per hour implied by the snowflake timestamps of one page.
+
+    Used for a channel's first crawl, when there is no previous crawl to
+    measure against.
+    """
+    if len(message_ids) < 2:
+        return None
+
+    span = (snowflake_to_timestamp_ms(max(message_ids)) - snowflake_to_timestamp_ms(min(message_ids))) / 1000
+    return len(message_ids) * 3600 / max(span, MIN_RATE_WINDOW)
+
+
+def estimate_rate(
+    previous_rate: Optional[float],
+    messages: int,
+    window: Optional[float],
+    first_page_ids: Optional[List[int]] = None,
+) -> float:
+    """
+    Update a channel's message rate after a crawl.
+
+    :param previous_rate: Smoothed rate in messages/hour before this crawl
+    :param messages: Messages fetched by this crawl
+    :param window: Seconds since the previous crawl finished
+    :param first_page_ids: Message ids of the newest page, only passed on a
+        channel's first crawl to seed the rate
+    :return: Smoothed rate in messages/hour
+    """
+    if first_page_ids:
+        seeded = page_rate(first_page_ids)
+        if seeded is not None:
+            return seeded
+
+    if window is None:
+        return previous_rate or 0.0
+
+    observed = messages * 3600 / max(window, MIN_RATE_WINDOW)
+    alpha = settings.CRAWL_RATE_SMOOTHING
+    return alpha * observed + (1 - alpha) * (previous_rate or 0.0)
+
+
+def next_crawl_interval(rate: float, priority: Optional[int] = 0) -> float:
+    """
+    Seconds until a channel should be crawled again.
+
+    :param rate: Smoothed message rate in messages/hour
+    :param priority: guild.crawl_priority
+    :return: Seconds, between CRAWL_MIN_INTERVAL and CRAWL_MAX_STALENESS
+    """
+    if rate > 0:
+        interval = settings.CRAWL_TARGET_MESSAGES * 3600 / rate
+    else:
+        interval = settings.CRAWL_MAX_STALENESS
+
+    interval /= priority_multiplier(priority)
+    return min(max(interval, settings.CRAWL_MIN_INTERVAL), settings.CRAWL_MAX_STALENESS)
+
+
+def requests_per_hour(rate: float, priority: Optional[int] = 0) -> float:
+    """
+    Message page requests per hour a channel costs at its current schedule.
+
+    Every crawl pages through the messages waiting, MESSAGE_LIMIT at a time,
+    plus one request for the empty page that ends it. Channels with no new
+    messages are not claimed, so a silent channel costs nothing.
+
+    :param rate: Smoothed message rate in messages/hour
+    :param priority: guild.crawl_priority
+    :return: Requests/hour
+    """
+    if not rate or rate <= 0:
+        return 0.0
+
+    interval = next_crawl_interval(rate, priority)
+    pages = math.ceil(rate * interval / 3600 / MESSAGE_LIMIT) + 1
+    return pages * 3600 / interval
@@ -0,0 +1,33 @@
+"""Helpers for Discord snowflake ids.
+
+A snowflake carries its creation time in the top 42 bits as milliseconds
+since the Discord epoch (2015-01-01), so ids sort by time.
+
+https://discord.com/developers/docs/reference#snowflakes
+"""
+from datetime import datetime, timezone
+from typing import Union
+
+
+DISCORD_EPOCH = 1420070400000
+
+
+def snowflake_to_timestamp_ms(snowflake: Union[int, str]) -> int:
+    """Unix time in milliseconds at which the snowflake was created."""
+    return (int(snowflake) >> 22) + DISCORD_EPOCH
+
+
+def snowflake_to_datetime(snowflake: Union[int, str]) -> datetime:
+    """UTC datetime at which the snowflake was created."""
+    return datetime.fromtimestamp(snowflake_to_timestamp_ms(snowflake) / 1000, tz=timezone.utc)
+
+
+def datetime_to_snowflake(dt: datetime) -> int:
+    """
+    The lowest snowflake that can be created at `dt`.
+
+    Naive datetimes are taken as UTC.
+    """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return max(int(dt.timestamp() * 1000) - DISCORD_EPOCH, 0) << 22
@@ -0,0 +1,304 @@
+"""Append-only spool of fetched message pages on local disk.
+
+message_history appends every page here instead of writing it to Postgres
+itself, so a slow or unavailable database does not hold up the crawl.
+spool_drain.py replays the pages into the database.
+
+The spool is a directory of numbered segment files. Each record is
+
+    header: payload length, crc32, channel_id, high_id, low_id
+    payload: the page as a JSON array (the response body), may be empty
+
+high_id / low_id are the channel cursor the page covers. The cursor is only
+moved by the drainer, in the transaction that stores the page, so a page lost
+from the spool is fetched again on the channel's next crawl.
+
+A payload that is a JSON object instead of an array is an update to the
+channel's crawl bookkeeping (see libs/pipeline.py store_records): the crawl
+log entry, the next crawl, disabling the channel and giving back its lease.
+It is queued behind the channel's pages and stored with them, so a crawl is
+only recorded once everything it fetched is in the database. Its high_id
+and low_id are 0 and move nothing.
+
+Appends are written straight away and fsynced by a background thread every
+SPOOL_FSYNC_INTERVAL seconds, so many pages share one fsync. A crash can
+leave a torn record at the end of the last segment; the writer always starts
+a new segment, and the reader skips to the next segment when it finds one.
+"""
+import logging.config
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import settings
+from libs.codec import dumps
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+HEADER = struct.Struct('<IIqqq')
+SEGMENT_SUFFIX = '.seg'
+
+# Seconds between disk usage checks while the spool is full.
+FULL_SLEEP = 1.0
+
+
+class Record(object):
+    __slots__ = ('channel_id', 'high_id', 'low_id', 'payload')
+
+    def __init__(self, channel_id: int, high_id: int, low_id: Optional[int], payload: bytes):
+        self.channel_id = channel_id
+        self.high_id = high_id
+        self.low_id = low_id
+        self.payload = payload
+
+    @property
+    def is_update(self) -> bool:
+        """Whether the payload is a channel update rather than a page."""
+        return self.payload[:1] == b'{'
+
+
+def encode_record(channel_id: int, high_id: int, low_id: Optional[int], payload: bytes) -> bytes:
+    fields = HEADER.pack(len(payload), 0, channel_id, high_id, low_id or 0)[8:]
+    crc = zlib.crc32(payload, zlib.crc32(fields))
+    return struct.pack('<II', len(payload), crc) + fields + payload
+
+
+def segment_name(number: int) -> str:
+    return '{0:012d}{1}'.format(number, SEGMENT_SUFFIX)
+
+
+def list_segments(directory: str) -> List[int]:
+    """Numbers of the segment files in a spool directory, in order."""
+    return sorted(
+        int(name[:-len(SEGMENT_SUFFIX)])
+        for name in os.listdir(directory)
+        if name.endswith(SEGMENT_SUFFIX)
+    )
+
+
+def disk_usage(directory: str) -> int:
+    """Bytes used by the segment files in a spool directory."""
+    total = 0
+    for number in list_segments(directory):
+        try:
+            total += os.path.getsize(os.path.join(directory, segment_name(number)))
+        except FileNotFoundError:
+            # Drained and deleted meanwhile.
+            pass
+    return total
+
+
+class Spool(object):
+    """
+    Writer side of a spool directory. Thread-safe; one writing process per
+    directory.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        segment_bytes: int,
+        fsync_interval: float,
+    ):
+        """
+        :param directory: Spool directory, created if missing
+        :param max_bytes: Disk space the segments may use. append blocks
+            beyond that until the drainer catches up.
+        :param segment_bytes: Start a new segment file after this many bytes
+        :param fsync_interval: Seconds between fsyncs of appended records
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+
+        self.lock = threading.Lock()
+        self.used = disk_usage(directory)
+        self.dirty = False
+        self.file = None
+        self.file_bytes = 0
+        # A previous run may have left a torn record in its last segment, so
+        # never append to it.
+        segments = list_segments(directory)
+        self.segment = segments[-1] + 1 if segments else 1
+        self._open_segment()
+
+        self.stop = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, name='spool-fsync', daemon=True)
+        self.flusher.start()
+
+    def _open_segment(self) -> None:
+        path = os.path.join(self.directory, segment_name(self.segment))
+        self.file = open(path, 'ab')
+        self.file_bytes = 0
+
+    def _sync(self) -> None:
+        """Flush and fsync the current segment. Hold the lock."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.dirty = False
+
+    def _flush_loop(self) -> None:
+        checked_at = time.monotonic()
+        while not self.stop.wait(self.fsync_interval):
+            with self.lock:
+                if self.dirty:
+                    self._sync()
+
+            # The drainer deletes segments behind our back.
+            if time.monotonic() - checked_at >= FULL_SLEEP:
+                used = disk_usage(self.directory)
+                with self.lock:
+                    self.used = used
+                checked_at = time.monotonic()
+
+    def _wait_for_space(self, size: int) -> None:
+        warned = False
+        while True:
+            with self.lock:
+                if self.used + size <= self.max_bytes:
+                    return
+            if not warned:
+                logger.warning('Spool {0} is full ({1} bytes). Waiting for the drainer'.format(
+                    self.directory, self.used,
+                ))
+                warned = True
+            time.sleep(FULL_SLEEP)
+            used = disk_usage(self.directory)
+            with self.lock:
+                self.used = used
+
+    def append(
+        self,
+        channel_id: int,
+        high_id: int,
+        low_id: Optional[int] = None,
+        payload: bytes = b'',
+    ) -> None:
+        """
+        Append a page. Blocks while the spool is full.
+
+        :param channel_id: Channel the page belongs to
+        :param high_id: Channel cursor high_message_id covered by the page
+        :param low_id: Channel cursor low_message_id covered by the page
+        :param payload: JSON array of messages, empty to only move the cursor
+        :return: None
+        """
+        record = encode_record(channel_id, high_id, low_id, payload)
+        self._wait_for_space(len(record))
+
+        with self.lock:
+            if self.file_bytes and self.file_bytes + len(record) > self.segment_bytes:
+                self._sync()
+                self.file.close()
+                self.segment += 1
+                self._open_segment()
+
+            self.file.write(record)
+            self.file_bytes += len(record)
+            self.used += len(record)
+            self.dirty = True
+
+    def append_update(self, channel_id: int, update: Dict) -> None:
+        """
+        Append an update to the channel's crawl bookkeeping, stored by the
+        drainer together with the pages appended before it.
+
+        :param channel_id: Channel to update
+        :param update: See libs/pipeline.py store_records
+        :return: None
+        """
+        self.append(channel_id, 0, None, dumps(update))
+
+    def flush(self) -> None:
+        """
+        Nothing to wait for: spool_drain.py stores the pages. Lets a Spool
+        stand in for a PageWriter (libs/pipeline.py).
+        """
+
+    def close(self) -> None:
+        """Fsync what is left and stop the flusher."""
+        self.stop.set()
+        self.flusher.join()
+        with self.lock:
+            self._sync()
+            self.file.close()
+
+
+class SpoolReader(object):
+    """Reader side of a spool directory, used by the drainer."""
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def read(
+        self,
+        segment: int,
+        offset: int,
+        max_records: int,
+    ) -> Tuple[List[Record], Tuple[int, int]]:
+        """
+        Read complete records from a position on.
+
+        :param segment: Segment number to start in
+        :param offset: Byte offset in that segment
+        :param max_records: Stop after this many records
+        :return: Tuple of (records, position after the last one). The
+            position can move without records when a torn tail was skipped.
+        """
+        records: List[Record] = []
+        segments = [number for number in list_segments(self.directory) if number >= segment]
+
+        if segments and segments[0] != segment:
+            # The checkpoint's segment is gone: it was drained completely.
+            segment, offset = segments[0], 0
+
+        for i, number in enumerate(segments):
+            if number != segment:
+                continue
+            last = i == len(segments) - 1
+
+            with open(os.path.join(self.directory, segment_name(number)), 'rb') as f:
+                f.seek(offset)
+                while len(records) < max_records:
+                    header = f.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+                    length, crc, channel_id, high_id, low_id = HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length or zlib.crc32(payload, zlib.crc32(header[8:])) != crc:
+                        break
+                    records.append(Record(channel_id, high_id, low_id or None, payload))
+                    offset += HEADER.size + length
+
+            if len(records) >= max_records or last:
+                break
+
+            # Anything left in a segment that is not the last one is a torn
+            # record from a crash. The writer moved on to the next segment.
+            segment, offset = segments[i + 1], 0
+
+        return records, (segment, offset)
+
+    def delete_before(self, segment: int) -> int:
+        """
+        Delete the segments before `segment`, they are drained.
+
+        :return: Number of segments deleted
+        """
+        deleted = 0
+        for number in list_segments(self.directory):
+            if number >= segment:
+                break
+            os.remove(os.path.join(self.directory, segment_name(number)))
+            deleted += 1
+        return deleted
@@ -0,0 +1,275 @@
+"""Spread a guild's requests over every selfbot that is a member of it.
+
+guild_selfbot (filled by refresh_guilds.py) lists the selfbots in each guild.
+Requests go to the guild's own selfbot (guild.selfbot_id, balanced by
+plan_placement.py) while it has at least SPILL_HEADROOM of its rate limit
+left. Beyond that they spill over to the other members at random, weighted
+by how much of its budget each token has left for the route, so a big guild
+is crawled at the combined rate of all its members instead of one account's.
+
+A token Discord rejects is dropped: on a 401 everywhere, and its memberships
+are deactivated on the next refresh, until refresh_guilds sees it working
+again and reactivates them; on a 403 only for the channel (or, for a guild's
+channel list, the guild) it was denied, until the next refresh.
+"""
+import logging.config
+import random
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+import psycopg
+import requests
+
+import settings
+from libs.api import DiscordAPI, DiscordAPIException
+from libs.codec import loads, loads_page
+from libs.db_operations import get_guild_memberships, deactivate_selfbot_memberships
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+MESSAGES_ROUTE = 'channels/{channel_id}/messages'
+CHANNELS_ROUTE = 'guilds/{guild_id}/channels'
+
+# Headroom below which the guild's own selfbot shares requests with the
+# other members.
+SPILL_HEADROOM = 0.25
+
+# Weight of a token with no headroom left, so it is still picked now and then
+# instead of every request piling onto the others.
+MIN_WEIGHT = 0.01
+
+
+def _error_body(resp: requests.Response) -> Dict:
+    """Decode a 401 or 403 body. A proxy or Cloudflare may answer with html."""
+    try:
+        body = loads(resp.content)
+    except ValueError:
+        return {'code': resp.status_code}
+    return body if isinstance(body, dict) else {'code': resp.status_code}
+
+
+class TokenPool(object):
+    """
+    DiscordAPI clients for every selfbot, and which of them can read each guild.
+
+    Thread-safe. Call refresh periodically to pick up membership changes and
+    to write rejected tokens back to the database.
+    """
+
+    def __init__(self, selfbots: List[Dict]):
+        self.apis: Dict[int, DiscordAPI] = {
+            sb['id']: DiscordAPI(sb['token'], name=sb['username']) for sb in selfbots
+        }
+        self.lock = threading.Lock()
+        self.members: Dict[int, List[int]] = {}
+        self.home: Dict[int, int] = {}
+        self.unauthorized: Set[int] = set()
+        self.forbidden: Set[Tuple[int, int]] = set()  # (channel_id or guild_id, selfbot_id)
+        self.pending: Set[int] = set()
+
+    def refresh(self, conn: psycopg.Connection) -> None:
+        """
+        Deactivate the memberships of rejected tokens and reload the rest.
+        Rejected tokens with active memberships again (reactivated by
+        refresh_guilds) are taken back into the pool.
+
+        :param conn: Database handle
+        :return: None
+        """
+        with self.lock:
+            pending, self.pending = self.pending, set()
+
+        for selfbot_id in pending:
+            deactivate_selfbot_memberships(conn, selfbot_id)
+
+        members: Dict[int, List[int]] = {}
+        home: Dict[int, int] = {}
+        for row in get_guild_memberships(conn):
+            if row['selfbot_id'] in self.apis:
+                members.setdefault(row['guild_id'], []).append(row['selfbot_id'])
+                if row['home']:
+                    home[row['guild_id']] = row['selfbot_id']
+
+        with self.lock:
+            self.members = members
+            self.home = home
+            self.forbidden.clear()
+
+            # Tokens rejected since the deactivation above stay out until
+            # the next refresh has deactivated them too.
+            active = {selfbot_id for selfbot_ids in members.values() for selfbot_id in selfbot_ids}
+            restored = (self.unauthorized & active) - self.pending
+            self.unauthorized -= restored
+
+        for selfbot_id in restored:
+            logger.info('Token of {0} works again. Taking it back'.format(self.apis[selfbot_id].limiter.name))
+
+    def candidates(self, guild_id: int, channel_id: int) -> List[int]:
+        """Selfbots that may currently be used for a channel of `guild_id`."""
+        with self.lock:
+            return [
+                selfbot_id for selfbot_id in self.members.get(guild_id, [])
+                if selfbot_id not in self.unauthorized
+                and (channel_id, selfbot_id) not in self.forbidden
+            ]
+
+    def pick(
+        self,
+        guild_id: int,
+        channel_id: int,
+        route: str = MESSAGES_ROUTE,
+    ) -> Optional[Tuple[int, DiscordAPI]]:
+        """
+        Choose a token for a request to a channel: the guild's own selfbot
+        while it has headroom, else any member weighted by headroom.
+
+        :param guild_id: Guild of the channel
+        :param channel_id: The request's major parameter (the guild_id for
+            a guild route)
+        :param route: Route of the request, for the headroom
+        :return: (selfbot_id, DiscordAPI), or None if no token can read the channel
+        """
+        selfbot_ids = self.candidates(guild_id, channel_id)
+
+        if not selfbot_ids:
+            return None
+
+        headroom = [
+            self.apis[selfbot_id].limiter.headroom(route, channel_id)
+            for selfbot_id in selfbot_ids
+        ]
+
+        home = self.home.get(guild_id)
+        if home in selfbot_ids and headroom[selfbot_ids.index(home)] >= SPILL_HEADROOM:
+            return home, self.apis[home]
+
+        weights = [max(h, MIN_WEIGHT) for h in headroom]
+        selfbot_id = random.choices(selfbot_ids, weights=weights)[0]
+        return selfbot_id, self.apis[selfbot_id]
+
+    def drop(self, selfbot_id: int, channel_id: int, status: int) -> None:
+        """
+        Take a token out of the pool after Discord rejected it.
+
+        :param selfbot_id: The rejected selfbot
+        :param channel_id: Channel of the rejected request, or the guild for
+            a guild route
+        :param status: 401 drops the token everywhere, 403 for this channel
+        :return: None
+        """
+        name = self.apis[selfbot_id].limiter.name
+
+        with self.lock:
+            if status == 401:
+                if selfbot_id not in self.unauthorized:
+                    logger.error('Token of {0} was rejected (401). Dropping it'.format(name))
+                self.unauthorized.add(selfbot_id)
+                self.pending.add(selfbot_id)
+            else:
+                logger.warning('{0} may not read {1} ({2}). Dropping it for that channel or guild'.format(
+                    name, channel_id, status,
+                ))
+                self.forbidden.add((channel_id, selfbot_id))
+
+    def _request(
+        self,
+        guild_id: int,
+        channel_id: int,
+        route: str,
+        send: Callable[[DiscordAPI], requests.Response],
+    ) -> Union[requests.Response, Dict]:
+        """
+        Send a request with the best token, moving on to the next one after
+        a 401 or 403. See get_messages.
+
+        :param guild_id: Guild of the request
+        :param channel_id: The request's major parameter
+        :param route: Route of the request
+        :param send: Sends the request with a DiscordAPI
+        :return: The response, or the error dict of the last token tried
+            when every token was denied
+        :raises DiscordAPIException: If the pool has no token for the guild,
+            or ran out of tokens with a 401 among them
+        """
+        error: Optional[Dict] = None
+        unauthorized = False
+
+        while True:
+            picked = self.pick(guild_id, channel_id, route)
+
+            if picked is None:
+                if unauthorized:
+                    raise DiscordAPIException('No authorized token left for {0} of guild {1}'.format(
+                        route.replace('{channel_id}', str(channel_id)).replace('{guild_id}', str(guild_id)), guild_id,
+                    ))
+                if error is not None:
+                    return error
+                raise DiscordAPIException('No usable token for guild {0}'.format(guild_id))
+
+            selfbot_id, api = picked
+            resp = send(api)
+
+            if resp.status_code not in (401, 403):
+                return resp
+
+            error = _error_body(resp)
+            unauthorized = unauthorized or resp.status_code == 401
+            self.drop(selfbot_id, channel_id, resp.status_code)
+
+    def get_messages(
+        self,
+        guild_id: int,
+        channel_id: int,
+        after: int = None,
+        before: int = None,
+    ) -> Union[List[Dict], Dict]:
+        """
+        Fetch one page of messages with the best token for the channel.
+
+        A 401 or 403 drops the token and the page is retried with the next
+        one. Same return values as DiscordAPI.get_messages.
+
+        Only when every token was denied the channel (403) is the error
+        returned, which makes the crawl disable the channel. A rejected
+        token (401) says nothing about the channel, so if one was among the
+        failures this raises instead and the channel is tried again once
+        the pool is refreshed.
+
+        :param guild_id: Guild of the channel
+        :param channel_id: Discord channel snowflake
+        :param after: Only return messages newer than this snowflake
+        :param before: Only return messages older than this snowflake
+        :return: List of messages, or the error dict of the last token tried
+            when every token of the guild was denied the channel
+        :raises DiscordAPIException: If the pool has no token for the guild,
+            or ran out of tokens with a 401 among them
+        """
+        resp = self._request(
+            guild_id, channel_id, MESSAGES_ROUTE,
+            lambda api: api.get_messages(channel_id, after=after, before=before, json_response=False),
+        )
+        if isinstance(resp, dict):
+            return resp
+        return loads_page(resp.content)
+
+    def get_channels(self, guild_id: int) -> Union[List[Dict], Dict]:
+        """
+        Fetch the channel list of a guild with the best token for it, picked
+        and dropped like the tokens of get_messages.
+
+        :param guild_id: Discord guild snowflake
+        :return: List of channels, or the error dict of the last token tried
+            when every token of the guild was denied
+        :raises DiscordAPIException: If the pool has no token for the guild,
+            or ran out of tokens with a 401 among them
+        """
+        resp = self._request(
+            guild_id, guild_id, CHANNELS_ROUTE,
+            lambda api: api.get_channels(guild_id, json_response=False),
+        )
+        if isinstance(resp, dict):
+            return resp
+        return loads(resp.content)
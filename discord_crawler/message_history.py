@@ -1,24 +1,42 @@
 """Worker to get entire channel message history"""
 
 import logging.config
+import signal
+import threading
 import time
+from collections import deque
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple, Union
 
-from libs.api import DiscordAPI
+import psycopg
+
+from libs.api import DiscordAPI429
+from libs.ratelimit import log_snapshot
 import settings
 from libs.db_operations import (
     get_db_conn,
     get_selfbots,
-    upsert_messages,
-    channel_mark_last_update, channel_crawl_enabled, create_channel_crawl_log,
+    claim_channels,
+    lease_owner, renew_crawl_leases, release_crawl_leases,
+    create_message_partitions,
 )
+from libs.codec import dumps_page
+from libs.lease import Lease
+from libs import metrics
+from libs.pipeline import PageWriter
+from libs.spool import Spool
+from libs.tokens import TokenPool
+from libs.scheduler import estimate_rate, next_crawl_interval
 
 
 logging.config.dictConfig(settings.DEFAULT_LOGGING)
 logger = logging.getLogger(__name__)
 
 
+# Seconds between checks that next months' message partitions exist.
+PARTITION_CHECK_INTERVAL = 3600
+
+
 def get_snowflake(message_list: List) -> Optional[int]:
     """
     Get the snowflake with the highest ID in a message list.
@@ -26,7 +44,7 @@ def get_snowflake(message_list: List) -> Optional[int]:
     :param message_list:
     :return: Integer - the lowest snowflake message id or None
     """
-    message_ids = [message['id'] for message in message_list if 'id' in message]
+    message_ids = [int(message['id']) for message in message_list if 'id' in message]
 
     if message_ids:
         return max(message_ids)
@@ -34,111 +52,310 @@ def get_snowflake(message_list: List) -> Optional[int]:
     return None
 
 
+def crawl_channel(
+    pool: TokenPool,
+    channel: Dict,
+    snowflake: int,
+    writer: Union[PageWriter, Spool],
+    lease: Optional[Lease] = None,
+) -> Tuple[int, Optional[List[int]]]:
+    """
+    Page forward through a channel from `snowflake` until no messages are left.
+
+    A channel without a snowflake starts from its newest page.
+
+    Each page goes to `writer` with the cursor it covers and the next page
+    is fetched while it is written. The writer stores pages in order, each
+    together with its cursor. Once the end of the channel is reached a crawl
+    log entry covering the crawled range is queued behind the pages, and a
+    channel the API refuses is disabled the same way, so the crawl itself
+    needs no database.
+
+    :param pool: Tokens of every selfbot in the channel's guild
+    :param channel: Claimed channel row
+    :param snowflake: Message id to continue after
+    :param writer: The worker's PageWriter, or the Spool when pages go
+        through spool_drain.py, which then stores them and moves the cursor
+    :param lease: The worker's lease on the channel, renewed between pages.
+        The crawl stops if the lease is lost.
+    :return: Tuple of (messages fetched, ids of the first page when this was
+        the channel's first crawl, else None)
+    """
+    channel_id: int = channel['channel_id']
+
+    logger.debug(
+        'Getting channel history for | {0} | {1} | {2}'.format(
+            channel['guild_name'],
+            channel['channel_name'],
+            channel_id
+        )
+    )
+
+    more_messages = True
+    reached_end = False
+    start_time = datetime.now()
+    low_id: int = snowflake
+    high_id: int = low_id
+    # A channel we never crawled starts at its newest page. Everything older
+    # is left to backfill_history.py.
+    first_crawl = not snowflake
+    first_page_ids: Optional[List[int]] = None
+    total_messages = 0
+
+    while more_messages:
+        if lease is not None and not lease.keep_alive():
+            break
+
+        try:
+            messages = pool.get_messages(channel['guild_id'], channel_id, after=snowflake or None)
+        except DiscordAPI429 as e:
+            # Keep what we have. The cursor covers every stored page, so
+            # the next crawl of this channel continues from there.
+            logger.warning('Channel {0} still rate limited, moving on: {1}'.format(channel_id, e))
+            break
+
+        # Has messages. Save them and calculate the next snowflake
+        # messages.ok
+        if isinstance(messages, list) and len(messages) > 0:
+            snowflake = get_snowflake(messages)
+            page_low_id = min(int(m['id']) for m in messages)
+            total_messages += len(messages)
+            metrics.PAGES.inc()
+            metrics.MESSAGES_FETCHED.inc(amount=len(messages))
+            writer.append(channel_id, snowflake, page_low_id, dumps_page(messages))
+            if first_crawl:
+                low_id = page_low_id
+                first_page_ids = [int(m['id']) for m in messages]
+                first_crawl = False
+
+        # Some kind of error came back. (Usually access related) Exit the while
+        # message.has_error
+        elif isinstance(messages, dict):
+            writer.append_update(channel_id, {'crawl_enabled': False})
+            more_messages = False
+            logger.warning('Channel {0} got error: {1}'.format(channel_id, messages))
+
+        # No messages returned. We reached the max. Log the crawl
+        # messages.is_empty
+        elif len(messages) == 0:
+            more_messages = False
+            reached_end = True
+            high_id = snowflake
+            # The channel's last message may have been deleted. Moving the
+            # cursor up to it stops the channel being picked again for nothing.
+            if channel['last_message_id'] and channel['last_message_id'] > int(high_id):
+                high_id = channel['last_message_id']
+            # Queued behind the channel's pages, so it cannot pass them.
+            writer.append(channel_id, high_id)
+
+    if reached_end:
+        writer.append_update(channel_id, {'crawl_log': {
+            'low_id': low_id,
+            'high_id': high_id,
+            'started_at': start_time.isoformat(),
+            'ended_at': datetime.utcnow().isoformat(),
+        }})
+
+    return total_messages, first_page_ids
+
+
+def crawl_worker(
+    selfbot: Dict,
+    pool: TokenPool,
+    stop: threading.Event,
+    spool: Optional[Spool] = None,
+) -> None:
+    """
+    Claim and crawl channels of one selfbot until `stop` is set.
+
+    Each worker has its own autocommit connection, and a PageWriter with
+    another one unless pages go to the spool. Channels are claimed
+    CRAWL_CLAIM_BATCH at a time into a local queue and stay leased until
+    they are crawled, so no transaction stays open between pages. Claims
+    still queued at shutdown are given back.
+
+    The next crawl is scheduled and the lease given back by an update
+    record queued behind the channel's pages, so a channel is not claimed
+    again before its cursor moved. With the spool a crawl needs the
+    database only to claim and renew leases: when the connection breaks the
+    claimed channels are still crawled, for as long as the leases last
+    (LEASE_TTL), while the worker reconnects.
+
+    :param selfbot: selfbot row
+    :param pool: Tokens of every selfbot, shared by all workers
+    :param stop: Set to shut the worker down after the current channel
+    :param spool: Local spool shared by all workers, if SPOOL_DIR is set
+    :return: None
+    """
+    db_conn = get_db_conn()
+    writer = spool or PageWriter('{0}-writer'.format(threading.current_thread().name))
+    owner = lease_owner()
+    queue = deque()
+    claimed_at = renewed_at = reconnect_at = 0.0
+
+    while not stop.is_set():
+        lease = None
+        try:
+            if db_conn.broken and time.monotonic() >= reconnect_at:
+                try:
+                    db_conn = get_db_conn()
+                except psycopg.OperationalError:
+                    logger.warning('Database unreachable, retrying in {0}s'.format(settings.CRAWL_IDLE_SLEEP))
+                    reconnect_at = time.monotonic() + settings.CRAWL_IDLE_SLEEP
+                    if not queue:
+                        stop.wait(settings.CRAWL_IDLE_SLEEP)
+                        continue
+
+            if not queue:
+                queue.extend(claim_channels(
+                    db_conn, selfbot['id'], owner, settings.CRAWL_CLAIM_BATCH,
+                ))
+                metrics.CHANNELS_CLAIMED.inc(amount=len(queue))
+
+                if not queue:
+                    # Crawls still waiting in the spool keep their leases
+                    # until spool_drain.py stores them.
+                    if time.monotonic() - renewed_at >= settings.LEASE_TTL / 3:
+                        renew_crawl_leases(db_conn, 'forward', owner)
+                        renewed_at = time.monotonic()
+                    stop.wait(settings.CRAWL_IDLE_SLEEP)
+                    continue
+                claimed_at = renewed_at = time.monotonic()
+
+            channel = queue.popleft()
+            metrics.CLAIM_QUEUE.set(threading.current_thread().name, value=len(queue))
+            lease = Lease(db_conn, channel['channel_id'], 'forward', owner, renewed_at)
+            messages, first_page_ids = crawl_channel(
+                pool, channel, channel['snowflake_id'], writer, lease,
+            )
+            # keep_alive replaces a broken connection.
+            db_conn = lease.conn
+            renewed_at = lease.renewed_at
+
+            if lease.lost:
+                # The new owner schedules the channel.
+                writer.flush()
+                continue
+
+            rate = estimate_rate(
+                channel['message_rate'],
+                messages,
+                channel['seconds_since_crawl'] + time.monotonic() - claimed_at,
+                first_page_ids,
+            )
+            writer.append_update(channel['channel_id'], {
+                'schedule': {
+                    'message_rate': rate,
+                    'messages': messages,
+                    'interval': next_crawl_interval(rate, channel['crawl_priority']),
+                },
+                'release': {'lane': 'forward', 'owner': owner},
+            })
+            writer.flush()
+            lease = None
+
+        except Exception:
+            logger.exception('Crawl failed for selfbot {0}'.format(selfbot['username']))
+            if db_conn.broken and spool is None:
+                # Nothing can be stored. The leases expire on their own after
+                # LEASE_TTL.
+                queue.clear()
+                lease = None
+            stop.wait(settings.CRAWL_IDLE_SLEEP)
+
+        finally:
+            if lease is not None and not lease.lost:
+                try:
+                    lease.release()
+                except psycopg.Error:
+                    logger.exception('Could not release the lease on channel {0}'.format(
+                        lease.channel_id,
+                    ))
+
+    if queue:
+        logger.info('Returning {0} unstarted channels'.format(len(queue)))
+        try:
+            release_crawl_leases(db_conn, [c['channel_id'] for c in queue], 'forward', owner)
+        except psycopg.Error as e:
+            logger.warning('Could not return them, their leases expire after {0}s: {1}'.format(settings.LEASE_TTL, e))
+
+    if writer is not spool:
+        writer.close()
+    db_conn.close()
+
+
 if __name__ == '__main__':
 
     logger.info('Starting up...')
-    db_conn = get_db_conn(autocommit=False)
+    db_conn = get_db_conn()
     selfbots = get_selfbots(db_conn)
 
     if not selfbots:
         logger.critical('No selfbot tokens. Add them to the database.')
         exit(1)
 
-    discord_apis = {}
+    stop = threading.Event()
+    # SIGTERM is handled like Ctrl-C. Setting the event from inside a signal
+    # handler can deadlock with the stop.wait() it interrupts.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    spool = None
+    if settings.SPOOL_DIR:
+        spool = Spool(
+            settings.SPOOL_DIR,
+            settings.SPOOL_MAX_BYTES,
+            settings.SPOOL_SEGMENT_BYTES,
+            settings.SPOOL_FSYNC_INTERVAL,
+        )
+        logger.info('Writing pages to the spool in {0}'.format(settings.SPOOL_DIR))
+
+    metrics.serve()
+    pool = TokenPool(selfbots)
+    pool.refresh(db_conn)
+    create_message_partitions(db_conn, settings.MESSAGE_PARTITIONS_AHEAD)
+
+    workers = []
     for sb in selfbots:
-        discord_apis[sb['username']] = DiscordAPI(sb['token'])
-
-    while True:
-        with db_conn.cursor() as cur:
-            channel = cur.execute("""
-            SELECT 
-                c.id as channel_id, 
-                c.name as channel_name,
-                g.name as guild_name,
-                s.username as selfbot_name
-            FROM channel c 
-            LEFT JOIN guild g on g.id = c.guild_id
-            LEFT JOIN selfbot s on s.id = g.selfbot_id
-            WHERE c.crawl_enabled = true and g.crawl_enabled = true
-            ORDER BY c.last_update ASC
-            LIMIT 1
-            FOR UPDATE of c SKIP LOCKED;
-            """).fetchone()
-
-            snowflake = cur.execute("""
-            SELECT
-                coalesce(max(cl.high_message_id), 0) AS snowflake_id
-                from channel_crawl_log cl
-                LEFT JOIN channel c on c.id = cl.channel_id
-                WHERE c.id = %s            
-            """, [channel['channel_id']]).fetchone()
-
-            # channel = cur.execute("""
-            # SELECT
-            #     coalesce(max(cl.high_message_id), 0)  AS snowflake,
-            #     c.id AS channel_id,
-            #     c.name AS channel_name,
-            #     g.name AS guild_name,
-            #     s.username AS selfbot_name
-            #     FROM channel c
-            #     LEFT JOIN channel_crawl_log cl ON cl.channel_id = c.id
-            #     LEFT JOIN guild g ON c.guild_id = g.id
-            #     LEFT JOIN selfbot s ON g.selfbot_id = s.id
-            #     WHERE c.crawl_enabled = true
-            #     GROUP BY c.id, c.name, s.username, g.name
-            #     ORDER BY max(c.last_update) ASC
-            #     LIMIT 1;
-            # """).fetchone()
-
-        channel_id: int = channel['channel_id']
-        snowflake: int = snowflake['snowflake_id']
-
-        logger.debug(
-            'Getting channel history for | {0} | {1} | {2}'.format(
-                channel['guild_name'],
-                channel['channel_name'],
-                channel_id
+        concurrency = sb['crawl_concurrency'] or settings.CRAWL_CONCURRENCY
+        logger.info('Crawling {0} channels at once for {1}'.format(concurrency, sb['username']))
+
+        for n in range(concurrency):
+            worker = threading.Thread(
+                target=crawl_worker,
+                args=(sb, pool, stop, spool),
+                name='{0}-{1}'.format(sb['username'], n),
             )
-        )
+            worker.start()
+            workers.append(worker)
+
+    reported_at = partitioned_at = time.monotonic()
+    try:
+        while not stop.wait(settings.TOKEN_POOL_REFRESH):
+            try:
+                if db_conn.broken:
+                    db_conn = get_db_conn()
+                pool.refresh(db_conn)
+
+                if time.monotonic() - partitioned_at >= PARTITION_CHECK_INTERVAL:
+                    created = create_message_partitions(db_conn, settings.MESSAGE_PARTITIONS_AHEAD)
+                    if created:
+                        logger.info('Created {0} message partitions'.format(created))
+                    partitioned_at = time.monotonic()
+            except psycopg.Error:
+                logger.exception('Could not refresh the token pool or message partitions')
+
+            if settings.RATE_LIMIT_REPORT_INTERVAL and \
+                    time.monotonic() - reported_at >= settings.RATE_LIMIT_REPORT_INTERVAL:
+                log_snapshot()
+                reported_at = time.monotonic()
+    except KeyboardInterrupt:
+        stop.set()
 
-        more_messages = True
-        start_time = datetime.now()
-        low_id: int = snowflake
-        high_id: int = low_id
-        total_messages = 0
-
-        while more_messages:
-            messages = discord_apis[channel['selfbot_name']].get_messages(channel_id, after=snowflake)
-
-            # Has messages. Save them and calculate the next snowflake
-            # messages.ok
-            if isinstance(messages, list) and len(messages) > 0:
-                upsert_messages(db_conn, messages, channel_id)
-                snowflake = get_snowflake(messages)
-
-            # Some kind of error came back. (Usually access related) Exit the while
-            # message.has_error
-            elif isinstance(messages, dict):
-                channel_crawl_enabled(db_conn, channel_id, False)
-                more_messages = False
-                logger.warning('Channel {0} got error: {1}'.format(channel_id, messages))
-
-            # No messages returned. We reached the max. Log the crawl
-            # messages.is_empty
-            elif len(messages) == 0:
-                more_messages = False
-                high_id = snowflake
-                create_channel_crawl_log(
-                    conn=db_conn,
-                    low_id=low_id,
-                    high_id=high_id,
-                    start_time=start_time,
-                    end_time=datetime.utcnow(),
-                    channel_id=channel_id,
-                )
-
-        channel_mark_last_update(db_conn, channel_id)
-        db_conn.commit()
+    logger.info('Waiting for crawls in progress to finish...')
+    for worker in workers:
+        worker.join()
 
+    if spool is not None:
+        spool.close()
     db_conn.close()
     print('DONE')
@@ -0,0 +1,93 @@
+"""Balance guilds over selfbot accounts by measured request demand.
+
+Prints the planned changes to guild.selfbot_id and the load per selfbot
+before and after. Nothing is written unless --apply is passed:
+
+    python plan_placement.py            # dry run
+    python plan_placement.py --apply
+"""
+
+import argparse
+import logging.config
+from typing import Dict, List
+
+import settings
+from libs.db_operations import (
+    get_db_conn,
+    get_selfbots,
+    get_guild_placement,
+    assign_guild_selfbots,
+)
+from libs.placement import Guild, plan_placement, loads
+from libs.scheduler import requests_per_hour
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+def print_loads(
+    label: str,
+    guilds: List[Guild],
+    assignment: Dict[int, int],
+    capacities: Dict[int, float],
+    names: Dict[int, str],
+) -> None:
+    load = loads(guilds, assignment, capacities)
+    print('{0}: max {1:.0f} requests/hour per worker'.format(label, max(load.values(), default=0)))
+    for selfbot_id in sorted(load, key=load.get, reverse=True):
+        print('  {0:<24} {1:>4} guilds {2:>10.0f} req/h {3:>8.0f} per worker'.format(
+            names[selfbot_id],
+            sum(1 for s in assignment.values() if s == selfbot_id),
+            load[selfbot_id] * capacities[selfbot_id],
+            load[selfbot_id],
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--apply', action='store_true', help='Write the plan to guild.selfbot_id')
+    args = parser.parse_args()
+
+    db_conn = get_db_conn()
+    selfbots = get_selfbots(db_conn) or []
+
+    names = {sb['id']: sb['username'] for sb in selfbots}
+    capacities = {
+        sb['id']: float(sb['crawl_concurrency'] or settings.CRAWL_CONCURRENCY) for sb in selfbots
+    }
+
+    guilds = [
+        Guild(
+            row['id'],
+            row['name'],
+            sum(requests_per_hour(rate, row['crawl_priority']) for rate in row['message_rates']),
+            row['members'],
+            row['selfbot_id'],
+        )
+        for row in get_guild_placement(db_conn)
+    ]
+
+    current = {guild.id: guild.selfbot_id for guild in guilds if guild.selfbot_id is not None}
+    plan = plan_placement(guilds, capacities)
+
+    moves = [guild for guild in guilds if plan.get(guild.id) != guild.selfbot_id]
+    for guild in sorted(moves, key=lambda g: -g.demand):
+        print('{0:<32} {1:>10.0f} req/h  {2} -> {3}'.format(
+            (guild.name or str(guild.id))[:32],
+            guild.demand,
+            names.get(guild.selfbot_id, guild.selfbot_id),
+            names.get(plan[guild.id], plan[guild.id]),
+        ))
+    print('{0} of {1} guilds move\n'.format(len(moves), len(guilds)))
+
+    print_loads('Current', guilds, current, capacities, names)
+    print_loads('Planned', guilds, plan, capacities, names)
+
+    if args.apply:
+        moved = assign_guild_selfbots(db_conn, plan)
+        logger.info('Moved {0} guilds'.format(moved))
+    elif moves:
+        print('\nDry run. Pass --apply to write the plan.')
+
+    db_conn.close()
@@ -2,10 +2,15 @@
 
 import logging.config
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from libs.api import DiscordAPI
+import requests
+
+from libs.api import DiscordAPI429, DiscordAPIException
+from libs import metrics
 import settings
 from libs.db_operations import get_db_conn, get_selfbots, upsert_channels
+from libs.tokens import TokenPool
 
 
 logging.config.dictConfig(settings.DEFAULT_LOGGING)
@@ -15,41 +20,77 @@ logger = logging.getLogger(__name__)
 if __name__ == '__main__':
 
     logger.info('Starting up...')
+    metrics.serve()
     db_conn = get_db_conn()
     selfbots = get_selfbots(db_conn)
+    started_at = time.monotonic()
 
     if not selfbots:
         logger.warning('No selfbot tokens. Add them to the database.')
 
-    discord_apis = {}
-    for sb in selfbots:
-        discord_apis[sb['username']] = DiscordAPI(sb['token'])
+    # Channel lists are fetched with any selfbot in the guild, chosen like
+    # the tokens of message_history.
+    pool = TokenPool(selfbots or [])
+    pool.refresh(db_conn)
 
     with db_conn.cursor() as cur:
         guilds = cur.execute("""
-            SELECT g.id, g.name, s.username as selfbot_name
+            SELECT g.id, g.name
             FROM guild g
-            LEFT JOIN selfbot s ON g.selfbot_id = s.id 
             WHERE g.crawl_enabled = true
             ORDER BY g.crawl_priority DESC 
         """).fetchall()
 
-    for guild in guilds:
-        guild_id = guild['id']
-        logger.debug(
-            'Getting channels for guild {0}-{1}'.format(
-                guild['name'],
-                guild_id,
-            ),
-        )
-        channels = discord_apis[guild['selfbot_name']].get_channels(guild_id)
+    totals = {'created': 0, 'changed': 0, 'deleted': 0}
+    failed = 0
+
+    # Channel lists are fetched TOPOLOGY_CONCURRENCY guilds at a time within
+    # each token's rate limits; every guild is written in one statement as
+    # its list arrives.
+    with ThreadPoolExecutor(max_workers=settings.TOPOLOGY_CONCURRENCY) as executor:
+        futures = {}
+        for guild in guilds:
+            future = executor.submit(pool.get_channels, guild['id'])
+            futures[future] = guild
+
+        for future in as_completed(futures):
+            guild = futures[future]
+            guild_id = guild['id']
+            logger.debug(
+                'Got channels for guild {0}-{1}'.format(
+                    guild['name'],
+                    guild_id,
+                ),
+            )
 
-        if channels:
-            upsert_channels(db_conn, channels, guild_id)
-        else:
-            logger.warning('No channels found for Guild {0} | {1}'.format(guild['name'], guild_id))
+            try:
+                channels = future.result()
+            except (DiscordAPI429, DiscordAPIException, requests.RequestException) as e:
+                logger.error('Could not get channels of guild {0} | {1}: {2}'.format(guild['name'], guild_id, e))
+                failed += 1
+                continue
 
-        time.sleep(3)
+            if isinstance(channels, dict):
+                logger.warning('Guild {0} | {1} got error: {2}'.format(guild['name'], guild_id, channels))
+                failed += 1
+            elif channels:
+                write_started_at = time.monotonic()
+                counts = upsert_channels(db_conn, channels, guild_id)
+                metrics.DB_WRITE_SECONDS.observe('channels', value=time.monotonic() - write_started_at)
+                for key in totals:
+                    totals[key] += counts[key]
+            else:
+                logger.warning('No channels found for Guild {0} | {1}'.format(guild['name'], guild_id))
 
+    logger.info('Refreshed {0} guilds in {1:.1f}s: {2} new, {3} changed, {4} deleted channels, {5} guilds failed'.format(
+        len(futures) - failed,
+        time.monotonic() - started_at,
+        totals['created'],
+        totals['changed'],
+        totals['deleted'],
+        failed,
+    ))
+    # Deactivates the memberships of tokens Discord rejected.
+    pool.refresh(db_conn)
     db_conn.close()
     logger.info('DONE')
@@ -1,12 +1,20 @@
 """Periodically refresh guilds and add them to the database."""
 
 import logging.config
-from libs.api import DiscordAPI
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import requests
+
+from libs.api import DiscordAPI, DiscordAPI429, GUILD_LIMIT
+from libs import metrics
 import settings
 from libs.db_operations import (
     get_db_conn,
     get_selfbots,
-    upsert_guild,
+    upsert_guilds,
+    upsert_guild_memberships,
 )
 
 
@@ -14,24 +22,65 @@ logging.config.dictConfig(settings.DEFAULT_LOGGING)
 logger = logging.getLogger(__name__)
 
 
+def fetch_guilds(discord: DiscordAPI) -> Optional[List[Dict]]:
+    """
+    Every guild a selfbot is a member of, GUILD_LIMIT per request.
+
+    :param discord: The selfbot's API client
+    :return: Guild objects, None if the API answered with an error
+    """
+    guilds: List[Dict] = []
+    after = None
+
+    while True:
+        page = discord.get_guilds(after=after)
+        if isinstance(page, dict):
+            logger.error('Could not list guilds of {0}: {1}'.format(discord.limiter.name, page))
+            return None
+
+        guilds.extend(page)
+        if len(page) < GUILD_LIMIT:
+            return guilds
+        after = max(int(guild['id']) for guild in page)
+
+
 if __name__ == '__main__':
 
     logger.info('Starting up...')
+    metrics.serve()
     db_conn = get_db_conn()
     selfbots = get_selfbots(db_conn)
+    started_at = time.monotonic()
 
     if not selfbots:
         logger.warning('No selfbot tokens. Add them to the database.')
 
-    for sb in selfbots:
-        discord = DiscordAPI(sb['token'])
+    # Fetch every selfbot's guilds at once, write them here one by one.
+    with ThreadPoolExecutor(max_workers=settings.TOPOLOGY_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(fetch_guilds, DiscordAPI(sb['token'], name=sb['username'])): sb
+            for sb in selfbots
+        }
+
+        for future in as_completed(futures):
+            sb = futures[future]
+            try:
+                guilds = future.result()
+            except (DiscordAPI429, requests.RequestException) as e:
+                logger.error('Could not list guilds of {0}: {1}'.format(sb['username'], e))
+                continue
 
-        logger.debug('Getting Guilds...')
-        guilds = discord.get_guilds()
+            if guilds is None:
+                continue
 
-        if guilds:
-            logger.debug('Got {0} Guilds. Upserting'.format(len(guilds)))
-            [upsert_guild(db_conn, guild, sb['id']) for guild in guilds]
+            write_started_at = time.monotonic()
+            with db_conn.transaction():
+                written = upsert_guilds(db_conn, guilds, sb['id'])
+                # Every selfbot in a guild shares its crawl, see libs/tokens.py
+                upsert_guild_memberships(db_conn, sb['id'], [int(guild['id']) for guild in guilds])
+            metrics.DB_WRITE_SECONDS.observe('guilds', value=time.monotonic() - write_started_at)
+            logger.info('{0}: {1} guilds, {2} new or changed'.format(sb['username'], len(guilds), written))
 
+    logger.info('Refreshed guilds of {0} selfbots in {1:.1f}s'.format(len(selfbots), time.monotonic() - started_at))
     db_conn.close()
-    logger.info('DONE')
\ No newline at end of file
+    logger.info('DONE')
@@ -0,0 +1,141 @@
+"""Periodically refresh the members of all guilds.
+
+Member lists are paged through MEMBER_LIMIT members at a time, for
+MEMBER_CONCURRENCY guilds at once within each token's rate limits. Every
+page is copied into a staging table as it arrives, so memory stays at one
+page per guild however big the guild is. Once a guild's list is complete
+it is merged into `member` in one statement that only writes new and
+changed members and marks the ones that left.
+"""
+
+import logging.config
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Optional
+
+import psycopg
+import requests
+
+from libs.api import DiscordAPI, DiscordAPI429, MEMBER_LIMIT
+from libs import metrics
+import settings
+from libs.db_operations import (
+    get_db_conn,
+    get_selfbots,
+    start_member_stage,
+    stage_members,
+    merge_members,
+)
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+def refresh_members(discord: DiscordAPI, guild: Dict) -> Optional[Dict[str, int]]:
+    """
+    Download the member list of a guild and store what changed.
+
+    :param discord: Client of the guild's selfbot
+    :param guild: Guild row
+    :return: Dict of members listed and created, changed and left counts,
+        None if the list could not be fetched completely
+    """
+    db_conn = get_db_conn()
+    try:
+        start_member_stage(db_conn)
+        listed = 0
+        after = None
+
+        while True:
+            page = discord.get_members(guild['id'], after=after)
+            if isinstance(page, dict):
+                logger.warning('Guild {0} | {1} got error: {2}'.format(guild['name'], guild['id'], page))
+                return None
+
+            if page:
+                stage_members(db_conn, page)
+                listed += len(page)
+                after = max(int(member['user']['id']) for member in page)
+            if len(page) < MEMBER_LIMIT:
+                break
+
+        if not listed:
+            # Every guild has at least the selfbot as a member.
+            logger.warning('No members found for Guild {0} | {1}'.format(guild['name'], guild['id']))
+            return None
+
+        started_at = time.monotonic()
+        counts = merge_members(db_conn, guild['id'])
+        metrics.DB_WRITE_SECONDS.observe('members', value=time.monotonic() - started_at)
+        counts['members'] = listed
+        return counts
+    finally:
+        db_conn.close()
+
+
+if __name__ == '__main__':
+
+    logger.info('Starting up...')
+    metrics.serve()
+    db_conn = get_db_conn()
+    selfbots = get_selfbots(db_conn)
+    started_at = time.monotonic()
+
+    if not selfbots:
+        logger.warning('No selfbot tokens. Add them to the database.')
+
+    discord_apis = {}
+    for sb in selfbots:
+        discord_apis[sb['username']] = DiscordAPI(sb['token'], name=sb['username'])
+
+    with db_conn.cursor() as cur:
+        guilds = cur.execute("""
+            SELECT g.id, g.name, s.username as selfbot_name
+            FROM guild g
+            LEFT JOIN selfbot s ON g.selfbot_id = s.id
+            WHERE g.crawl_enabled = true
+            ORDER BY g.members_refreshed_at ASC NULLS FIRST
+        """).fetchall()
+
+    totals = {'members': 0, 'created': 0, 'changed': 0, 'left': 0}
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=settings.MEMBER_CONCURRENCY) as executor:
+        futures = {}
+        for guild in guilds:
+            if guild['selfbot_name'] not in discord_apis:
+                logger.warning('Guild {0} | {1} has no selfbot'.format(guild['name'], guild['id']))
+                continue
+            future = executor.submit(refresh_members, discord_apis[guild['selfbot_name']], guild)
+            futures[future] = guild
+
+        for future in as_completed(futures):
+            guild = futures[future]
+            try:
+                counts = future.result()
+            except (DiscordAPI429, requests.RequestException, psycopg.Error) as e:
+                logger.error('Could not refresh members of guild {0} | {1}: {2}'.format(guild['name'], guild['id'], e))
+                counts = None
+
+            if counts is None:
+                failed += 1
+                continue
+
+            logger.info('Guild {0} | {1}: {2} members, {3} new, {4} changed, {5} left'.format(
+                guild['name'], guild['id'], counts['members'], counts['created'], counts['changed'], counts['left'],
+            ))
+            for key in totals:
+                totals[key] += counts[key]
+
+    logger.info('Refreshed {0} guilds in {1:.1f}s: {2} members, {3} new, {4} changed, {5} left, {6} guilds failed'.format(
+        len(futures) - failed,
+        time.monotonic() - started_at,
+        totals['members'],
+        totals['created'],
+        totals['changed'],
+        totals['left'],
+        failed,
+    ))
+    db_conn.close()
+    logger.info('DONE')
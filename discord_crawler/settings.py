@@ -1,5 +1,6 @@
 """Config file for logging and other settings as they come along."""
 import os
+import socket
 
 
 VERBOSE = os.getenv('VERBOSE', False)
@@ -40,7 +41,101 @@ DEFAULT_LOGGING = {
     }
 }
 
-BASE_URL = 'https://discord.com/api/v10/{0}'
+BASE_URL = os.getenv('DISCORD_API_URL', 'https://discord.com/api/v10') + '/{0}'
+
+# Size of the keep-alive connection pool shared by every client of a token.
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 300))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 30))
+
+# Discord allows 50 requests/sec per token across all routes.
+RATE_LIMIT_GLOBAL_PER_SECOND = int(os.getenv('RATE_LIMIT_GLOBAL_PER_SECOND', 50))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv('RATE_LIMIT_MAX_RETRIES', 5))
+# Seconds between rate limiter state reports in the logs. 0 disables them.
+RATE_LIMIT_REPORT_INTERVAL = int(os.getenv('RATE_LIMIT_REPORT_INTERVAL', 60))
+
+# Channels crawled at once per selfbot. selfbot.crawl_concurrency overrides it.
+CRAWL_CONCURRENCY = int(os.getenv('CRAWL_CONCURRENCY', 1))
+# Channels backfill_history.py backfills at once per selfbot.
+BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', 1))
+# Seconds a crawl worker waits when there is nothing to crawl or after an error.
+CRAWL_IDLE_SLEEP = float(os.getenv('CRAWL_IDLE_SLEEP', 5))
+# Seconds a channel lease lives without a heartbeat. Workers renew it every
+# third of that, so a dead worker's channels are crawled again after at most
+# LEASE_TTL seconds.
+LEASE_TTL = float(os.getenv('LEASE_TTL', 120))
+# Channels a message_history worker claims in one query and queues locally.
+CRAWL_CLAIM_BATCH = int(os.getenv('CRAWL_CLAIM_BATCH', 10))
+# Seconds between reloads of which selfbots are members of which guild.
+TOKEN_POOL_REFRESH = float(os.getenv('TOKEN_POOL_REFRESH', 60))
+# Monthly message partitions message_history keeps created ahead of time.
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv('MESSAGE_PARTITIONS_AHEAD', 3))
+
+# Port the crawler processes serve Prometheus metrics on (libs/metrics.py).
+# 0 disables. Give every process on a host its own port.
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Guilds refresh_guilds / refresh_channels fetch from the API at once. The
+# rate limiter still spaces out the requests of each token.
+TOPOLOGY_CONCURRENCY = int(os.getenv('TOPOLOGY_CONCURRENCY', 8))
+
+# Guild member lists refresh_users.py downloads at once. Each holds one page
+# (1000 members) in memory and a database connection.
+MEMBER_CONCURRENCY = int(os.getenv('MEMBER_CONCURRENCY', 4))
+
+# Attachment downloads (download_attachments.py, libs/download.py). Files
+# are stored under ATTACHMENT_DIR by the SHA-256 of their content.
+ATTACHMENT_DIR = os.getenv('ATTACHMENT_DIR', '')
+# Downloads running at once, in total and per host.
+ATTACHMENT_CONCURRENCY = int(os.getenv('ATTACHMENT_CONCURRENCY', 16))
+ATTACHMENT_HOST_CONCURRENCY = int(os.getenv('ATTACHMENT_HOST_CONCURRENCY', 8))
+# Larger attachments are not downloaded.
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', 100 * 1024 ** 2))
+# Attempts before a download is given up.
+ATTACHMENT_MAX_ATTEMPTS = int(os.getenv('ATTACHMENT_MAX_ATTEMPTS', 5))
+# Seconds a claimed download may take before another downloader retries it.
+ATTACHMENT_CLAIM_TTL = float(os.getenv('ATTACHMENT_CLAIM_TTL', 900))
+
+# Gateway ingestion (gateway_ingest.py, libs/gateway.py).
+GATEWAY_URL = os.getenv('DISCORD_GATEWAY_URL', 'wss://gateway.discord.gg/?v=10&encoding=json')
+# Message events written per transaction, and the longest an event waits
+# for its batch to fill.
+GATEWAY_BATCH_EVENTS = int(os.getenv('GATEWAY_BATCH_EVENTS', 500))
+GATEWAY_BATCH_SECONDS = float(os.getenv('GATEWAY_BATCH_SECONDS', 0.5))
+# Events held while the database is slow or down. Beyond that they are
+# dropped and REST polling fills the gap.
+GATEWAY_MAX_PENDING = int(os.getenv('GATEWAY_MAX_PENDING', 50000))
+# Seconds message_history leaves a channel alone after the gateway moved its
+# cursor. Crawls then only catch what the gateway missed without noticing.
+GATEWAY_CRAWL_DEFER = float(os.getenv('GATEWAY_CRAWL_DEFER', 600))
+
+# Local spool (libs/spool.py). When SPOOL_DIR is set message_history appends
+# fetched pages there and spool_drain.py writes them to the database.
+SPOOL_DIR = os.getenv('SPOOL_DIR', '')
+# Name of this host's spool in spool_checkpoint. One per SPOOL_DIR.
+SPOOL_ID = os.getenv('SPOOL_ID', socket.gethostname())
+# Disk space the spool may use before crawlers wait for the drainer.
+SPOOL_MAX_BYTES = int(os.getenv('SPOOL_MAX_BYTES', 10 * 1024 ** 3))
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', 64 * 1024 ** 2))
+# Seconds between fsyncs of appended pages.
+SPOOL_FSYNC_INTERVAL = float(os.getenv('SPOOL_FSYNC_INTERVAL', 0.2))
+# Pages spool_drain.py writes per transaction.
+SPOOL_DRAIN_BATCH = int(os.getenv('SPOOL_DRAIN_BATCH', 200))
+
+# Write stage of message_history (libs/pipeline.py). Pages fetched ahead
+# while earlier ones are written, per crawl worker.
+PIPELINE_QUEUE_PAGES = int(os.getenv('PIPELINE_QUEUE_PAGES', 20))
+# Most pages written in one transaction.
+WRITE_MAX_BATCH = int(os.getenv('WRITE_MAX_BATCH', 50))
+# Seconds a batch write should take. Batches shrink when writes are slower.
+WRITE_TARGET_LATENCY = float(os.getenv('WRITE_TARGET_LATENCY', 0.25))
+
+# Adaptive scheduling (libs/scheduler.py). A channel is due again when about
+# CRAWL_TARGET_MESSAGES are expected to be waiting at its measured rate.
+CRAWL_TARGET_MESSAGES = float(os.getenv('CRAWL_TARGET_MESSAGES', 50))
+CRAWL_MIN_INTERVAL = float(os.getenv('CRAWL_MIN_INTERVAL', 60))
+CRAWL_MAX_STALENESS = float(os.getenv('CRAWL_MAX_STALENESS', 6 * 3600))
+CRAWL_RATE_SMOOTHING = float(os.getenv('CRAWL_RATE_SMOOTHING', 0.3))
 
 USER_AGENT = os.getenv('USER_AGENT', 'MeBottt (https://mebottt.co, 0.1)')
 DATABASE_URI = os.environ['DATABASE_URL']
\ No newline at end of file
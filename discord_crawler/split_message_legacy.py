@@ -0,0 +1,67 @@
+"""One-off job splitting message_legacy into monthly message partitions.
+
+The partitioning migration kept the messages stored before it in one
+partition, message_legacy, covering every id below the first monthly
+partition. This detaches it and moves its messages into their months,
+newest first, in batches of one transaction each, then drops it:
+
+    python split_message_legacy.py --batch 10000
+
+Interrupted runs can simply be started again: moved messages are no longer
+in message_legacy. Monthly partitions are created down to the oldest
+message, and create_message_partitions() creates the month of any older
+message stored afterwards.
+
+Until a message is moved it is missing from `message`: queries do not see
+it and edits or deletes from gateway_ingest do not reach it. A message
+stored again meanwhile is kept as stored then.
+"""
+
+import argparse
+import logging.config
+import signal
+import time
+
+import settings
+from libs.db_operations import get_db_conn, split_message_legacy
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+# Seconds between progress lines.
+REPORT_INTERVAL = 30
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch', type=int, default=10000, help='Messages per transaction')
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    db_conn = get_db_conn()
+    moved = 0
+    started_at = reported_at = time.monotonic()
+
+    try:
+        while True:
+            result = split_message_legacy(db_conn, args.batch)
+            if result is None:
+                logger.info('message_legacy is split')
+                break
+            if result == 0:
+                logger.info('Detached message_legacy')
+            moved += result
+
+            if time.monotonic() - reported_at >= REPORT_INTERVAL:
+                logger.info('Moved {0} messages, {1:.0f} messages/sec'.format(
+                    moved, moved / (time.monotonic() - started_at),
+                ))
+                reported_at = time.monotonic()
+    except KeyboardInterrupt:
+        logger.info('Stopping. Run again to continue')
+
+    logger.info('Moved {0} messages'.format(moved))
+    db_conn.close()
+    print('DONE')
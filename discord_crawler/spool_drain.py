@@ -0,0 +1,121 @@
+"""Write the pages message_history left in the local spool to the database.
+
+Run one next to message_history on every host that sets SPOOL_DIR:
+
+    SPOOL_DIR=/var/spool/discord python spool_drain.py
+
+Records are read in order, SPOOL_DRAIN_BATCH at a time. Each batch is stored
+in one transaction that inserts the messages, moves the channel cursors,
+applies the channel updates queued behind them (crawl log, next crawl,
+lease) and saves the spool position in spool_checkpoint. A batch is
+therefore stored completely or not at all, and after a crash or a lost
+connection draining continues from the last committed position. Messages
+stored twice are skipped by the insert. Segments before the checkpoint are
+deleted. With METRICS_PORT set, the inserted messages and write times are
+served as metrics, like message_history does without a spool.
+"""
+
+import logging.config
+import signal
+import time
+from typing import List, Tuple
+
+import psycopg
+
+import settings
+from libs import metrics
+from libs.db_operations import get_db_conn, get_spool_checkpoint, set_spool_checkpoint
+from libs.pipeline import store_records
+from libs.spool import Record, SpoolReader, disk_usage
+
+
+logging.config.dictConfig(settings.DEFAULT_LOGGING)
+logger = logging.getLogger(__name__)
+
+
+# Seconds to wait when the spool is drained or the database is unreachable.
+IDLE_SLEEP = 1.0
+
+# Seconds between progress lines.
+REPORT_INTERVAL = 60
+
+
+def store_batch(
+    db_conn: psycopg.Connection,
+    records: List[Record],
+    position: Tuple[int, int],
+) -> int:
+    """
+    Store a batch of records and the spool position after it.
+
+    :param db_conn: Database handle, autocommit on
+    :param records: Records read from the spool
+    :param position: Tuple of (segment, offset) after the last record
+    :return: New messages inserted
+    """
+    started_at = time.monotonic()
+    with db_conn.transaction():
+        inserted = store_records(db_conn, records)
+        set_spool_checkpoint(db_conn, settings.SPOOL_ID, *position)
+    metrics.DB_WRITE_SECONDS.observe('messages', value=time.monotonic() - started_at)
+    metrics.MESSAGES_INSERTED.inc(amount=inserted)
+    return inserted
+
+
+if __name__ == '__main__':
+
+    if not settings.SPOOL_DIR:
+        logger.critical('Set SPOOL_DIR to the spool message_history writes to.')
+        exit(1)
+
+    # SIGTERM is handled like Ctrl-C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    metrics.serve()
+
+    reader = SpoolReader(settings.SPOOL_DIR)
+    db_conn = None
+    position = None
+    pages = inserted = 0
+    reported_at = time.monotonic()
+    logger.info('Draining spool {0} in {1}'.format(settings.SPOOL_ID, settings.SPOOL_DIR))
+
+    try:
+        while True:
+            try:
+                if db_conn is None or db_conn.broken:
+                    db_conn = get_db_conn()
+                    # The last commit may or may not have gone through.
+                    position = None
+                if position is None:
+                    position = get_spool_checkpoint(db_conn, settings.SPOOL_ID) or (0, 0)
+
+                records, next_position = reader.read(*position, settings.SPOOL_DRAIN_BATCH)
+                if records:
+                    inserted += store_batch(db_conn, records, next_position)
+                    pages += sum(1 for record in records if record.payload and not record.is_update)
+                elif next_position != position:
+                    # Skipped a torn record or a deleted segment.
+                    set_spool_checkpoint(db_conn, settings.SPOOL_ID, *next_position)
+                position = next_position
+
+                reader.delete_before(position[0])
+            except psycopg.Error:
+                logger.exception('Could not drain the spool, retrying in {0}s'.format(IDLE_SLEEP))
+                time.sleep(IDLE_SLEEP)
+                continue
+
+            if time.monotonic() - reported_at >= REPORT_INTERVAL:
+                logger.info('Drained {0} pages, {1} new messages. {2} bytes in the spool'.format(
+                    pages, inserted, disk_usage(settings.SPOOL_DIR),
+                ))
+                reported_at = time.monotonic()
+
+            if not records:
+                time.sleep(IDLE_SLEEP)
+    except KeyboardInterrupt:
+        pass
+
+    logger.info('Drained {0} pages, {1} new messages'.format(pages, inserted))
+    if db_conn is not None:
+        db_conn.close()
+    print('DONE')